@@ -60,6 +60,13 @@ parser.add_argument('--dropout_rate', type=float, help='Dropout rate.')
 parser.add_argument('--use_dropout', type=int, help='Flag whether to use dropout.')
 parser.add_argument('--alpha', type=float, help='weighting factor of classification loss.')
 parser.add_argument('--lambda', type=float, help='weighting factor of generator.')
+parser.add_argument('--raw_shards', type=int, help='Flag whether to read the raw uint8 shards.')
+parser.add_argument('--parallel_pipeline', type=int, help='Flag whether to use parallel map and prefetch.')
+parser.add_argument('--deterministic_pipeline', type=int, help='Flag whether to keep the element order.')
+parser.add_argument('--cache_eval', type=int, help='Flag whether to cache the eval splits.')
+parser.add_argument('--compiled_steps', type=int, help='Flag whether to trace the train steps with tf.function.')
+parser.add_argument('--xla', type=int, help='Flag whether to compile the traced train steps with XLA.')
+parser.add_argument('--fused_input_grads', type=int, help='Flag whether to compute the input gradients on the concatenated domains.')
 parser.add_argument('--epsL', type=float, help='Multiple for labels.')
 parser.add_argument('--epsD', type=float, help='Multiple for domains.')
 parser.add_argument('--seed', type=int, help='Seed.')
@@ -142,8 +149,89 @@ def loss_fn_label(features1, features2, features3, model_label, config, training
 
     return label_loss, accuracy, l2_regularizer
 
+# mean over the source domains of the per domain means, the domains are concatenated in inputs
+def _mean_per_domain(values, sizes):
+    return tf.reduce_mean([tf.reduce_mean(v) for v in tf.split(values, sizes)])
+
+# loss function for the domain network on the concatenated source domains
+def loss_fn_domain_fused(inputs, domain, sizes, model_domain, config, training):
+    domain_loss = tf.nn.softmax_cross_entropy_with_logits(labels = tf.one_hot(domain, axis=-1, 
+                                depth=config.num_classes_domain), 
+                                logits = model_domain(inputs, training=training))
+    return _mean_per_domain(domain_loss, sizes)
+
+# loss function for the class network on the concatenated source domains
+def loss_fn_label_fused(inputs, label, sizes, model_label, config, training):
+    # L2 regularizers
+    l2_regularizer = tf.add_n([tf.nn.l2_loss(v) for v in 
+        model_label.trainable_variables if 'bias' not in v.name])
+
+    # get predictions on all source domains at once
+    model_label_output = model_label(inputs, training=training)
+
+    label_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels = label,
+                                logits = model_label_output)
+    correct = tf.where(tf.equal(label, tf.argmax(model_label_output, axis=-1)),
+                    tf.ones_like(label, dtype=tf.float32),
+                    tf.zeros_like(label, dtype=tf.float32))
+
+    return _mean_per_domain(label_loss, sizes), _mean_per_domain(correct, sizes), l2_regularizer
+
+# train step with one forward pass per network on the concatenated domains, one input gradient 
+# per loss and the clean losses of the first pass reused for the parameter updates
+def _train_step_fused(model_label, model_domain, features1, features2, features3,
+                optimizer1, optimizer2, global_step, config):
+    features = [features1, features2, features3]
+    sizes = tf.stack([tf.shape(f["image"])[0] for f in features])
+    inputs = tf.concat([f["image"] for f in features], 0)
+    label = tf.concat([tf.reshape(f["label"], [-1]) for f in features], 0)
+    domain = tf.concat([tf.reshape(f["domain"], [-1]) for f in features], 0)
+
+    with tf.GradientTape(persistent=True) as tape_src:
+
+        tape_src.watch(inputs)
+
+        # get loss of labels
+        mean_classification_loss, accuracy, l2_regularizer = loss_fn_label_fused(
+            inputs, label, sizes, model_label, config=config, training=True)
+
+        tf.summary.scalar("binary_crossentropy", mean_classification_loss, 
+            step=global_step)
+        tf.summary.scalar("accuracy", accuracy, step=global_step)
+
+        total_loss = mean_classification_loss + \
+            config.l2_penalty_weight*l2_regularizer
+        # get loss of domains
+        loss_domain = loss_fn_domain_fused(inputs, domain, sizes, model_domain, config, training=True)
+
+        # get gradients wrt to inputs, one call per loss for all domains
+        with tape_src.stop_recording():
+            grads_l = tape_src.gradient(total_loss, inputs)
+            grads_d = tape_src.gradient(loss_domain, inputs)
+
+        # create the new features as defined in the paper
+        X_l = tf.stop_gradient(inputs + config.epsL*grads_l)
+        X_d = tf.stop_gradient(inputs + config.epsD*grads_d)
+
+        # calculate the losses with peturbated x
+        loss_l, _, _ = loss_fn_label_fused(X_d, label, sizes, model_label, config=config, training=True)
+        loss_d = loss_fn_domain_fused(X_l, domain, sizes, model_domain, config=config, training=True)
+
+        # calculate the losses for the gradients
+        loss3 = 0.9*loss_domain+0.1*loss_d
+        loss4 = 0.9*total_loss+0.1*loss_l
+
+    # calculate gradients for both neural nets
+    grads3 = tape_src.gradient(loss3, model_domain.trainable_variables)
+    grads4 = tape_src.gradient(loss4, model_label.trainable_variables)
+
+    # apply gradient to both neural nets
+    optimizer1.apply_gradients(zip(grads3, model_domain.trainable_variables))
+    optimizer2.apply_gradients(zip(grads4, model_label.trainable_variables))
+
 def _train_step(model_label, model_domain, features1, features2, features3,
                 optimizer1, optimizer2, global_step, config):
+    # the first tape is persistent for the two input gradients and released right after them
     with tf.GradientTape(persistent=True) as tape_src:
 
         tape_src.watch(features1["image"])
@@ -163,40 +251,40 @@ def _train_step(model_label, model_domain, features1, features2, features3,
         # get loss of domains
         loss_domain = loss_fn_domain(features1, features2, features3, model_domain, config, training=True)
 
-        # get gradients wrt to inputs
-        grads11 = tape_src.gradient(total_loss, features1["image"])
-        grads12 = tape_src.gradient(total_loss, features2["image"])
-        grads13 = tape_src.gradient(total_loss, features3["image"])
-        grads21 = tape_src.gradient(loss_domain, features1["image"])
-        grads22 = tape_src.gradient(loss_domain, features2["image"])
-        grads23 = tape_src.gradient(loss_domain, features3["image"])
-
-        # create the new features as defined in the paper
-        X_d1, X_d2, X_d3 = {}, {}, {}
-        X_l1, X_l2, X_l3 = {}, {}, {}
-
-
-        X_l1["image"] = features1["image"] + config.epsL*grads11
-        X_l1["label"] = features1["label"]
-        X_l1["domain"] = features1["domain"]
-        X_l2["image"] = features2["image"] + config.epsL*grads12
-        X_l2["label"] = features2["label"]
-        X_l2["domain"] = features2["domain"]
-        X_l3["image"] = features3["image"] + config.epsL*grads13
-        X_l3["label"] = features3["label"]
-        X_l3["domain"] = features3["domain"]
-        X_d1["image"] = features1["image"] + config.epsD*grads21
-        X_d1["label"] = features1["label"]
-        X_d1["domain"] = features1["domain"]
-        X_d2["image"] = features2["image"] + config.epsD*grads22
-        X_d2["label"] = features2["label"]
-        X_d2["domain"] = features2["domain"]
-        X_d3["image"] = features3["image"] + config.epsD*grads23
-        X_d3["label"] = features3["label"]
-        X_d3["domain"] = features3["domain"]
-
-    
-    with tf.GradientTape(persistent=True) as tape_src:
+    # get gradients wrt to inputs
+    grads11, grads12, grads13 = tape_src.gradient(total_loss, 
+        [features1["image"], features2["image"], features3["image"]])
+    grads21, grads22, grads23 = tape_src.gradient(loss_domain, 
+        [features1["image"], features2["image"], features3["image"]])
+    del tape_src
+
+    # create the new features as defined in the paper
+    X_d1, X_d2, X_d3 = {}, {}, {}
+    X_l1, X_l2, X_l3 = {}, {}, {}
+
+
+    X_l1["image"] = features1["image"] + config.epsL*grads11
+    X_l1["label"] = features1["label"]
+    X_l1["domain"] = features1["domain"]
+    X_l2["image"] = features2["image"] + config.epsL*grads12
+    X_l2["label"] = features2["label"]
+    X_l2["domain"] = features2["domain"]
+    X_l3["image"] = features3["image"] + config.epsL*grads13
+    X_l3["label"] = features3["label"]
+    X_l3["domain"] = features3["domain"]
+    X_d1["image"] = features1["image"] + config.epsD*grads21
+    X_d1["label"] = features1["label"]
+    X_d1["domain"] = features1["domain"]
+    X_d2["image"] = features2["image"] + config.epsD*grads22
+    X_d2["label"] = features2["label"]
+    X_d2["domain"] = features2["domain"]
+    X_d3["image"] = features3["image"] + config.epsD*grads23
+    X_d3["label"] = features3["label"]
+    X_d3["domain"] = features3["domain"]
+
+    # the second tape is not persistent, loss3 only depends on model_domain and loss4 only on 
+    # model_label, so the gradient of their sum gives the gradients of both in one backward pass
+    with tf.GradientTape() as tape_src:
         
         # get loss of domains
         loss_domain = loss_fn_domain(features1, features2, features3, 
@@ -215,13 +303,15 @@ def _train_step(model_label, model_domain, features1, features2, features3,
         loss3 = 0.9*loss_domain+0.1*loss_d
         loss4 = 0.9*total_loss+0.1*loss_l
 
-        # calculate gradients for both neural nets
-        grads3 = tape_src.gradient(loss3, model_domain.trainable_variables)
-        grads4 = tape_src.gradient(loss4, model_label.trainable_variables)
+    # calculate gradients for both neural nets
+    num_domain_variables = len(model_domain.trainable_variables)
+    grads = tape_src.gradient(loss3 + loss4, 
+        model_domain.trainable_variables + model_label.trainable_variables)
+    grads3, grads4 = grads[:num_domain_variables], grads[num_domain_variables:]
 
-        # apply gradient to both neural nets
-        optimizer1.apply_gradients(zip(grads3, model_domain.trainable_variables))
-        optimizer2.apply_gradients(zip(grads4, model_label.trainable_variables))
+    # apply gradient to both neural nets
+    optimizer1.apply_gradients(zip(grads3, model_domain.trainable_variables))
+    optimizer2.apply_gradients(zip(grads4, model_label.trainable_variables))
 
 
 
@@ -230,9 +320,16 @@ def train_one_epoch(model_domain, model_label, train_input1, train_input2, train
     train_input1.shuffle(buffer_size=10000)
     train_input2.shuffle(buffer_size=10000)
     train_input3.shuffle(buffer_size=10000)
-    for _input1, _input2, _input3 in zip(train_input1, train_input2, train_input3):
-        _train_step(model_label, model_domain, _input1, _input2, _input3, optimizer1, 
+    # measure how long the loop waits for the input pipeline
+    input_timer = util.InputTimer()
+    if config.fused_input_grads:
+        train_step = util.get_train_step(_train_step_fused, config)
+    else:
+        train_step = util.get_train_step(_train_step, config)
+    for _input1, _input2, _input3 in input_timer(zip(train_input1, train_input2, train_input3)):
+        train_step(model_label, model_domain, _input1, _input2, _input3, optimizer1, 
         optimizer2, global_step, config)
+    return input_timer
 
 
 # compute the mean of all examples for a specific set (eval, validation, out-of-distribution, etc)
@@ -297,7 +394,11 @@ def picture(dataset, model_label, config):
 
 def _preprocess_exampe(model_label, example, dataset_name, config):
     example["image"] = tf.cast(example["image"], dtype=tf.float64)/255.
-    example["image"] = tf.image.resize(example["image"], size=(model_label.input_shape[0], model_label.input_shape[1]))
+    if example["image"].shape[:2].as_list() != list(model_label.input_shape):
+        example["image"] = tf.image.resize(example["image"], size=(model_label.input_shape[0], model_label.input_shape[1]))
+    else:
+        # raw shards are already stored at the model resolution
+        example["image"] = tf.cast(example["image"], dtype=tf.float32)
     example["label"] = example["attributes"]["label"]
     example["domain"] = example["attributes"]["domain"]
     # encode source domains as 0,1,2
@@ -312,22 +413,48 @@ def _preprocess_exampe(model_label, example, dataset_name, config):
     return example
 
 
+_BUILDERS = {}
+
+def _get_builder(dataset_name, validation_split):
+    # prepare the tfds builder once and read all splits from it
+    key = (dataset_name, tuple(validation_split))
+    if key not in _BUILDERS:
+        builder = tfds.builder(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
+            validation_split=validation_split)
+        builder.download_and_prepare()
+        _BUILDERS[key] = builder
+    return _BUILDERS[key]
+
+
 def _get_dataset(dataset_name, model_label, validation_split, split, batch_size, config, 
-    num_batches=None):
+    num_batches=None, cache=False):
 
-    builder_kwargs = {
-        "validation_split": validation_split,
-    }
+    if config.raw_shards:
+        dataset = pacs.load_raw_split(split, model_label.input_shape, local_settings.TF_DATASET_PATH)
+    else:
+        dataset = _get_builder(dataset_name, validation_split).as_dataset(split=split)
 
-    dataset, _ = tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
-        split=split, builder_kwargs=builder_kwargs, with_info=True)
-    dataset = dataset.map(lambda x: _preprocess_exampe(model_label, x, dataset_name, config))
+    if config.parallel_pipeline:
+        num_parallel_calls = tf.data.experimental.AUTOTUNE
+    else:
+        num_parallel_calls = None
+    options = tf.data.Options()
+    options.experimental_deterministic = bool(config.deterministic_pipeline)
+    dataset = dataset.with_options(options)
+
+    dataset = dataset.map(lambda x: _preprocess_exampe(model_label, x, dataset_name, config), 
+        num_parallel_calls=num_parallel_calls)
+    # keep the preprocessed examples in memory, only used for the eval splits. take()
+    # stops the first pass early and an unfinished cache is never written
+    if cache and num_batches is None:
+        dataset = dataset.cache()
     #dataset = dataset.shuffle(512)
     dataset = dataset.batch(batch_size)
     if num_batches is not None:
         dataset = dataset.take(num_batches)
 
-    # dataset = dataset.prefetch(2)
+    if config.parallel_pipeline:
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
     return dataset
 
@@ -438,7 +565,7 @@ def main():
 
     ds_train_complete = _get_dataset(config.dataset, model_label, config.test_domain,
         split=tfds.Split.TRAIN, batch_size=tf.cast(config.batch_size/3, tf.int64), config = config,
-        num_batches=num_batches)
+        num_batches=num_batches, cache=config.cache_eval)
 
     ds_train1 = _get_dataset(config.dataset, model_label, config.test_domain,
         split="train1", batch_size=tf.cast(config.batch_size/3, tf.int64), config = config,
@@ -454,19 +581,19 @@ def main():
 
     ds_val_in = _get_dataset(config.dataset, model_label, config.test_domain, config = config,
         split="val_in", batch_size=tf.cast(config.batch_size/3, tf.int64),
-        num_batches=num_batches)
+        num_batches=num_batches, cache=config.cache_eval)
 
     ds_val_out = _get_dataset(config.dataset, model_label, config.test_domain, config = config,
         split="val_out", batch_size=tf.cast(config.batch_size/3, tf.int64),
-        num_batches=num_batches)
+        num_batches=num_batches, cache=config.cache_eval)
 
     ds_test_in = _get_dataset(config.dataset, model_label, config.test_domain, config = config,
         split="test_in", batch_size=tf.cast(config.batch_size/3, tf.int64), 
-        num_batches=num_batches)
+        num_batches=num_batches, cache=config.cache_eval)
 
     ds_test_out = _get_dataset(config.dataset, model_label, config.test_domain, config = config, 
         split="test_out", batch_size=tf.cast(config.batch_size/3, tf.int64),
-        num_batches=num_batches)
+        num_batches=num_batches, cache=config.cache_eval)
 
     # TODO: add test set - done
     
@@ -484,14 +611,17 @@ def main():
         manager = tf.train.CheckpointManager(ckpt, model_dir, max_to_keep=3) 
 
     writer = tf.summary.create_file_writer(manager._directory)
-    with writer.as_default(), tf.summary.record_if(lambda: int(global_step.numpy()) % 100 == 0):
+    with writer.as_default(), tf.summary.record_if(lambda: tf.equal(global_step % 100, 0)):
         for epoch in range(epoch_start, config.num_epochs):
             
             start_time = time.time()
 
-            train_one_epoch(model_domain = model_domain, model_label=model_label, train_input1=ds_train1, 
+            util.reset_peak_memory()
+            input_timer = train_one_epoch(model_domain = model_domain, model_label=model_label, train_input1=ds_train1, 
                 train_input2=ds_train2, train_input3=ds_train3, optimizer1=optimizer1, optimizer2=optimizer2, 
                 global_step=global_step, config=config)
+            train_time = time.time() - start_time
+            peak_memory = util.get_peak_memory()
 
             train_metr = eval_one_epoch(model_label=model_label, dataset=ds_train_complete,
                 summary_directory=os.path.join(manager._directory, "train"), 
@@ -521,6 +651,10 @@ def main():
             logging.info("\n #### \n epoch: %d, time: %0.2f" % 
                 (epoch, time.time() - start_time))
             logging.info("Global step: {}".format(global_step.numpy()))
+            logging.info("step_time: {:4f}, input_wait_time: {:2f}".format(
+                train_time/max(input_timer.num_steps, 1), input_timer.wait_time))
+            if peak_memory is not None:
+                logging.info("peak_memory_per_step: {:1f} MB".format(peak_memory))
             logging.info("train_accuracy: {:2f}, train_loss: {:4f}".format(
                 train_metr['accuracy'], train_metr['loss']))
             logging.info("val_out_accuracy: {:2f}, val_out_loss: {:4f}".format(
@@ -59,6 +59,8 @@ parser.add_argument('--overwrite_configs', type=int,
 parser.add_argument('--dropout_rate', type=float, help='Dropout rate.')
 parser.add_argument('--use_dropout', type=int, help='Flag whether to use dropout.')
 parser.add_argument('--alpha', type=float, help='weighting factor of classification loss.')
+parser.add_argument('--env_cache', type=int, help='Flag whether to load the colored environments from the on-disk cache.')
+parser.add_argument('--fused_input_grads', type=int, help='Flag whether to compute the input gradients on the concatenated domains.')
 parser.add_argument('--epsL', type=float, help='Multiple for labels.')
 parser.add_argument('--epsD', type=float, help='Multiple for domains.')
 parser.add_argument('--seed', type=int, help='Seed.')
@@ -126,6 +128,83 @@ def loss_fn_label(features1, features2, model_label, config, training):
     accuracy = tf.reduce_mean([accuracy1, accuracy2])
     return label_loss, accuracy, l2_regularizer
 
+# mean over the source domains of the per domain means, the domains are concatenated in inputs
+def _mean_per_domain(values, sizes):
+    return tf.reduce_mean([tf.reduce_mean(v) for v in tf.split(values, sizes)])
+
+# loss function for domain classifier on the concatenated source domains
+def loss_fn_domain_fused(inputs, domain, sizes, model_domain, config, training):
+    domain_loss = tf.nn.softmax_cross_entropy_with_logits(labels = tf.one_hot(domain, axis=-1, 
+                                depth=config.num_classes_domain), 
+                                logits = model_domain(inputs, training=training))
+    return _mean_per_domain(domain_loss, sizes)
+
+# loss function for label classifer on the concatenated source domains
+def loss_fn_label_fused(inputs, label, sizes, model_label, config, training):
+    # L2 regularizers
+    l2_regularizer = tf.add_n([tf.nn.l2_loss(v) for v in 
+        model_label.trainable_variables if 'bias' not in v.name])
+
+    # get predictions on both domains at once
+    model_label_output = model_label(inputs, training=training)
+
+    label_loss = tf.nn.softmax_cross_entropy_with_logits(labels = tf.one_hot(label, axis=-1, 
+                                depth=config.num_classes_label), 
+                                logits = model_label_output)
+    correct = tf.where(tf.equal(label, tf.argmax(model_label_output, axis=-1)),
+                    tf.ones_like(label, dtype=tf.float32),
+                    tf.zeros_like(label, dtype=tf.float32))
+
+    return _mean_per_domain(label_loss, sizes), _mean_per_domain(correct, sizes), l2_regularizer
+
+# train step with one forward pass per network on the concatenated domains, one input gradient 
+# per loss and the clean losses of the first pass reused for the parameter updates
+def _train_step_fused(model_label, model_domain, features1, features2,
+                optimizer, global_step, config):
+    features = [features1, features2]
+    sizes = tf.stack([tf.shape(f["image"])[0] for f in features])
+    inputs = tf.concat([f["image"] for f in features], 0)
+    label = tf.concat([tf.reshape(f["label"], [-1]) for f in features], 0)
+    domain = tf.concat([tf.reshape(f["domain"], [-1]) for f in features], 0)
+
+    with tf.GradientTape(persistent=True) as tape_src:
+
+        tape_src.watch(inputs)
+
+        # get loss of labels
+        mean_classification_loss, accuracy, l2_regularizer = loss_fn_label_fused(
+            inputs, label, sizes, model_label, config=config, training=True)
+
+        tf.summary.scalar("binary_crossentropy", mean_classification_loss, 
+            step=global_step)
+        tf.summary.scalar("accuracy", accuracy, step=global_step)
+
+        total_loss = mean_classification_loss + \
+            config.l2_penalty_weight*l2_regularizer
+        # get loss of domains
+        loss_domain = loss_fn_domain_fused(inputs, domain, sizes, model_domain, config, training=True)
+
+        # get gradients wrt to inputs, one call per loss for both domains
+        with tape_src.stop_recording():
+            grads_l = tape_src.gradient(total_loss, inputs)
+            grads_d = tape_src.gradient(loss_domain, inputs)
+
+        # create the new features as defined in the paper
+        X_l = tf.stop_gradient(inputs + config.epsL*grads_l)
+        X_d = tf.stop_gradient(inputs + config.epsD*grads_d)
+
+        # calculate the losses with peturbated x
+        loss_l, _, _ = loss_fn_label_fused(X_d, label, sizes, model_label, config=config, training=True)
+        loss_d = loss_fn_domain_fused(X_l, domain, sizes, model_domain, config=config, training=True)
+
+    # calculate gradients for both neural nets
+    grads3 = tape_src.gradient((1-config.alpha)*loss_domain+config.alpha*loss_d, model_domain.trainable_variables)
+    grads4 = tape_src.gradient((1-config.alpha)*total_loss+config.alpha*loss_l, model_label.trainable_variables)
+
+    # apply gradient to both neural nets
+    optimizer.apply_gradients(zip(grads3, model_domain.trainable_variables))
+    optimizer.apply_gradients(zip(grads4, model_label.trainable_variables))
+
 def _train_step(model_label, model_domain, features1, features2,
                 optimizer, global_step, config):
     with tf.GradientTape(persistent=True) as tape_src:
@@ -194,8 +273,12 @@ def train_one_epoch(model_domain, model_label,  train_input1, train_input2,
                     optimizer,  global_step, config):
     train_input1.shuffle(buffer_size=10000)
     train_input2.shuffle(buffer_size=10000)
+    if config.fused_input_grads:
+        train_step = _train_step_fused
+    else:
+        train_step = _train_step
     for _input1, _input2 in zip(train_input1, train_input2):
-        _train_step(model_label, model_domain, _input1, _input2, optimizer, global_step, config)
+        train_step(model_label, model_domain, _input1, _input2, optimizer, global_step, config)
 
 
 # compute the mean of all examples for a specific set (eval, validation, out-of-distribution, etc)
@@ -255,12 +338,28 @@ def _preprocess_exampe(model_label, example, dataset_name, domain,e):
 
     return example   
 
-def _get_dataset(dataset_name, model_label, split, batch_size, e, domain,
-    num_batches=None):
+def _load_raw(dataset_name, split):
+    data = tfds.as_numpy(tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
+        split=split, batch_size=-1))
+    return data["image"], data["label"]
+
 
-    dataset, info = tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
-        split=split, with_info=True)
-    dataset = dataset.map(lambda x: _preprocess_exampe(model_label, x, dataset_name, domain,e))
+def _get_dataset(dataset_name, model_label, split, batch_size, e, domain,
+    num_batches=None, env_cache=False, seed=0):
+
+    if env_cache:
+        # load the colored environment from the on-disk cache instead of preprocessing per example
+        images, labels, _ = util.load_colored_mnist("{}_domain{}".format(dataset_name, 
+            int(domain)), e, seed, lambda: _load_raw(dataset_name, split), 
+            os.path.join(local_settings.RAW_DATA_PATH, "colored_mnist"))
+        images = np.transpose(images, (0, 2, 3, 1)).astype(np.float64)/255.
+        labels = labels.astype(np.int64)[:, None, None]
+        dataset = tf.data.Dataset.from_tensor_slices({"image": images, "label": labels})
+        dataset = dataset.map(lambda x: dict(x, domain=domain))
+    else:
+        dataset, info = tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
+            split=split, with_info=True)
+        dataset = dataset.map(lambda x: _preprocess_exampe(model_label, x, dataset_name, domain,e))
     dataset = dataset.shuffle(512)
     dataset = dataset.batch(batch_size)
     if num_batches is not None:
@@ -378,16 +477,19 @@ def main():
     ds_train1 = _get_dataset(config.dataset, model_label,
         split=tfds.Split.TRAIN.subsplit(tfds.percent[:50]), 
         batch_size=tf.cast(config.batch_size/2, tf.int64), 
-        num_batches=num_batches, domain = tf.constant(0), e = 0.2)
+        num_batches=num_batches, domain = tf.constant(0), e = 0.2,
+        env_cache=config.env_cache, seed=config.seed)
 
     ds_train2 = _get_dataset(config.dataset, model_label, 
         split=tfds.Split.TRAIN.subsplit(tfds.percent[-50:]),
         batch_size=tf.cast(config.batch_size/2, tf.int64),
-        num_batches=num_batches, domain = tf.constant(1), e = 0.1)
+        num_batches=num_batches, domain = tf.constant(1), e = 0.1,
+        env_cache=config.env_cache, seed=config.seed)
     
     ds_val = _get_dataset(config.dataset, model_label, 
         split=tfds.Split.TEST, batch_size=config.batch_size, 
-        num_batches=num_batches, domain = tf.constant(2), e = 0.9)
+        num_batches=num_batches, domain = tf.constant(2), e = 0.9,
+        env_cache=config.env_cache, seed=config.seed)
 
     # TODO: add test set - done
     
@@ -4,6 +4,7 @@ from collections import namedtuple
 from shutil import make_archive
 from datetime import datetime
 import os
+import zlib
 import tensorflow as tf
 import numpy as np
 
@@ -44,3 +45,38 @@ def tf_bernoulli(p, size):
 
 def tf_xor(a, b):
     return tf.abs((a-b)) # Assumes both inputs are either 0 or 1
+
+
+def make_colored_mnist(images, labels, e, seed):
+    # vectorized colored MNIST environment, same recipe as the per example preprocessing
+    rng = np.random.RandomState(seed)
+    # 2x subsample for computational convenience
+    images = np.asarray(images).reshape((-1, 28, 28))[:, ::2, ::2]
+    # Assign a binary label based on the digit; flip label with probability 0.25
+    labels = (np.asarray(labels) < 5).astype(np.float32)
+    labels = np.abs(labels - (rng.uniform(size=len(labels)) < 0.25))
+    # Assign a color based on the label; flip the color with probability e
+    colors = np.abs(labels - (rng.uniform(size=len(labels)) < e)).astype(np.float32)
+    # Apply the color to the image by zeroing out the other color channel
+    images = np.stack([images, images], axis=1)
+    images[np.arange(len(images)), (1-colors).astype(np.int64), :, :] = 0
+    return images.astype(np.uint8), labels.astype(np.float32), colors
+
+
+def load_colored_mnist(name, e, seed, load_raw, cache_dir):
+    # environments are keyed by name, e and seed, the raw data is only read on a cache miss
+    path = os.path.join(cache_dir, "colored_mnist_{}_e{}_seed{}.npz".format(name, e, seed))
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return data["images"], data["labels"], data["colors"]
+    images, labels = load_raw()
+    # mix the name into the seed so environments with the same seed get different noise
+    images, labels, colors = make_colored_mnist(images, labels, e, 
+        [seed, zlib.crc32(name.encode())])
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so concurrent jobs never read a partial cache
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.savez(f, images=images, labels=labels, colors=colors)
+    os.replace(tmp_path, path)
+    return images, labels, colors
@@ -1,4 +1,6 @@
 import argparse
+import os
+import zlib
 import numpy as np
 import torch
 from torchvision import datasets
@@ -13,17 +15,84 @@ parser.add_argument('--penalty_anneal_iters', type=int, default=100)
 parser.add_argument('--penalty_weight', type=float, default=10000.0)
 parser.add_argument('--steps', type=int, default=501)
 parser.add_argument('--grayscale_model', action='store_true')
+parser.add_argument('--batched_penalty', action='store_true')
+parser.add_argument('--unbiased_penalty', action='store_true')
+parser.add_argument('--parallel_restarts', action='store_true')
+parser.add_argument('--env_cache', action='store_true')
+parser.add_argument('--cache_dir', type=str, default='/cluster/work/math/ebeck/torch_datasets/colored_mnist')
+parser.add_argument('--seed', type=int, default=0)
 flags = parser.parse_args()
+if flags.unbiased_penalty and not flags.batched_penalty:
+  parser.error('--unbiased_penalty requires --batched_penalty')
 
 print('Flags:')
 for k,v in sorted(vars(flags).items()):
   print("\t{}: {}".format(k, v))
 
-final_train_accs = []
-final_test_accs = []
-for restart in range(flags.n_restarts):
-  print("Restart", restart)
+def make_colored_mnist(images, labels, e, seed):
+  # vectorized numpy version of make_environment, seeded so that it is reproducible
+  rng = np.random.RandomState(seed)
+  # 2x subsample for computational convenience
+  images = np.asarray(images).reshape((-1, 28, 28))[:, ::2, ::2]
+  # Assign a binary label based on the digit; flip label with probability 0.25
+  labels = (np.asarray(labels) < 5).astype(np.float32)
+  labels = np.abs(labels - (rng.uniform(size=len(labels)) < 0.25))
+  # Assign a color based on the label; flip the color with probability e
+  colors = np.abs(labels - (rng.uniform(size=len(labels)) < e)).astype(np.float32)
+  # Apply the color to the image by zeroing out the other color channel
+  images = np.stack([images, images], axis=1)
+  images[np.arange(len(images)), (1-colors).astype(np.int64), :, :] = 0
+  return images.astype(np.uint8), labels.astype(np.float32), colors
 
+def load_colored_mnist(name, e, seed, load_raw, cache_dir):
+  # environments are keyed by name, e and seed, the raw data is only read on a cache miss
+  path = os.path.join(cache_dir, "colored_mnist_{}_e{}_seed{}.npz".format(name, e, seed))
+  if os.path.exists(path):
+    with np.load(path) as data:
+      return data["images"], data["labels"], data["colors"]
+  images, labels = load_raw()
+  # mix the name into the seed so environments with the same seed get different noise
+  images, labels, colors = make_colored_mnist(images, labels, e, 
+    [seed, zlib.crc32(name.encode())])
+  os.makedirs(cache_dir, exist_ok=True)
+  # write to a temporary file first so concurrent jobs never read a partial cache
+  tmp_path = "{}.{}.tmp".format(path, os.getpid())
+  with open(tmp_path, "wb") as f:
+    np.savez(f, images=images, labels=labels, colors=colors)
+  os.replace(tmp_path, path)
+  return images, labels, colors
+
+def load_cached_environments(seed):
+  # Same environments as load_environments, but generated once per seed and read from disk
+  raw = {}
+  def load_raw(train, part):
+    if train not in raw:
+      mnist = datasets.MNIST('/cluster/work/math/ebeck/torch_datasets/mnist', train=train, download=True)
+      images, labels = mnist.data.numpy(), mnist.targets.numpy()
+      if train:
+        # seeded shuffle of the train set examples
+        perm = np.random.RandomState(seed).permutation(len(labels))
+        images, labels = images[perm], labels[perm]
+      raw[train] = (images, labels)
+    images, labels = raw[train]
+    return images[part], labels[part]
+
+  envs = []
+  for name, train, part, e in [('train1', True, slice(0, None, 2), 0.2),
+                               ('train2', True, slice(1, None, 2), 0.1),
+                               ('test', False, slice(None), 0.9)]:
+    images, labels, _ = load_colored_mnist(name, e, seed, 
+      lambda: load_raw(train, part), flags.cache_dir)
+    envs.append({
+      'images': (torch.from_numpy(images).float() / 255.).cuda(),
+      'labels': torch.from_numpy(labels)[:, None].cuda()
+    })
+  return envs
+
+def load_environments(restart=0):
+  if flags.env_cache:
+    # every restart gets its own environments, like the uncached path that redraws them
+    return load_cached_environments(flags.seed + restart)
   # Load MNIST, make train/val splits, and shuffle train set examples
 
   mnist = datasets.MNIST('/cluster/work/math/ebeck/torch_datasets/mnist', train=True, download=True)
@@ -63,76 +132,130 @@ for restart in range(flags.n_restarts):
     make_environment(mnist_train[0][1::2], mnist_train[1][1::2], 0.1),
     make_environment(mnist_val[0], mnist_val[1], 0.9)
   ]
+  return envs
 
-  # Define and instantiate the model
+def pretty_print(*values):
+  col_width = 13
+  def format_val(v):
+    if not isinstance(v, str):
+      v = np.array2string(v, precision=5, floatmode='fixed')
+    return v.ljust(col_width)
+  str_values = [format_val(v) for v in values]
+  print("   ".join(str_values))
 
-  class MLP(nn.Module):
-    def __init__(self):
-      super(MLP, self).__init__()
-      if flags.grayscale_model:
-        lin1 = nn.Linear(14 * 14, flags.hidden_dim)
-      else:
-        lin1 = nn.Linear(2 * 14 * 14, flags.hidden_dim)
-      lin2 = nn.Linear(flags.hidden_dim, flags.hidden_dim)
-      lin3 = nn.Linear(flags.hidden_dim, 1)
-      for lin in [lin1, lin2, lin3]:
-        nn.init.xavier_uniform_(lin.weight)
-        nn.init.zeros_(lin.bias)
-      self._main = nn.Sequential(lin1, nn.ReLU(True), lin2, nn.ReLU(True), lin3)
-    def forward(self, input):
-      if flags.grayscale_model:
-        out = input.view(input.shape[0], 2, 14 * 14).sum(dim=1)
-      else:
-        out = input.view(input.shape[0], 2 * 14 * 14)
-      out = self._main(out)
-      return out
+class EnsembleMLP(nn.Module):
+  # n_models MLPs with stacked weights, all models are evaluated with batched matrix products
+  def __init__(self, n_models):
+    super(EnsembleMLP, self).__init__()
+    self.n_models = n_models
+    if flags.grayscale_model:
+      dims = [14 * 14, flags.hidden_dim, flags.hidden_dim, 1]
+    else:
+      dims = [2 * 14 * 14, flags.hidden_dim, flags.hidden_dim, 1]
+    self.weights = nn.ParameterList()
+    self.biases = nn.ParameterList()
+    for dim_in, dim_out in zip(dims[:-1], dims[1:]):
+      weight = torch.empty(n_models, dim_out, dim_in)
+      for w in weight:
+        nn.init.xavier_uniform_(w)
+      self.weights.append(nn.Parameter(weight.transpose(1, 2).contiguous()))
+      self.biases.append(nn.Parameter(torch.zeros(n_models, 1, dim_out)))
+  def forward(self, input):
+    if flags.grayscale_model:
+      out = input.view(input.shape[0], 2, 14 * 14).sum(dim=1)
+    else:
+      out = input.view(input.shape[0], 2 * 14 * 14)
+    # the environment tensors are shared, every model sees the same inputs
+    out = out.unsqueeze(0).expand(self.n_models, -1, -1)
+    for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+      out = torch.baddbmm(b, out, w)
+      if i < len(self.weights) - 1:
+        out = torch.relu(out)
+    return out
 
-  mlp = MLP().cuda()
+def train_parallel_restarts():
+  # all restarts are trained at once on one copy of the environments, 
+  # the restarts only differ in the initialization of their MLP
+  envs = load_environments()
+  n_models = flags.n_restarts
+  mlp = EnsembleMLP(n_models).cuda()
 
-  # Define loss function helpers
+  # Define loss function helpers, all return one value per model
 
   def mean_nll(logits, y):
-    return nn.functional.binary_cross_entropy_with_logits(logits, y)
+    losses = nn.functional.binary_cross_entropy_with_logits(logits, 
+      y.unsqueeze(0).expand_as(logits), reduction='none')
+    return losses.reshape(n_models, -1).mean(dim=1)
 
   def mean_accuracy(logits, y):
     preds = (logits > 0.).float()
-    return ((preds - y).abs() < 1e-2).float().mean()
+    return ((preds - y.unsqueeze(0)).abs() < 1e-2).float().reshape(n_models, -1).mean(dim=1)
 
   def penalty(logits, y):
-    scale = torch.tensor(1.).cuda().requires_grad_()
-    loss = mean_nll(logits * scale, y)
+    # the nll of a model only depends on its own scale
+    scale = torch.ones(n_models, 1, 1).cuda().requires_grad_()
+    loss = mean_nll(logits * scale, y).sum()
     grad = autograd.grad(loss, [scale], create_graph=True)[0]
-    return torch.sum(grad**2)
+    return grad.view(n_models)**2
 
-  # Train loop
+  # all environments concatenated, one forward pass and one penalty gradient for all of them
+  env_sizes = [len(env['labels']) for env in envs]
+  all_images = torch.cat([env['images'] for env in envs])
+  all_labels = torch.cat([env['labels'] for env in envs])
+  env_ids = torch.cat([torch.full((size,), i, dtype=torch.long) 
+    for i, size in enumerate(env_sizes)]).cuda()
+  if flags.unbiased_penalty:
+    # split every environment into two halves, the penalty is the product of their gradients
+    halves = torch.cat([torch.arange(size) % 2 for size in env_sizes]).cuda()
+    segments = env_ids * 2 + halves
+    n_segments = 2 * len(envs)
+  else:
+    segments = env_ids
+    n_segments = len(envs)
+  segment_sizes = torch.bincount(segments, minlength=n_segments).float()
+
+  def penalty_batched(logits, y):
+    # one scale per model and environment (and half), returns one penalty per model and environment
+    scale = torch.ones(n_models, n_segments).cuda().requires_grad_()
+    losses = nn.functional.binary_cross_entropy_with_logits(
+      logits * scale[:, segments][:, :, None], y.unsqueeze(0).expand_as(logits), 
+      reduction='none')[:, :, 0]
+    segment_losses = torch.zeros(n_models, n_segments).cuda().index_add_(1, segments, losses) / segment_sizes
+    grad = autograd.grad(segment_losses.sum(), [scale], create_graph=True)[0]
+    if flags.unbiased_penalty:
+      grad = grad.view(n_models, len(envs), 2)
+      return grad[:, :, 0] * grad[:, :, 1]
+    return grad**2
 
-  def pretty_print(*values):
-    col_width = 13
-    def format_val(v):
-      if not isinstance(v, str):
-        v = np.array2string(v, precision=5, floatmode='fixed')
-      return v.ljust(col_width)
-    str_values = [format_val(v) for v in values]
-    print("   ".join(str_values))
+  # Train loop
 
+  # Adam updates every element on its own, so the models do not interact
   optimizer = optim.Adam(mlp.parameters(), lr=flags.lr)
 
   pretty_print('step', 'train nll', 'train acc', 'train penalty', 'test acc')
 
   for step in range(flags.steps):
-    for env in envs:
-      logits = mlp(env['images'])
-      env['nll'] = mean_nll(logits, env['labels'])
-      env['acc'] = mean_accuracy(logits, env['labels'])
-      env['penalty'] = penalty(logits, env['labels'])
+    if flags.batched_penalty:
+      all_logits = mlp(all_images)
+      penalties = penalty_batched(all_logits, all_labels)
+      for i, (env, logits) in enumerate(zip(envs, torch.split(all_logits, env_sizes, dim=1))):
+        env['nll'] = mean_nll(logits, env['labels'])
+        env['acc'] = mean_accuracy(logits, env['labels'])
+        env['penalty'] = penalties[:, i]
+    else:
+      for env in envs:
+        logits = mlp(env['images'])
+        env['nll'] = mean_nll(logits, env['labels'])
+        env['acc'] = mean_accuracy(logits, env['labels'])
+        env['penalty'] = penalty(logits, env['labels'])
 
-    train_nll = torch.stack([envs[0]['nll'], envs[1]['nll']]).mean()
-    train_acc = torch.stack([envs[0]['acc'], envs[1]['acc']]).mean()
-    train_penalty = torch.stack([envs[0]['penalty'], envs[1]['penalty']]).mean()
+    train_nll = torch.stack([envs[0]['nll'], envs[1]['nll']]).mean(dim=0)
+    train_acc = torch.stack([envs[0]['acc'], envs[1]['acc']]).mean(dim=0)
+    train_penalty = torch.stack([envs[0]['penalty'], envs[1]['penalty']]).mean(dim=0)
 
-    weight_norm = torch.tensor(0.).cuda()
+    weight_norm = torch.zeros(n_models).cuda()
     for w in mlp.parameters():
-      weight_norm += w.norm().pow(2)
+      weight_norm += w.pow(2).view(n_models, -1).sum(dim=1)
 
     loss = train_nll.clone()
     loss += flags.l2_regularizer_weight * weight_norm
@@ -144,22 +267,163 @@ for restart in range(flags.n_restarts):
       loss /= penalty_weight
 
     optimizer.zero_grad()
-    loss.backward()
+    # the loss of a model only depends on its own weights
+    loss.sum().backward()
     optimizer.step()
-    
+
     test_acc = envs[2]['acc']
     if step % 100 == 0:
+      # mean over the models
       pretty_print(
         np.int32(step),
-        train_nll.detach().cpu().numpy(),
-        train_acc.detach().cpu().numpy(),
-        train_penalty.detach().cpu().numpy(),
-        test_acc.detach().cpu().numpy()
+        train_nll.mean().detach().cpu().numpy(),
+        train_acc.mean().detach().cpu().numpy(),
+        train_penalty.mean().detach().cpu().numpy(),
+        test_acc.mean().detach().cpu().numpy()
       )
 
-  final_train_accs.append(train_acc.detach().cpu().numpy())
-  final_test_accs.append(test_acc.detach().cpu().numpy())
-  print('Final train acc (mean/std across restarts so far):')
+  final_train_accs = train_acc.detach().cpu().numpy()
+  final_test_accs = test_acc.detach().cpu().numpy()
+  print('Final train acc (mean/std across restarts):')
   print(np.mean(final_train_accs), np.std(final_train_accs))
-  print('Final test acc (mean/std across restarts so far):')
-  print(np.mean(final_test_accs), np.std(final_test_accs))
\ No newline at end of file
+  print('Final test acc (mean/std across restarts):')
+  print(np.mean(final_test_accs), np.std(final_test_accs))
+
+if flags.parallel_restarts:
+  train_parallel_restarts()
+else:
+  final_train_accs = []
+  final_test_accs = []
+  for restart in range(flags.n_restarts):
+    print("Restart", restart)
+
+    envs = load_environments(restart)
+
+
+    # Define and instantiate the model
+
+    class MLP(nn.Module):
+      def __init__(self):
+        super(MLP, self).__init__()
+        if flags.grayscale_model:
+          lin1 = nn.Linear(14 * 14, flags.hidden_dim)
+        else:
+          lin1 = nn.Linear(2 * 14 * 14, flags.hidden_dim)
+        lin2 = nn.Linear(flags.hidden_dim, flags.hidden_dim)
+        lin3 = nn.Linear(flags.hidden_dim, 1)
+        for lin in [lin1, lin2, lin3]:
+          nn.init.xavier_uniform_(lin.weight)
+          nn.init.zeros_(lin.bias)
+        self._main = nn.Sequential(lin1, nn.ReLU(True), lin2, nn.ReLU(True), lin3)
+      def forward(self, input):
+        if flags.grayscale_model:
+          out = input.view(input.shape[0], 2, 14 * 14).sum(dim=1)
+        else:
+          out = input.view(input.shape[0], 2 * 14 * 14)
+        out = self._main(out)
+        return out
+
+    mlp = MLP().cuda()
+
+    # Define loss function helpers
+
+    def mean_nll(logits, y):
+      return nn.functional.binary_cross_entropy_with_logits(logits, y)
+
+    def mean_accuracy(logits, y):
+      preds = (logits > 0.).float()
+      return ((preds - y).abs() < 1e-2).float().mean()
+
+    def penalty(logits, y):
+      scale = torch.tensor(1.).cuda().requires_grad_()
+      loss = mean_nll(logits * scale, y)
+      grad = autograd.grad(loss, [scale], create_graph=True)[0]
+      return torch.sum(grad**2)
+
+    # all environments concatenated, one forward pass and one penalty gradient for all of them
+    env_sizes = [len(env['labels']) for env in envs]
+    all_images = torch.cat([env['images'] for env in envs])
+    all_labels = torch.cat([env['labels'] for env in envs])
+    env_ids = torch.cat([torch.full((size,), i, dtype=torch.long) 
+      for i, size in enumerate(env_sizes)]).cuda()
+    if flags.unbiased_penalty:
+      # split every environment into two halves, the penalty is the product of their gradients
+      halves = torch.cat([torch.arange(size) % 2 for size in env_sizes]).cuda()
+      segments = env_ids * 2 + halves
+      n_segments = 2 * len(envs)
+    else:
+      segments = env_ids
+      n_segments = len(envs)
+    segment_sizes = torch.bincount(segments, minlength=n_segments).float()
+
+    def penalty_batched(logits, y):
+      # one scale per environment (and half), the nll of a segment only depends on its own 
+      # scale, so the gradient of the summed nlls holds the gradients of all segments
+      scale = torch.ones(n_segments).cuda().requires_grad_()
+      losses = nn.functional.binary_cross_entropy_with_logits(
+        logits * scale[segments][:, None], y, reduction='none')[:, 0]
+      segment_losses = torch.zeros(n_segments).cuda().index_add_(0, segments, losses) / segment_sizes
+      grad = autograd.grad(segment_losses.sum(), [scale], create_graph=True)[0]
+      if flags.unbiased_penalty:
+        grad = grad.view(len(envs), 2)
+        return grad[:, 0] * grad[:, 1]
+      return grad**2
+
+    # Train loop
+
+    optimizer = optim.Adam(mlp.parameters(), lr=flags.lr)
+
+    pretty_print('step', 'train nll', 'train acc', 'train penalty', 'test acc')
+
+    for step in range(flags.steps):
+      if flags.batched_penalty:
+        all_logits = mlp(all_images)
+        penalties = penalty_batched(all_logits, all_labels)
+        for i, (env, logits) in enumerate(zip(envs, torch.split(all_logits, env_sizes))):
+          env['nll'] = mean_nll(logits, env['labels'])
+          env['acc'] = mean_accuracy(logits, env['labels'])
+          env['penalty'] = penalties[i]
+      else:
+        for env in envs:
+          logits = mlp(env['images'])
+          env['nll'] = mean_nll(logits, env['labels'])
+          env['acc'] = mean_accuracy(logits, env['labels'])
+          env['penalty'] = penalty(logits, env['labels'])
+
+      train_nll = torch.stack([envs[0]['nll'], envs[1]['nll']]).mean()
+      train_acc = torch.stack([envs[0]['acc'], envs[1]['acc']]).mean()
+      train_penalty = torch.stack([envs[0]['penalty'], envs[1]['penalty']]).mean()
+
+      weight_norm = torch.tensor(0.).cuda()
+      for w in mlp.parameters():
+        weight_norm += w.norm().pow(2)
+
+      loss = train_nll.clone()
+      loss += flags.l2_regularizer_weight * weight_norm
+      penalty_weight = (flags.penalty_weight 
+          if step >= flags.penalty_anneal_iters else 1.0)
+      loss += penalty_weight * train_penalty
+      if penalty_weight > 1.0:
+        # Rescale the entire loss to keep gradients in a reasonable range
+        loss /= penalty_weight
+
+      optimizer.zero_grad()
+      loss.backward()
+      optimizer.step()
+    
+      test_acc = envs[2]['acc']
+      if step % 100 == 0:
+        pretty_print(
+          np.int32(step),
+          train_nll.detach().cpu().numpy(),
+          train_acc.detach().cpu().numpy(),
+          train_penalty.detach().cpu().numpy(),
+          test_acc.detach().cpu().numpy()
+        )
+
+    final_train_accs.append(train_acc.detach().cpu().numpy())
+    final_test_accs.append(test_acc.detach().cpu().numpy())
+    print('Final train acc (mean/std across restarts so far):')
+    print(np.mean(final_train_accs), np.std(final_train_accs))
+    print('Final test acc (mean/std across restarts so far):')
+    print(np.mean(final_test_accs), np.std(final_test_accs))
\ No newline at end of file
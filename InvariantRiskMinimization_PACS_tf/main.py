@@ -23,6 +23,8 @@ parser.add_argument('--epochs', type=int, default=10)
 parser.add_argument('--batch_size', type=int, default=8)
 parser.add_argument('--shuffle_buffer_size', type=int, default=2000)
 parser.add_argument('--grayscale_model', action='store_true')
+parser.add_argument('--batched_penalty', action='store_true')
+parser.add_argument('--unbiased_penalty', action='store_true')
 parser.add_argument('--seed', type=int, default=1)
 flags = parser.parse_args()
 
@@ -144,6 +146,40 @@ def penalty(logits, y):
 
     return tf.reduce_sum(grad**2)
 
+def penalty_batched(logits, y, segments, n_segments):
+    # one scale per environment (and half), the nll of a segment only depends on its own 
+    # scale, so the gradient of the summed nlls holds the gradients of all segments
+    with tf.GradientTape() as tape_src:
+        scale = tf.ones([n_segments])
+        tape_src.watch(scale)
+        losses = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(
+            labels=tf.one_hot(tf.cast(y, dtype=tf.int32), axis=-1, depth = 7), 
+            logits=logits * tf.expand_dims(tf.gather(scale, segments), -1)), axis=-1)
+        segment_losses = tf.math.unsorted_segment_mean(losses, segments, n_segments)
+        grad = tape_src.gradient(tf.reduce_sum(segment_losses), scale)
+
+    if flags.unbiased_penalty:
+        grad = tf.reshape(grad, [-1, 2])
+        return grad[:, 0] * grad[:, 1]
+    return grad**2
+
+def env_metrics_batched(batches):
+    # one forward pass for all environments, returns nll, accuracy and penalty per environment
+    sizes = [tf.shape(batch[0])[0] for batch in batches]
+    logits = model(tf.concat([batch[0] for batch in batches], 0)/255.)
+    labels = tf.concat([batch[1] for batch in batches], 0)
+    segments = tf.concat([tf.fill([size], i) for i, size in enumerate(sizes)], 0)
+    n_segments = len(batches)
+    if flags.unbiased_penalty:
+        # split every environment into two halves, the penalty is the product of their gradients
+        segments = segments * 2 + tf.concat([tf.range(size) % 2 for size in sizes], 0)
+        n_segments = 2 * len(batches)
+    penalties = penalty_batched(logits, labels, segments, n_segments)
+    env = []
+    for i, (env_logits, env_labels) in enumerate(zip(tf.split(logits, sizes), tf.split(labels, sizes))):
+        env.append([mean_nll(env_logits, env_labels), mean_accuracy(env_logits, env_labels), penalties[i]])
+    return env
+
 # define optimizer
 
 optimizer = tf.keras.optimizers.Adam(lr=flags.lr)
@@ -176,22 +212,25 @@ for step in range(flags.epochs):
 
     for env0, env1, env2, env3 in zip(envs[0], envs[1], envs[2], envs[3]):
         with tf.GradientTape() as tape_src:
-            env = [[], [], [], []]
-            env[0].append(mean_nll(model(env0[0]/255.), env0[1]))
-            env[0].append(mean_accuracy(model(env0[0]/255.), env0[1]))
-            env[0].append(penalty(model(env0[0]/255.), env0[1]))
-
-            env[1].append(mean_nll(model(env1[0]/255.), env1[1]))
-            env[1].append(mean_accuracy(model(env1[0]/255.), env1[1]))
-            env[1].append(penalty(model(env1[0]/255.), env1[1]))
-
-            env[2].append(mean_nll(model(env2[0]/255.), env2[1]))
-            env[2].append(mean_accuracy(model(env2[0]/255.), env2[1]))
-            env[2].append(penalty(model(env2[0]/255.), env2[1]))
-
-            env[3].append(mean_nll(model(env3[0]/255.), env3[1]))
-            env[3].append(mean_accuracy(model(env3[0]/255.), env3[1]))
-            env[3].append(penalty(model(env3[0]/255.), env3[1]))
+            if flags.batched_penalty:
+                env = env_metrics_batched([env0, env1, env2, env3])
+            else:
+                env = [[], [], [], []]
+                env[0].append(mean_nll(model(env0[0]/255.), env0[1]))
+                env[0].append(mean_accuracy(model(env0[0]/255.), env0[1]))
+                env[0].append(penalty(model(env0[0]/255.), env0[1]))
+
+                env[1].append(mean_nll(model(env1[0]/255.), env1[1]))
+                env[1].append(mean_accuracy(model(env1[0]/255.), env1[1]))
+                env[1].append(penalty(model(env1[0]/255.), env1[1]))
+
+                env[2].append(mean_nll(model(env2[0]/255.), env2[1]))
+                env[2].append(mean_accuracy(model(env2[0]/255.), env2[1]))
+                env[2].append(penalty(model(env2[0]/255.), env2[1]))
+
+                env[3].append(mean_nll(model(env3[0]/255.), env3[1]))
+                env[3].append(mean_accuracy(model(env3[0]/255.), env3[1]))
+                env[3].append(penalty(model(env3[0]/255.), env3[1]))
 
             train_nll = tf.reduce_mean([env[0][0], env[1][0], env[2][0]])
             train_accuracy = tf.reduce_mean([env[0][1], env[1][1], env[2][1]])
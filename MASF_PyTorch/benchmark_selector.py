@@ -0,0 +1,53 @@
+import torch
+import argparse
+import time
+import numpy as np
+from util import BatchHardTripletSelector, DeviceTripletSelector
+
+# compares the runtime of the numpy batch hard selector with the on-device selectors
+parser = argparse.ArgumentParser(description='Triplet selector benchmark')
+parser.add_argument('--batch_sizes', type=int, nargs='+', default=[96, 192, 384, 768, 1024])
+parser.add_argument('--embedding_features', type=int, default=256)
+parser.add_argument('--num_classes', type=int, default=7)
+parser.add_argument('--repeats', type=int, default=50)
+parser.add_argument('--eps', type=float, default=0.2)
+flags = parser.parse_args()
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def time_selector(selector, embeds, labels):
+    # warm up
+    selector(embeds, labels)
+    synchronize()
+    start_time = time.time()
+    for _ in range(flags.repeats):
+        anchor, pos, neg = selector(embeds, labels)
+    synchronize()
+    return (time.time() - start_time) / flags.repeats * 1000.
+
+selectors = [('numpy hard', BatchHardTripletSelector()), 
+             ('device hard', DeviceTripletSelector()),
+             ('device semi hard', DeviceTripletSelector(semi_hard=True, margin=flags.eps))]
+
+print('device: {}'.format(device))
+template = '{:>10} ' + ' '.join(['{:>18}'] * len(selectors))
+print(template.format('batch', *[name + ' [ms]' for name, _ in selectors]))
+for batch_size in flags.batch_sizes:
+    embeds = torch.randn(batch_size, flags.embedding_features, device=device)
+    # labels come from the loaders as float column vectors on the host
+    labels = torch.randint(0, flags.num_classes, (batch_size, 1)).float()
+
+    # the device selector has to pick the same triplets as the numpy selector
+    _, pos_numpy, neg_numpy = selectors[0][1](embeds, labels)
+    _, pos_device, neg_device = selectors[1][1](embeds, labels)
+    assert np.allclose(torch.norm(embeds - pos_numpy, dim=1).cpu().numpy(), 
+                       torch.norm(embeds - pos_device, dim=1).cpu().numpy(), atol=1e-4)
+    assert np.allclose(torch.norm(embeds - neg_numpy, dim=1).cpu().numpy(), 
+                       torch.norm(embeds - neg_device, dim=1).cpu().numpy(), atol=1e-4)
+
+    times = [time_selector(selector, embeds, labels) for _, selector in selectors]
+    print(template.format(batch_size, *['{:.3f}'.format(t) for t in times]))
@@ -5,8 +5,9 @@ import argparse
 import numpy as np
 from models import model_feature, model_task, model_embedding
 from torch.utils import data
-from data_loader import HDF5Dataset
+from data_loader import HDF5Dataset, HDF5ConcatDataset, get_loader
 from train import validate_epoch, train_one_epoch
+from util import BatchHardTripletSelector, DeviceTripletSelector
 
 #from train import validate_epoch, train_one_epoch_metatrain, train_one_epoch_full
 
@@ -18,6 +19,14 @@ parser.add_argument('--epochs', type=int, default=15)
 parser.add_argument('--num_classes', type=int, default=7)
 parser.add_argument('--eps', type=float, default=0.2)
 parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--num_workers', type=int, default=1)
+parser.add_argument('--lazy_loading', type=int, default=0)
+parser.add_argument('--batched_loading', type=int, default=0)
+parser.add_argument('--pin_memory', type=int, default=0)
+parser.add_argument('--vectorized_global', type=int, default=0)
+parser.add_argument('--fused_step', type=int, default=0)
+parser.add_argument('--count_passes', type=int, default=0)
+parser.add_argument('--triplet_miner', type=str, default='cpu', choices=['cpu', 'hard', 'semi_hard'])
 flags = parser.parse_args()
 
 #print setup
@@ -29,21 +38,21 @@ for k,v in sorted(vars(flags).items()):
 random.seed(flags.seed)
 
 # load data
-dataset1 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/art_painting_train.hdf5')
-train_data1 = data.DataLoader(dataset1, num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)
-dataset2 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/sketch_train.hdf5')
-train_data2 = data.DataLoader(dataset2, num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)
-dataset3 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/photo_train.hdf5')
-train_data3 = data.DataLoader(dataset3, num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)
-train_data_full = data.DataLoader(data.ConcatDataset([dataset1, dataset2, dataset3]), 
-                                                    num_workers=1, batch_size=flags.batch_size, 
-                                                    shuffle=True, drop_last=True)
-dataset = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/cartoon_test.hdf5')
-test_data = data.DataLoader(dataset, num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)
+dataset1 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/art_painting_train.hdf5', lazy=flags.lazy_loading)
+train_data1 = get_loader(dataset1, flags.batch_size, num_workers=flags.num_workers, 
+                         batched=flags.batched_loading, pin_memory=flags.pin_memory)
+dataset2 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/sketch_train.hdf5', lazy=flags.lazy_loading)
+train_data2 = get_loader(dataset2, flags.batch_size, num_workers=flags.num_workers, 
+                         batched=flags.batched_loading, pin_memory=flags.pin_memory)
+dataset3 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/photo_train.hdf5', lazy=flags.lazy_loading)
+train_data3 = get_loader(dataset3, flags.batch_size, num_workers=flags.num_workers, 
+                         batched=flags.batched_loading, pin_memory=flags.pin_memory)
+train_data_full = get_loader(HDF5ConcatDataset([dataset1, dataset2, dataset3]), flags.batch_size, 
+                             num_workers=flags.num_workers, batched=flags.batched_loading, 
+                             pin_memory=flags.pin_memory)
+dataset = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/cartoon_test.hdf5', lazy=flags.lazy_loading)
+test_data = get_loader(dataset, flags.batch_size, num_workers=flags.num_workers, 
+                       batched=flags.batched_loading, pin_memory=flags.pin_memory)
 
 # load models
 feature_network = model_feature(flags.hidden_dim).cuda()
@@ -60,6 +69,12 @@ def trainer(feature_network, task_network, embedding_network, train_data_full, t
     optimizer_feature = optim.SGD(feature_network.parameters(), lr=learning_rate, momentum=0.9)
     optimizer_task = optim.SGD(task_network.parameters(), lr=learning_rate, momentum=0.9)
     optimizer_embedding = optim.SGD(embedding_network.parameters(), lr=learning_rate, momentum=0.9)
+
+    # set triplet selector for the local loss
+    if flags.triplet_miner == 'cpu':
+        selector = BatchHardTripletSelector()
+    else:
+        selector = DeviceTripletSelector(semi_hard=flags.triplet_miner == 'semi_hard', margin=eps)
     
 
     # metatraining
@@ -73,7 +88,8 @@ def trainer(feature_network, task_network, embedding_network, train_data_full, t
         # train one epoch
         train_one_epoch(feature_network, task_network, embedding_network, train_input1, train_input2, 
                                     train_input3, train_data_full, optimizer_feature, optimizer_task, optimizer_embedding, eps, 
-                                    learning_rate, loss_function)
+                                    learning_rate, loss_function, vectorized=flags.vectorized_global,
+                                    selector=selector, fused=flags.fused_step, count_passes=flags.count_passes)
 
         # validate epoch on validation set
         loss_train, accuracy_train, loss_test, accuracy_test = validate_epoch(train_data_full, test_data, feature_network, 
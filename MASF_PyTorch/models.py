@@ -1,3 +1,4 @@
+import torch
 import torchvision.models as models
 from torch import nn
 
@@ -12,7 +13,11 @@ class model_feature(nn.Module):
         return x
 
     def forward(self, input):
-        input = input.permute(0,3,1,2).cuda()
+        if input.dtype == torch.uint8:
+            # raw batches from the batched loader, normalize once on the device
+            input = input.cuda(non_blocking=True).permute(0,3,1,2).float().div_(255.)
+        else:
+            input = input.permute(0,3,1,2).cuda()
         x = self.logits(input)
         return x
 
@@ -19,7 +19,7 @@ def loss_fn_task(input1, input2, feature_network, task_network, loss_function):
     # get outputs of task_network
     task_network_output = task_network(feature_network_output)
     # calculate mean loss over the training domains
-    task_network_loss = loss_function(task_network(feature_network(inputs)), 
+    task_network_loss = loss_function(task_network_output, 
                     torch.tensor(torch.squeeze(labels), dtype=torch.long).cuda())
     return task_network_loss
 
@@ -133,7 +133,45 @@ def loss_fn_global(input1, input2, input3, feature_network, task_network):
     loss_global = torch.mean(torch.stack([loss_global1_mean, loss_global2_mean]))
     return loss_global
 
-def loss_fn_local(input1, input2, input3, embedding_network, eps):
+def loss_fn_global_vectorized(input1, input2, input3, feature_network, task_network, num_classes=7):
+    inputs1, labels1 = input1
+    inputs2, labels2 = input2
+    inputs3, labels3 = input3
+
+    # concat the domains and run the feature network once on all of them
+    inputs = torch.cat([inputs1, inputs2, inputs3], 0)
+    labels = torch.cat([labels1, labels2, labels3], 0)
+    domains = torch.cat([torch.full((labels1.size(0),), 0, dtype=torch.long), 
+                         torch.full((labels2.size(0),), 1, dtype=torch.long),
+                         torch.full((labels3.size(0),), 2, dtype=torch.long)], 0)
+    features = feature_network(inputs)
+
+    return loss_fn_global_features(features, labels, domains, task_network, num_classes)
+
+# global loss on features the feature network already computed for the three domains
+def loss_fn_global_features(features, labels, domains, task_network, num_classes=7):
+    num_domains = 3
+    labels = labels.view(-1).long().to(features.device)
+    domains = domains.to(features.device)
+
+    # get the mean of outputs per class per domain of the model (eq. 2) with a segment mean,
+    # classes without examples keep a zero vector
+    segments = domains * num_classes + labels
+    sums = torch.zeros(num_domains * num_classes, features.size(1), device=features.device, 
+                       dtype=features.dtype).index_add_(0, segments, features)
+    counts = torch.bincount(segments, minlength=num_domains * num_classes).clamp(min=1)
+    means = (sums / counts.unsqueeze(1).to(features.dtype)).view(num_domains, num_classes, -1)
+
+    # get softmax outputs of all classes and domains at once (eq. 3)
+    outputs_softmax = torch.nn.functional.softmax(task_network(means) / 2., dim=-1).data # TODO tau as variable
+
+    # calculate the loss function, the mean over the classes of kd is the kd over all classes
+    loss_global1_mean = util.kd(outputs_softmax[0], outputs_softmax[2])
+    loss_global2_mean = util.kd(outputs_softmax[1], outputs_softmax[2])
+    loss_global = torch.mean(torch.stack([loss_global1_mean, loss_global2_mean]))
+    return loss_global
+
+def loss_fn_local(input1, input2, input3, embedding_network, eps, selector=None):
     # get inputs and labels
     inputs1, labels1 = input1
     inputs2, labels2 = input2
@@ -147,7 +185,8 @@ def loss_fn_local(input1, input2, input3, embedding_network, eps):
     loss_triplet = util.TripletLoss(margin=eps)
 
     # initialize triplet selector
-    selector = util.BatchHardTripletSelector()
+    if selector is None:
+        selector = util.BatchHardTripletSelector()
 
     # get the triplets 
     anchor, pos, neg = selector(embeddings, labels)
@@ -179,16 +218,35 @@ def _train_step1(feature_network_copy, task_network_copy, input1, input2,
     optimizer_feature_copy.step()
     
 
+# task networks updated with one backward pass instead of one per network
+def _train_step1_fused(feature_network_copy, task_network_copy, input1, input2,
+                 optimizer_feature_copy, optimizer_task_copy, loss_function):
+
+    # get loss of classifier
+    loss = loss_fn_task(input1, input2, feature_network_copy, task_network_copy, loss_function)
+
+    # zero the parameter gradients, update task and feature network
+    optimizer_task_copy.zero_grad()
+    optimizer_feature_copy.zero_grad()
+    # perform gradient descent
+    loss.backward()
+    optimizer_task_copy.step()
+    optimizer_feature_copy.step()
 
 def _train_step2(feature_network, feature_network_copy, task_network, task_network_copy, 
                 embedding_network, input1, input2, input3, optimizer_feature, 
-                optimizer_task, optimizer_embedding, eps, loss_function):
+                optimizer_task, optimizer_embedding, eps, loss_function, vectorized=False,
+                selector=None):
 
 
     # get loss of critic
-    loss_global = loss_fn_global(input1, input2, input3, feature_network_copy, 
-                                task_network_copy)
-    loss_local = loss_fn_local(input1, input2, input3, embedding_network, eps)
+    if vectorized:
+        loss_global = loss_fn_global_vectorized(input1, input2, input3, feature_network_copy, 
+                                    task_network_copy)
+    else:
+        loss_global = loss_fn_global(input1, input2, input3, feature_network_copy, 
+                                    task_network_copy)
+    loss_local = loss_fn_local(input1, input2, input3, embedding_network, eps, selector=selector)
     loss_meta = loss_global + 0.005 * loss_local
     loss_task = loss_fn_task(input1, input2, feature_network_copy, 
                             task_network_copy, loss_function)
@@ -226,17 +284,32 @@ def _train_step2(feature_network, feature_network_copy, task_network, task_netwo
     # optimizer_task.step()
 
     # update parameters of embedding network
-    loss_local = loss_fn_local(input1, input2, input3, embedding_network, eps)
+    loss_local = loss_fn_local(input1, input2, input3, embedding_network, eps, selector=selector)
     # zero the parameter gradients, update feature network
     optimizer_embedding.zero_grad()
     # perform gradient descent
     loss_local.backward()
     optimizer_embedding.step()
 
+# only the local loss has an effect in step 2: the critic update of _train_step2 rebinds the
+# loop variable and never changes feature_network or task_network, so its losses are skipped
+def _train_step2_fused(feature_network, feature_network_copy, task_network, task_network_copy, 
+                embedding_network, input1, input2, input3, optimizer_feature, 
+                optimizer_task, optimizer_embedding, eps, loss_function, selector=None):
+
+    # update parameters of embedding network
+    loss_local = loss_fn_local(input1, input2, input3, embedding_network, eps, selector=selector)
+    # zero the parameter gradients, update embedding network
+    optimizer_embedding.zero_grad()
+    # perform gradient descent
+    loss_local.backward()
+    optimizer_embedding.step()
+
 
 def train_one_epoch(feature_network, task_network, embedding_network, train_input1, train_input2, 
                     train_input3, train_input_full, optimizer_feature, optimizer_task, optimizer_embedding, eps, 
-                    learning_rate, loss_function):
+                    learning_rate, loss_function, vectorized=False, selector=None, fused=False,
+                    count_passes=False):
     # set model status to train
     feature_network = feature_network.train()
     task_network = task_network.train()
@@ -255,14 +328,38 @@ def train_one_epoch(feature_network, task_network, embedding_network, train_inpu
     optimizer_feature_copy = optim.SGD(feature_network_copy.parameters(), lr=learning_rate, momentum=0.9)
     optimizer_task_copy = optim.SGD(task_network_copy.parameters(), lr=learning_rate, momentum=0.9)
 
-    for input1, input2, _ in zip(train_input1, train_input2, train_input3):
-        _train_step1(feature_network_copy, task_network_copy, input1, input2,
-                     optimizer_feature_copy, optimizer_task_copy, loss_function)
+    # count the forward and backward passes of the feature networks
+    if count_passes:
+        pass_counter = util.PassCounter([feature_network, feature_network_copy])
 
-    for input1, input2, input3 in zip(train_input1, train_input2, train_input3):
-        _train_step2(feature_network, feature_network_copy, task_network, task_network_copy, 
-                    embedding_network, input1, input2, input3 , optimizer_feature, 
-                    optimizer_task, optimizer_embedding, eps, loss_function)
+    for i, (input1, input2, _) in enumerate(zip(train_input1, train_input2, train_input3), 1):
+        if fused:
+            _train_step1_fused(feature_network_copy, task_network_copy, input1, input2,
+                         optimizer_feature_copy, optimizer_task_copy, loss_function)
+        else:
+            _train_step1(feature_network_copy, task_network_copy, input1, input2,
+                         optimizer_feature_copy, optimizer_task_copy, loss_function)
+
+    if count_passes:
+        template = 'Step 1: {:.1f} forward passes, {:.1f} backward passes per step'
+        print(template.format(pass_counter.forward_passes/i, pass_counter.backward_passes/i))
+        pass_counter.reset()
+
+    for i, (input1, input2, input3) in enumerate(zip(train_input1, train_input2, train_input3), 1):
+        if fused:
+            _train_step2_fused(feature_network, feature_network_copy, task_network, task_network_copy, 
+                        embedding_network, input1, input2, input3 , optimizer_feature, 
+                        optimizer_task, optimizer_embedding, eps, loss_function, selector=selector)
+        else:
+            _train_step2(feature_network, feature_network_copy, task_network, task_network_copy, 
+                        embedding_network, input1, input2, input3 , optimizer_feature, 
+                        optimizer_task, optimizer_embedding, eps, loss_function, vectorized=vectorized,
+                        selector=selector)
+
+    if count_passes:
+        template = 'Step 2: {:.1f} forward passes, {:.1f} backward passes per step'
+        print(template.format(pass_counter.forward_passes/i, pass_counter.backward_passes/i))
+        pass_counter.remove()
 
 # define accuracy function 
 def mean_accuracy(logits, y):
@@ -69,4 +69,65 @@ class BatchHardTripletSelector(object):
         neg_idxs = np.argmin(dist_diff, axis = 1)
         pos = embeds[pos_idxs].contiguous().view(num, -1)
         neg = embeds[neg_idxs].contiguous().view(num, -1)
-        return embeds, pos, neg
\ No newline at end of file
+        return embeds, pos, neg
+
+class DeviceTripletSelector(object):
+    '''
+    a selector to generate batch hard or semi hard triplets from the embedded batch,
+    the mining runs with masked reductions on the device of the embeddings
+    '''
+    def __init__(self, semi_hard=False, margin=None, *args, **kwargs):
+        super(DeviceTripletSelector, self).__init__()
+        self.semi_hard = semi_hard
+        self.margin = margin
+
+    def __call__(self, embeds, labels):
+        with torch.no_grad():
+            dist_mtx = pdist(embeds, embeds)
+            labels = labels.contiguous().view(-1, 1).to(embeds.device)
+            num = labels.shape[0]
+            lb_eqs = labels == labels.t()
+            eye = torch.eye(num, dtype=torch.bool, device=embeds.device)
+            # hardest positive, the anchor itself is excluded
+            dist_same = dist_mtx.masked_fill(~lb_eqs | eye, -np.inf)
+            pos_dist, pos_idxs = torch.max(dist_same, dim = 1)
+            # hardest negative
+            dist_diff = dist_mtx.masked_fill(lb_eqs, np.inf)
+            neg_idxs = torch.argmin(dist_diff, dim = 1)
+            if self.semi_hard:
+                # closest negative which is further away than the positive (and within 
+                # the margin), anchors without such a negative keep the hardest negative
+                semi = dist_diff > pos_dist.unsqueeze(1)
+                if self.margin is not None:
+                    semi = semi & (dist_diff < pos_dist.unsqueeze(1) + self.margin)
+                semi_dist, semi_idxs = torch.min(dist_diff.masked_fill(~semi, np.inf), dim = 1)
+                neg_idxs = torch.where(torch.isinf(semi_dist), neg_idxs, semi_idxs)
+        pos = embeds[pos_idxs].contiguous().view(num, -1)
+        neg = embeds[neg_idxs].contiguous().view(num, -1)
+        return embeds, pos, neg
+
+class PassCounter(object):
+    '''
+    counts the forward and backward passes through a list of modules
+    '''
+    def __init__(self, modules):
+        super(PassCounter, self).__init__()
+        self.handles = [module.register_forward_hook(self._forward_hook) for module in modules]
+        self.reset()
+
+    def _forward_hook(self, module, input, output):
+        self.forward_passes += 1
+        if output.requires_grad:
+            # the gradient of the output is computed once per backward pass through the module
+            output.register_hook(self._backward_hook)
+
+    def _backward_hook(self, grad):
+        self.backward_passes += 1
+
+    def reset(self):
+        self.forward_passes = 0
+        self.backward_passes = 0
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
@@ -7,6 +7,7 @@
 import tensorflow as tf
 import numpy as np
 import os
+import hashlib
 from tensorflow.python.framework import dtypes
 from tensorflow.python.framework.ops import convert_to_tensor
 
@@ -20,7 +21,7 @@ class ImageDataGenerator(object):
     """
 
     def __init__(self, txt_file, dataroot, mode, batch_size, num_classes, shuffle=True,
-                 buffer_size=1000):
+                 buffer_size=1000, repeat=False, cache_dir=None):
         """Create a new ImageDataGenerator.
 
         Recieves a path string to a text file, which consists of many lines,
@@ -39,6 +40,11 @@ class ImageDataGenerator(object):
                 initial file list.
             buffer_size: Number of images used as buffer for TensorFlows
                 shuffling of the dataset.
+            repeat: Wether or not to repeat the dataset indefinitely. All
+                batches are full and every epoch is reshuffled.
+            cache_dir: Directory of the preprocessed image cache (see
+                build_image_cache). If None, the images are decoded and
+                resized in every epoch.
 
         Raises:
             ValueError: If an invalid mode is passed.
@@ -50,6 +56,7 @@ class ImageDataGenerator(object):
 
         # retrieve the data from the text file
         self._read_txt_file()
+        self.indices = list(range(len(self.labels)))
 
         # number of samples in the dataset
         self.data_size = len(self.labels)
@@ -66,7 +73,14 @@ class ImageDataGenerator(object):
         data = tf.data.Dataset.from_tensor_slices((self.img_paths, self.labels))
 
         # distinguish between train/infer. when calling the parsing functions
-        if mode == 'training':
+        if cache_dir is not None and mode in ['training', 'inference']:
+            # the preprocessed images are read from the cache, the dataset only carries indices
+            self.images = build_image_cache(txt_file, dataroot, cache_dir)
+            self.indices = convert_to_tensor(self.indices, dtype=dtypes.int64)
+            data = tf.data.Dataset.from_tensor_slices((self.indices, self.labels))
+            data = data.map(self._parse_function_cached, num_parallel_calls=8)
+
+        elif mode == 'training':
             data = data.map(self._parse_function_train, num_parallel_calls=8)
 
         elif mode == 'inference':
@@ -79,9 +93,17 @@ class ImageDataGenerator(object):
         if shuffle:
             data = data.shuffle(buffer_size=buffer_size)
 
+        # repeat before batching so that batches never run short at the epoch end
+        if repeat:
+            data = data.repeat()
+
         # create a new dataset with batches of images
         data = data.batch(batch_size)
 
+        # read the whole batch from the cache at once
+        if cache_dir is not None:
+            data = data.map(self._read_cached_batch)
+
         self.data = data
 
     def _read_txt_file(self):
@@ -99,12 +121,15 @@ class ImageDataGenerator(object):
         """Conjoined shuffling of the list of paths and labels."""
         path = self.img_paths
         labels = self.labels
+        indices = self.indices
         permutation = np.random.permutation(self.data_size)
         self.img_paths = []
         self.labels = []
+        self.indices = []
         for i in permutation:
             self.img_paths.append(path[i])
             self.labels.append(labels[i])
+            self.indices.append(indices[i])
 
     def _parse_function_train(self, filename, label):
         """Input parser for samples of the training set."""
@@ -125,6 +150,25 @@ class ImageDataGenerator(object):
 
         return img_bgr, one_hot
 
+    def _parse_function_cached(self, index, label):
+        """Input parser for samples read from the preprocessed cache."""
+        # convert label number into one-hot-encoding
+        one_hot = tf.one_hot(label, self.num_classes)
+
+        return index, one_hot
+
+    def _read_cached_batch(self, index, one_hot):
+        """Read a batch of resized images from the cache and preprocess it."""
+        img_resized = tf.py_func(lambda i: self.images[i], [index], tf.uint8,
+                                 stateful=False)
+        img_resized.set_shape([None, 227, 227, 3])
+        img_centered = tf.subtract(tf.cast(img_resized, tf.float32), IMAGENET_MEAN)
+
+        # RGB -> BGR
+        img_bgr = img_centered[:, :, :, ::-1]
+
+        return img_bgr, one_hot
+
     def _parse_function_inference(self, filename, label):
         """Input parser for samples of the validation/test set."""
         # convert label number into one-hot-encoding
@@ -139,4 +183,109 @@ class ImageDataGenerator(object):
         # RGB -> BGR
         img_bgr = img_centered[:, :, ::-1]
 
-        return img_bgr, one_hot
\ No newline at end of file
+        return img_bgr, one_hot
+
+
+def _decode_resized(filename):
+    """Decode an image and resize it to the AlexNet input size."""
+    img_string = tf.read_file(filename)
+    img_decoded = tf.image.decode_png(img_string, channels=3)
+    img_resized = tf.image.resize_images(img_decoded, [227, 227])
+
+    return tf.cast(tf.round(img_resized), tf.uint8)
+
+
+def build_image_cache(txt_file, dataroot, cache_dir, batch_size=64):
+    """Decode and resize all images of a file list once and store them.
+
+    The resized RGB images are written in the order of the text file to a
+    uint8 .npy file, which is keyed by the name and content of the text file
+    and the dataroot. The mean subtraction and the RGB -> BGR flip are cheap
+    and stay in the input pipeline. An existing cache is only memory mapped.
+
+    Args:
+        txt_file: Path to the text file.
+        dataroot: Root folder of the image paths in the text file.
+        cache_dir: Directory where the cache is stored.
+        batch_size: Number of images decoded per session run.
+
+    Returns:
+        Memory mapped array of shape [num_images, 227, 227, 3].
+    """
+    with open(txt_file, 'rb') as f:
+        key = hashlib.md5(f.read() + dataroot.encode()).hexdigest()[:10]
+    name = os.path.splitext(os.path.basename(txt_file))[0]
+    cache_file = os.path.join(cache_dir, '%s_%s_227.npy' % (name, key))
+
+    if not os.path.exists(cache_file):
+        img_paths = []
+        with open(txt_file, 'r') as f:
+            for line in f.readlines():
+                img_paths.append(os.path.join(dataroot, line.split(' ')[0]))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # write to a temporary file first so concurrent jobs never read a partial cache
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        images = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8,
+                                           shape=(len(img_paths), 227, 227, 3))
+        # decode in a separate graph so the graph of the caller stays untouched
+        with tf.Graph().as_default():
+            data = tf.data.Dataset.from_tensor_slices(img_paths)
+            data = data.map(_decode_resized, num_parallel_calls=8)
+            next_batch = data.batch(batch_size).make_one_shot_iterator().get_next()
+            with tf.Session() as sess:
+                start = 0
+                while start < len(img_paths):
+                    batch = sess.run(next_batch)
+                    images[start:start+len(batch)] = batch
+                    start += len(batch)
+        images.flush()
+        del images
+        os.rename(tmp_file, cache_file)
+
+    return np.load(cache_file, mmap_mode='r')
+
+
+def make_episode_dataset(datasets, num_meta_test=1):
+    """Interleave the domain datasets into meta-train/meta-test episodes.
+
+    Takes one batch from every (repeated) domain dataset per episode,
+    randomly picks `num_meta_test` domains as meta-test and concatenates
+    and shuffles the remaining domains as meta-train, all inside the graph.
+
+    Args:
+        datasets: List of batched and repeated datasets, one per domain.
+        num_meta_test: Number of domains used for meta-test.
+
+    Returns:
+        Dataset of (inputa, labela, inputb, labelb) tuples.
+    """
+    num_domains = len(datasets)
+
+    def _episode(*batches):
+        images = tf.stack([img for img, _ in batches])
+        labels = tf.stack([lab for _, lab in batches])
+        # randomly choosing meta train and meta test domains
+        task_list = tf.random_shuffle(tf.range(num_domains))
+        meta_train_index = task_list[:num_domains-num_meta_test]
+        meta_test_index = task_list[num_domains-num_meta_test:]
+
+        def _gather(index):
+            img = tf.gather(images, index)
+            lab = tf.gather(labels, index)
+            img = tf.reshape(img, tf.concat([[-1], tf.shape(img)[2:]], 0))
+            lab = tf.reshape(lab, tf.concat([[-1], tf.shape(lab)[2:]], 0))
+            return img, lab
+
+        inputa, labela = _gather(meta_train_index)
+        inputb, labelb = _gather(meta_test_index)
+        # shuffle the examples of the meta train domains together
+        perm = tf.random_shuffle(tf.range(tf.shape(inputa)[0]))
+        inputa = tf.gather(inputa, perm)
+        labela = tf.gather(labela, perm)
+        return inputa, labela, inputb, labelb
+
+    data = tf.data.Dataset.zip(tuple(datasets))
+    data = data.map(_episode)
+    return data
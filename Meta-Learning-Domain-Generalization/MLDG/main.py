@@ -4,7 +4,8 @@ import pickle
 import random
 import tensorflow as tf
 import os
-from data_generator import ImageDataGenerator
+import time
+from data_generator import ImageDataGenerator, make_episode_dataset
 from maml import MAML
 from tensorflow.python.platform import flags
 from tensorflow.contrib.data import Iterator
@@ -15,6 +16,7 @@ FLAGS = flags.FLAGS
 ## Dataset/method options
 flags.DEFINE_string('datasource', 'PACS', 'PACS')
 flags.DEFINE_string('dataroot', '/cluster/work/math/ebeck/data/pacs/kfold/', 'Root folder where PACS dataset is stored')
+flags.DEFINE_string('cache_dir', '', 'folder of the preprocessed image cache, empty to decode the images in every epoch')
 flags.DEFINE_integer('num_classes', 7, 'number of classes used in classification (e.g. 5-way classification).')
 
 ## Training options
@@ -24,9 +26,13 @@ flags.DEFINE_integer('meta_batch_size', 64, 'number of tasks sampled per meta-up
 flags.DEFINE_float('meta_lr', 0.0005, 'the base learning rate of the generator')
 flags.DEFINE_float('update_lr', 0.0005, 'step size alpha for inner gradient update.') # 0.1 for omniglot
 flags.DEFINE_integer('num_updates', 3, 'number of inner gradient updates during training.')
+flags.DEFINE_bool('in_graph_pipeline', False, 'if True, build the meta-train/meta-test episodes in the input pipeline instead of feeding them')
 
 ## Model options
+flags.DEFINE_bool('mmap_weights', False, 'if True, load the pretrained AlexNet weights from a memory mapped copy with a single assign run')
 flags.DEFINE_bool('stop_grad', False, 'if True, do not use second derivatives in meta-optimization (for speed)')
+flags.DEFINE_string('meta_grad', 'second_order', 'meta-gradient estimator: second_order, first_order, truncated (last truncate_steps inner updates) or reptile')
+flags.DEFINE_integer('truncate_steps', 1, 'number of last inner updates differentiated through with meta_grad=truncated')
 
 ## Logging, saving, and testing options
 flags.DEFINE_bool('log', True, 'if false, do not log summaries, for debugging code.')
@@ -34,9 +40,100 @@ flags.DEFINE_string('logdir', './logs/', 'directory for summaries and checkpoint
 flags.DEFINE_bool('resume', False, 'resume training if there is a model available')
 flags.DEFINE_bool('train', True, 'True to train, False to test.')
 flags.DEFINE_integer('test_iter', -1, 'iteration to load model (-1 for latest model)')
+flags.DEFINE_integer('eval_batch_size', 1, 'number of test examples per batch in the periodic validation.')
+flags.DEFINE_integer('eval_subsample', 1, 'use every n-th test batch for the periodic validation, the full test domain is evaluated after training.')
 flags.DEFINE_integer('train_update_batch_size', -1, 'number of examples used for gradient update during training (use if you want to test with a different number).')
 flags.DEFINE_float('train_update_lr', -1, 'value of inner gradient step step during training. (use if you want to test with a different value)') # 0.1 for omniglot
 
+def sample_episode(sess, itr, num_training_tasks, train_next_list, training_init_op, train_batches_per_epoch):
+    """ Fetch one batch per domain and split them into meta train and meta test data """
+    # Sampling training and test tasks
+    num_meta_train = num_training_tasks-1
+    num_meta_test = num_training_tasks-num_meta_train
+    
+    # Randomly choosing meta train and meta test domains
+    task_list = np.random.permutation(num_training_tasks)
+    meta_train_index_list = task_list[:num_meta_train]
+    meta_test_index_list = task_list[num_meta_train:]
+    
+    for i in range(num_training_tasks):
+        if itr%train_batches_per_epoch[i] == 0:
+            sess.run(training_init_op[i])
+    
+    # Populating input tensors
+
+    # Sampling meta train data
+    for i in range(num_meta_train):
+        
+        task_ind = meta_train_index_list[i]
+        if i == 0:
+            inputa, labela = sess.run(train_next_list[task_ind])
+        else:
+            inp_tmp, lab_tmp = sess.run(train_next_list[task_ind])
+            inputa = np.concatenate((inputa, inp_tmp), axis=0)
+            labela = np.concatenate((labela, lab_tmp), axis=0)
+    
+    inputs_all = list(zip(inputa, labela))
+    shuffle(inputs_all)
+    inputa, labela = zip(*inputs_all)
+    
+    # Sampling meta test data
+    for i in range(num_meta_test):
+        
+        task_ind = meta_test_index_list[i]
+        if i == 0:
+            inputb, labelb = sess.run(train_next_list[task_ind])
+        else:
+            inp_tmp, lab_tmp = sess.run(train_next_list[task_ind])
+            inputb = np.concatenate((inputb, inp_tmp), axis=0)
+            labelb = np.concatenate((labelb, lab_tmp), axis=0)
+    return inputa, labela, inputb, labelb
+
+
+def evaluate(sess, model, init_op, next_batch):
+    """ Run the test graph over all batches of the test iterator, returns mean loss and accuracy """
+    test_acc = 0.
+    test_loss = 0.
+    test_count = 0
+    sess.run(init_op)
+    while True:
+        try:
+            test_input, test_label = sess.run(next_batch)
+        except tf.errors.OutOfRangeError:
+            break
+        
+        feed_dict = {model.test_input: test_input, model.test_label: test_label, model.KEEP_PROB: 1.}
+        input_tensors = [model.test_loss, model.test_acc]
+
+        result = sess.run(input_tensors, feed_dict)
+        # weight by the batch size, the last batch can be smaller
+        test_loss += np.sum(result[0])
+        test_acc += result[1] * len(test_label)
+        test_count += len(test_label)
+    return test_loss/test_count, test_acc/test_count
+
+
+def build_episode_inputs(train_file_list):
+    """ Build the in-graph episode pipeline and return its tensors for construct_model_train """
+    with tf.device('/cpu:0'):
+        tr_data_list = []
+        for i in range(len(train_file_list)):
+            tr_data = ImageDataGenerator(train_file_list[i],
+                                     dataroot=FLAGS.dataroot,
+                                     mode='training',
+                                     batch_size=FLAGS.meta_batch_size,
+                                     num_classes=FLAGS.num_classes,
+                                     shuffle=True,
+                                     repeat=True,
+                                     cache_dir=FLAGS.cache_dir or None)
+            tr_data_list.append(tr_data.data)
+        episodes = make_episode_dataset(tr_data_list, num_meta_test=1)
+        # prepare the next episode while the current one is trained on
+        episodes = episodes.prefetch(1)
+        inputa, labela, inputb, labelb = episodes.make_one_shot_iterator().get_next()
+    return {'inputa': inputa, 'labela': labela, 'inputb': inputb, 'labelb': labelb}
+
+
 def train(model, saver, sess, exp_string, train_file_list, test_file, resume_itr=0):
     SUMMARY_INTERVAL = 100
     SAVE_INTERVAL = 10000
@@ -48,6 +145,7 @@ def train(model, saver, sess, exp_string, train_file_list, test_file, resume_itr
         train_writer = tf.summary.FileWriter(FLAGS.logdir + '/' + exp_string, sess.graph)
     print('Done initializing, starting training.')
     prelosses, postlosses = [], []
+    iter_times = []
 
     num_classes = FLAGS.num_classes # for classification, 1 otherwise
 
@@ -57,13 +155,16 @@ def train(model, saver, sess, exp_string, train_file_list, test_file, resume_itr
         train_iterator_list = []
         train_next_list = []
         
-        for i in range(len(train_file_list)):
+        # with the in-graph pipeline the model reads the episodes directly, see build_episode_inputs
+        loader_file_list = [] if FLAGS.in_graph_pipeline else train_file_list
+        for i in range(len(loader_file_list)):
             tr_data = ImageDataGenerator(train_file_list[i],
                                      dataroot=FLAGS.dataroot,
                                      mode='training',
                                      batch_size=FLAGS.meta_batch_size,
                                      num_classes=num_classes,
-                                     shuffle=True)
+                                     shuffle=True,
+                                     cache_dir=FLAGS.cache_dir or None)
             tr_data_list.append(tr_data)
             
             train_iterator_list.append(Iterator.from_structure(tr_data_list[i].data.output_types,
@@ -73,9 +174,10 @@ def train(model, saver, sess, exp_string, train_file_list, test_file, resume_itr
         test_data = ImageDataGenerator(test_file,
                                       dataroot=FLAGS.dataroot,
                                       mode='inference',
-                                      batch_size=1,
+                                      batch_size=FLAGS.eval_batch_size,
                                       num_classes=num_classes,
-                                      shuffle=False)
+                                      shuffle=False,
+                                      cache_dir=FLAGS.cache_dir or None)
         
         test_iterator = Iterator.from_structure(test_data.data.output_types,
                                            test_data.data.output_shapes)
@@ -87,63 +189,30 @@ def train(model, saver, sess, exp_string, train_file_list, test_file, resume_itr
     # Ops for initializing different iterators
     training_init_op = []
     train_batches_per_epoch = []
-    for i in range(len(train_file_list)):
+    for i in range(len(tr_data_list)):
         training_init_op.append(train_iterator_list[i].make_initializer(tr_data_list[i].data))
         train_batches_per_epoch.append(int(np.floor(tr_data_list[i].data_size/FLAGS.meta_batch_size)))
     
-    test_init_op = test_iterator.make_initializer(test_data.data)
-    test_batches_per_epoch = int(np.floor(test_data.data_size / 1))
+    # prefetch the next test batch while the current one is evaluated
+    test_init_op = test_iterator.make_initializer(test_data.data.prefetch(1))
+    if FLAGS.eval_subsample > 1:
+        # quick validation on a fixed, evenly spread subset of the test batches
+        quick_test_init_op = test_iterator.make_initializer(
+            test_data.data.shard(FLAGS.eval_subsample, 0).prefetch(1))
+    else:
+        quick_test_init_op = test_init_op
     
     
     # Training begins
     
     for itr in range(resume_itr, FLAGS.pretrain_iterations + FLAGS.metatrain_iterations):
-        feed_dict = {}
-        
-        # Sampling training and test tasks
-        num_training_tasks = len(train_file_list)
-        num_meta_train = num_training_tasks-1
-        num_meta_test = num_training_tasks-num_meta_train
-        
-        # Randomly choosing meta train and meta test domains
-        task_list = np.random.permutation(num_training_tasks)
-        meta_train_index_list = task_list[:num_meta_train]
-        meta_test_index_list = task_list[num_meta_train:]
-        
-        for i in range(len(train_file_list)):
-            if itr%train_batches_per_epoch[i] == 0:
-                sess.run(training_init_op[i])
-        
-        # Populating input tensors
-
-        # Sampling meta train data
-        for i in range(num_meta_train):
-            
-            task_ind = meta_train_index_list[i]
-            if i == 0:
-                inputa, labela = sess.run(train_next_list[task_ind])
-            else:
-                inp_tmp, lab_tmp = sess.run(train_next_list[task_ind])
-                inputa = np.concatenate((inputa, inp_tmp), axis=0)
-                labela = np.concatenate((labela, lab_tmp), axis=0)
-        
-        inputs_all = list(zip(inputa, labela))
-        shuffle(inputs_all)
-        inputa, labela = zip(*inputs_all)
-        
-        # Sampling meta test data
-        for i in range(num_meta_test):
-            
-            task_ind = meta_test_index_list[i]
-            if i == 0:
-                inputb, labelb = sess.run(train_next_list[task_ind])
-            else:
-                inp_tmp, lab_tmp = sess.run(train_next_list[task_ind])
-                inputb = np.concatenate((inputb, inp_tmp), axis=0)
-                labelb = np.concatenate((labelb, lab_tmp), axis=0)
-        
-        
-        feed_dict = {model.inputa: inputa, model.inputb: inputb,  model.labela: labela, model.labelb: labelb, model.KEEP_PROB: dropout_rate}
+        if FLAGS.in_graph_pipeline:
+            # inputa/inputb are dataset tensors, only the dropout rate is fed
+            feed_dict = {model.KEEP_PROB: dropout_rate}
+        else:
+            inputa, labela, inputb, labelb = sample_episode(sess, itr, len(train_file_list), train_next_list, 
+                                                            training_init_op, train_batches_per_epoch)
+            feed_dict = {model.inputa: inputa, model.inputb: inputb,  model.labela: labela, model.labelb: labelb, model.KEEP_PROB: dropout_rate}
         
         if itr<FLAGS.pretrain_iterations:
             input_tensors = [model.pretrain_op]
@@ -154,7 +223,9 @@ def train(model, saver, sess, exp_string, train_file_list, test_file, resume_itr
             input_tensors.extend([model.summ_op, model.total_loss1, model.total_losses2[FLAGS.num_updates-1]])
             input_tensors.extend([model.total_accuracy1, model.total_accuracies2[FLAGS.num_updates-1]])
 
+        start_time = time.time()
         result = sess.run(input_tensors, feed_dict)
+        iter_times.append(time.time() - start_time)
 
         if itr % SUMMARY_INTERVAL == 0:
             prelosses.append(result[-2])
@@ -165,8 +236,12 @@ def train(model, saver, sess, exp_string, train_file_list, test_file, resume_itr
         if (itr!=0) and itr % PRINT_INTERVAL == 0:
             print_str = 'Iteration ' + str(itr - FLAGS.pretrain_iterations)
             print_str += ': ' + str(np.mean(prelosses)) + ', ' + str(np.mean(postlosses))
+            # cost of the chosen meta-gradient estimator
+            print_str += ', ' + FLAGS.meta_grad + ': %.3f s/iter, peak memory %.0f MB' % (
+                np.mean(iter_times), sess.run(model.max_bytes_in_use) / 2.**20)
             print(print_str)
             prelosses, postlosses = [], []
+            iter_times = []
 
         if (itr!=0) and itr % SAVE_INTERVAL == 0:
             saver.save(sess, FLAGS.logdir + '/' + exp_string + '/model' + str(itr))
@@ -174,32 +249,32 @@ def train(model, saver, sess, exp_string, train_file_list, test_file, resume_itr
 
         # Testing periodically
         if itr % TEST_PRINT_INTERVAL == 0:
-            test_acc = 0.
-            test_loss = 0.
-            test_count = 0
-            sess.run(test_init_op)
-            for it in range(test_batches_per_epoch):	
-                
-                test_input, test_label = sess.run(test_next_batch)
-                
-                feed_dict = {model.test_input: test_input, model.test_label: test_label, model.KEEP_PROB: 1.}
-                input_tensors = [model.test_loss, model.test_acc]
-
-                result = sess.run(input_tensors, feed_dict)
-                test_loss += result[0]
-                test_acc += result[1]
-                test_count += 1
-                
-            print('Validation results: Iteration %d, Loss: %f, Accuracy: %f' %(itr, test_loss/test_count, test_acc/test_count))
+            test_loss, test_acc = evaluate(sess, model, quick_test_init_op, test_next_batch)
+            print('Validation results: Iteration %d, Loss: %f, Accuracy: %f' %(itr, test_loss, test_acc))
+
+    if FLAGS.eval_subsample > 1:
+        test_loss, test_acc = evaluate(sess, model, test_init_op, test_next_batch)
+        print('Final validation results: Loss: %f, Accuracy: %f' %(test_loss, test_acc))
 
     saver.save(sess, FLAGS.logdir + '/' + exp_string +  '/model' + str(itr))
 
 
 def main():
     
+    filelist_root = '../data/MLDG/'
+    domain_dict = {1:'art_painting.txt', 2:'cartoon.txt', 3:'photo.txt', 4:'sketch.txt'}
+    train_domain_list = [2, 3, 4]
+    test_domain_list = [1]
+    
+    train_file_list = [os.path.join(filelist_root, domain_dict[i]) for i in train_domain_list]
+    test_file_list = [os.path.join(filelist_root, domain_dict[i]) for i in test_domain_list]
+
     # Constructing training and test graphs
     model = MAML()
-    model.construct_model_train()
+    if FLAGS.in_graph_pipeline:
+        model.construct_model_train(input_tensors=build_episode_inputs(train_file_list))
+    else:
+        model.construct_model_train()
     model.construct_model_test()
     
     model.summ_op = tf.summary.merge_all()
@@ -218,7 +293,7 @@ def main():
     tf.train.start_queue_runners()
     
     print('Loading pretrained weights')
-    model.load_initial_weights(sess)
+    model.load_initial_weights(sess, mmap=FLAGS.mmap_weights)
 
     if FLAGS.resume or not FLAGS.train:
         model_file = tf.train.latest_checkpoint(FLAGS.logdir + '/' + exp_string)
@@ -228,13 +303,6 @@ def main():
             print("Restoring model weights from " + model_file)
             saver.restore(sess, model_file)
 
-    filelist_root = '../data/MLDG/'
-    domain_dict = {1:'art_painting.txt', 2:'cartoon.txt', 3:'photo.txt', 4:'sketch.txt'}
-    train_domain_list = [2, 3, 4]
-    test_domain_list = [1]
-    
-    train_file_list = [os.path.join(filelist_root, domain_dict[i]) for i in train_domain_list]
-    test_file_list = [os.path.join(filelist_root, domain_dict[i]) for i in test_domain_list]
     train(model, saver, sess, exp_string, train_file_list, test_file_list[0], resume_itr)
 
 if __name__ == "__main__":
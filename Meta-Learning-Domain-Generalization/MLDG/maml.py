@@ -10,7 +10,7 @@ except KeyError as e:
           file=sys.stderr)
 
 from tensorflow.python.platform import flags
-from utils import mse, xent, conv_block, fc, max_pool, lrn, dropout
+from utils import mse, xent, conv_block, fc, max_pool, lrn, dropout, load_weights_mmap
 
 FLAGS = flags.FLAGS
 
@@ -25,13 +25,20 @@ class MAML:
         self.loss_func = xent
         self.WEIGHTS_PATH = '/cluster/home/ebeck/DomainGeneralisation/Meta-Learning-Domain-Generalization/data/bvlc_alexnet.npy'
     
-    def construct_model_train(self, prefix='metatrain_'):
+    def construct_model_train(self, input_tensors=None, prefix='metatrain_'):
         # a: training data for inner gradient, b: test data for meta gradient
         
-        self.inputa = tf.placeholder(tf.float32)
-        self.inputb = tf.placeholder(tf.float32)
-        self.labela = tf.placeholder(tf.float32)
-        self.labelb = tf.placeholder(tf.float32)
+        if input_tensors is None:
+            self.inputa = tf.placeholder(tf.float32)
+            self.inputb = tf.placeholder(tf.float32)
+            self.labela = tf.placeholder(tf.float32)
+            self.labelb = tf.placeholder(tf.float32)
+        else:
+            # inputs come directly from the input pipeline, nothing is fed
+            self.inputa = input_tensors['inputa']
+            self.inputb = input_tensors['inputb']
+            self.labela = input_tensors['labela']
+            self.labelb = input_tensors['labelb']
         self.KEEP_PROB = tf.placeholder(tf.float32)
         
         with tf.variable_scope('model', reuse=None) as training_scope:
@@ -61,7 +68,7 @@ class MAML:
                 task_outputa = self.forward(inputa, weights, reuse=reuse)
                 task_lossa = self.loss_func(task_outputa, labela)
                 grads = tf.gradients(task_lossa, list(weights.values()))
-                if FLAGS.stop_grad:
+                if self.stop_inner_grad(0):
                     grads = [tf.stop_gradient(grad) for grad in grads]
                 gradients = dict(zip(weights.keys(), grads))
                 fast_weights = dict(zip(weights.keys(), [weights[key] - self.update_lr*gradients[key] for key in weights.keys()]))
@@ -74,7 +81,7 @@ class MAML:
                 for j in range(num_updates - 1):
                     loss = self.loss_func(self.forward(inputa, fast_weights, reuse=True), labela)
                     grads = tf.gradients(loss, list(fast_weights.values()))
-                    if FLAGS.stop_grad:
+                    if self.stop_inner_grad(j+1):
                         grads = [tf.stop_gradient(grad) for grad in grads]
                     
                     gradients = dict(zip(fast_weights.keys(), grads))
@@ -83,6 +90,15 @@ class MAML:
                     task_outputbs.append(output)
                     task_lossesb.append(self.loss_func(output, labelb))
 
+                if FLAGS.meta_grad == 'reptile':
+                    # one more step on meta test, the meta update follows the whole trajectory
+                    grads = tf.gradients(task_lossesb[-1], list(fast_weights.values()))
+                    gradients = dict(zip(fast_weights.keys(), grads))
+                    # average step direction, scaled like the gradient of the meta_batch_size normalized losses
+                    scale = self.update_lr * (num_updates + 1) * FLAGS.meta_batch_size
+                    self.reptile_grads = dict([(weights[key].name, tf.stop_gradient(weights[key] - fast_weights[key] 
+                        + self.update_lr*gradients[key]) / scale) for key in weights.keys()])
+
                 task_output = [task_outputa, task_outputbs, task_lossa, task_lossesb]
 
                 # Populating the metrics
@@ -136,9 +152,13 @@ class MAML:
                 optimizer1 = tf.train.GradientDescentOptimizer(learning_rate1)
                 optimizer2 = tf.train.GradientDescentOptimizer(learning_rate2)
                 
-                gradients1 = tf.gradients(self.total_loss1 + self.total_losses2[FLAGS.num_updates-1], var_list1) 
+                if FLAGS.meta_grad == 'reptile':
+                    gradients1 = [self.reptile_grads[var.name] for var in var_list1]
+                    gradients2 = [self.reptile_grads[var.name] for var in var_list2]
+                else:
+                    gradients1 = tf.gradients(self.total_loss1 + self.total_losses2[FLAGS.num_updates-1], var_list1) 
+                    gradients2 = tf.gradients(self.total_loss1 + self.total_losses2[FLAGS.num_updates-1], var_list2)
                 gradients1 = list(zip(gradients1, var_list1))
-                gradients2 = tf.gradients(self.total_loss1 + self.total_losses2[FLAGS.num_updates-1], var_list2)
                 gradients2 = list(zip(gradients2, var_list2))
             
                 gradients1 = [(tf.clip_by_value(grad, -5, 5), var) for grad, var in gradients1]
@@ -147,6 +167,9 @@ class MAML:
                 train_op2 = optimizer2.apply_gradients(grads_and_vars=gradients2, global_step=global_step)
                 self.metatrain_op = tf.group(train_op1, train_op2)
         
+            # peak memory of the device, reported together with the time per iteration
+            self.max_bytes_in_use = tf.contrib.memory_stats.MaxBytesInUse()
+        
         ## Summaries
         tf.summary.scalar(prefix+'Pre-update loss', total_loss1)
         tf.summary.scalar(prefix+'Pre-update accuracy', total_accuracy1)
@@ -157,6 +180,15 @@ class MAML:
 
     
     
+    def stop_inner_grad(self, step):
+        """ Whether the meta-gradient is cut at inner update `step` (0 is the first update) """
+        if FLAGS.stop_grad or FLAGS.meta_grad in ['first_order', 'reptile']:
+            return True
+        if FLAGS.meta_grad == 'truncated':
+            # only differentiate through the last truncate_steps inner updates
+            return step < FLAGS.num_updates - FLAGS.truncate_steps
+        return False
+
     def construct_model_test(self, prefix='test'):
         # a: training data for inner gradient, b: test data for meta gradient
         
@@ -226,14 +258,33 @@ class MAML:
         
         return weights
 
-    def load_initial_weights(self, session):
+    def load_initial_weights(self, session, mmap=False):
         """Load weights from file into network.
 
         As the weights from http://www.cs.toronto.edu/~guerzhoy/tf_alexnet/
         come as a dict of lists (e.g. weights['conv1'] is a list) and not as
         dict of dicts (e.g. weights['conv1'] is a dict with keys 'weights' &
         'biases') we need a special load function
+
+        With mmap=True the weights are read from the memory mapped copy (see
+        utils.load_weights_mmap) and all variables are assigned in one run.
         """
+        if mmap:
+            weights_dict = load_weights_mmap(self.WEIGHTS_PATH)
+            assign_ops = []
+            feed_dict = {}
+            with tf.variable_scope('model', reuse=True):
+                for op_name in weights_dict:
+                    if op_name not in self.SKIP_LAYER:
+                        with tf.variable_scope(op_name, reuse=True):
+                            for kind in weights_dict[op_name]:
+                                var = tf.get_variable(kind, trainable=True)
+                                data = tf.placeholder(var.dtype.base_dtype, weights_dict[op_name][kind].shape)
+                                assign_ops.append(var.assign(data))
+                                feed_dict[data] = weights_dict[op_name][kind]
+            session.run(assign_ops, feed_dict)
+            return
+
         # Load the weights into memory
         weights_dict = np.load(self.WEIGHTS_PATH, encoding='bytes').item()
 
@@ -22,6 +22,36 @@ def get_images(paths, labels, nb_samples=None, shuffle=True):
         random.shuffle(images)
     return images
 
+## Weight helpers
+def load_weights_mmap(weights_path):
+    """Memory map the pretrained AlexNet weights.
+
+    The pickled dict of lists in `weights_path` is converted once into a
+    folder with one .npy file per array next to it. Afterwards only that
+    folder is memory mapped, so nothing is unpickled and only the pages
+    that are actually used get read.
+
+    Returns a dict of dicts, e.g. weights['conv1']['weights'].
+    """
+    mmap_dir = os.path.splitext(weights_path)[0] + '_mmap'
+    if not os.path.isdir(mmap_dir):
+        weights_dict = np.load(weights_path, encoding='bytes', allow_pickle=True).item()
+        # write to a temporary folder first so concurrent jobs never read a partial conversion
+        tmp_dir = '%s.%d.tmp' % (mmap_dir, os.getpid())
+        os.makedirs(tmp_dir)
+        for op_name in weights_dict:
+            name = op_name.decode() if isinstance(op_name, bytes) else op_name
+            for data in weights_dict[op_name]:
+                kind = 'biases' if len(data.shape) == 1 else 'weights'
+                np.save(os.path.join(tmp_dir, '%s_%s.npy' % (name, kind)), data)
+        os.rename(tmp_dir, mmap_dir)
+
+    weights = {}
+    for file_name in sorted(os.listdir(mmap_dir)):
+        op_name, kind = os.path.splitext(file_name)[0].rsplit('_', 1)
+        weights.setdefault(op_name, {})[kind] = np.load(os.path.join(mmap_dir, file_name), mmap_mode='r')
+    return weights
+
 ## Network helpers
 def conv_block(inp, cweight, bweight, stride_y=2, stride_x=2, groups=1):
     """ Perform, conv, batch norm, nonlinearity, and max pool """
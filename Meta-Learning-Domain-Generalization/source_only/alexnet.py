@@ -21,6 +21,7 @@ folder as this file:
 @author: Frederik Kratzert (contact: f.kratzert(at)gmail.com)
 """
 
+import os
 import tensorflow as tf
 import numpy as np
 
@@ -89,14 +90,39 @@ class AlexNet(object):
         # 8th Layer: FC and return unscaled activations
         self.fc8 = fc(dropout7, 4096, self.NUM_CLASSES, relu=False, name='fc8')
 
-    def load_initial_weights(self, session):
+    def load_initial_weights(self, session, mmap=False):
         """Load weights from file into network.
 
         As the weights from http://www.cs.toronto.edu/~guerzhoy/tf_alexnet/
         come as a dict of lists (e.g. weights['conv1'] is a list) and not as
         dict of dicts (e.g. weights['conv1'] is a dict with keys 'weights' &
         'biases') we need a special load function
+
+        With mmap=True the weights are read from the memory mapped copy (see
+        load_weights_mmap) and all variables are assigned in one run.
         """
+        if mmap:
+            weights_dict = load_weights_mmap(self.WEIGHTS_PATH)
+            assign_ops = []
+            feed_dict = {}
+            for op_name in weights_dict:
+
+                # Check if layer should be trained from scratch
+                if op_name not in self.SKIP_LAYER:
+
+                    with tf.variable_scope(op_name, reuse=True):
+
+                        # Collect one assign per weights/biases variable
+                        for kind in weights_dict[op_name]:
+                            var = tf.get_variable(kind, trainable=True)
+                            data = tf.placeholder(var.dtype.base_dtype,
+                                                  weights_dict[op_name][kind].shape)
+                            assign_ops.append(var.assign(data))
+                            feed_dict[data] = weights_dict[op_name][kind]
+
+            session.run(assign_ops, feed_dict)
+            return
+
         # Load the weights into memory
         weights_dict = np.load(self.WEIGHTS_PATH, encoding='bytes').item()
 
@@ -122,6 +148,37 @@ class AlexNet(object):
                             session.run(var.assign(data))
 
 
+def load_weights_mmap(weights_path):
+    """Memory map the pretrained AlexNet weights.
+
+    The pickled dict of lists in `weights_path` is converted once into a
+    folder with one .npy file per array next to it. Afterwards only that
+    folder is memory mapped, so nothing is unpickled and only the pages
+    that are actually used get read.
+
+    Returns a dict of dicts, e.g. weights['conv1']['weights'].
+    """
+    mmap_dir = os.path.splitext(weights_path)[0] + '_mmap'
+    if not os.path.isdir(mmap_dir):
+        weights_dict = np.load(weights_path, encoding='bytes', allow_pickle=True).item()
+        # write to a temporary folder first so concurrent jobs never read a partial conversion
+        tmp_dir = '%s.%d.tmp' % (mmap_dir, os.getpid())
+        os.makedirs(tmp_dir)
+        for op_name in weights_dict:
+            name = op_name.decode() if isinstance(op_name, bytes) else op_name
+            for data in weights_dict[op_name]:
+                kind = 'biases' if len(data.shape) == 1 else 'weights'
+                np.save(os.path.join(tmp_dir, '%s_%s.npy' % (name, kind)), data)
+        os.rename(tmp_dir, mmap_dir)
+
+    weights = {}
+    for file_name in sorted(os.listdir(mmap_dir)):
+        op_name, kind = os.path.splitext(file_name)[0].rsplit('_', 1)
+        weights.setdefault(op_name, {})[kind] = np.load(os.path.join(mmap_dir, file_name), mmap_mode='r')
+    return weights
+
+
+
 def conv(x, filter_height, filter_width, num_filters, stride_y, stride_x, name,
          padding='SAME', groups=1):
     """Create a convolution layer.
@@ -11,10 +11,13 @@ from tensorflow.contrib.data import Iterator
 # Path to the textfiles for the trainings and validation set
 dataroot = '/cluster/work/math/ebeck/data/pacs/kfold'
 test_file = 'data/sourceonly/art_painting/test.txt'
+# Folder of the preprocessed image cache, None to decode the images
+cache_dir = None
 checkpoint_path = '/cluster/home/ebeck/DomainGeneralisation/Meta-Learning-Domain-Generalization/results/checkpoints'
 num_classes = 7
 scratch_layers = ['fc8']
-batch_size = 1
+# Test examples per batch, the last batch may be smaller
+batch_size = 64
 
 # Place data loading and preprocessing on the cpu
 with tf.device('/cpu:0'):
@@ -23,7 +26,8 @@ with tf.device('/cpu:0'):
                                   mode='inference',
                                   batch_size=batch_size,
                                   num_classes=num_classes,
-                                  shuffle=False)
+                                  shuffle=False,
+                                  cache_dir=cache_dir)
 
     # create an reinitializable iterator given the dataset structure
     iterator = Iterator.from_structure(test_data.data.output_types,
@@ -31,11 +35,12 @@ with tf.device('/cpu:0'):
     next_batch_test = iterator.get_next()
 
 # Ops for initializing the two different iterators
-test_init_op = iterator.make_initializer(test_data.data)
+# prefetch the next test batch while the current one is evaluated
+test_init_op = iterator.make_initializer(test_data.data.prefetch(1))
 
 # TF placeholder for graph input and output
-x = tf.placeholder(tf.float32, [batch_size, 227, 227, 3])
-y = tf.placeholder(tf.float32, [batch_size, num_classes])
+x = tf.placeholder(tf.float32, [None, 227, 227, 3])
+y = tf.placeholder(tf.float32, [None, num_classes])
 keep_prob = tf.placeholder(tf.float32)
 
 # Initialize model
@@ -44,9 +49,6 @@ model = AlexNet(x, keep_prob, num_classes, scratch_layers)
 # Link variable to model output
 score = model.fc8
 
-# Get the number of training/validation steps per epoch
-test_batches_per_epoch = int(np.floor(test_data.data_size / batch_size))
-
 with tf.name_scope("accuracy"):
     correct_pred = tf.equal(tf.argmax(score, 1), tf.argmax(y, 1))
     accuracy = tf.reduce_mean(tf.cast(correct_pred, tf.float32))
@@ -67,14 +69,17 @@ with tf.Session() as sess:
     sess.run(test_init_op)
     test_acc = 0.
     test_count = 0
-    for _ in range(test_batches_per_epoch):
-
-        img_batch, label_batch = sess.run(next_batch_test)
+    while True:
+        try:
+            img_batch, label_batch = sess.run(next_batch_test)
+        except tf.errors.OutOfRangeError:
+            break
         acc = sess.run(accuracy, feed_dict={x: img_batch,
                                             y: label_batch,
                                             keep_prob: 1.})
-        test_acc += acc
-        test_count += 1
+        # weight by the batch size, the last batch can be smaller
+        test_acc += acc * len(label_batch)
+        test_count += len(label_batch)
     test_acc /= test_count
     print("{} Test Accuracy = {:.4f}".format(datetime.now(),
                                                    test_acc))
@@ -31,6 +31,8 @@ dataroot = '/cluster/work/math/ebeck/data/pacs/kfold/'
 train_file = 'data/sourceonly/art_painting/train.txt'
 val_file = 'data/sourceonly/art_painting/val.txt'
 out_path = 'results/'
+# Folder of the preprocessed image cache, None to decode the images in every epoch
+cache_dir = None
 
 # Learning params
 base_learning_rate = 0.0005
@@ -38,6 +40,8 @@ num_iters = 45000
 batch_size = 64
 
 # Network params
+# Load the pretrained weights from a memory mapped copy with a single assign run
+mmap_weights = False
 dropout_rate = 0.5
 num_classes = 7
 scratch_layers = ['fc8']
@@ -63,13 +67,15 @@ with tf.device('/cpu:0'):
                                  mode='training',
                                  batch_size=batch_size,
                                  num_classes=num_classes,
-                                 shuffle=True)
+                                 shuffle=True,
+                                 cache_dir=cache_dir)
     val_data = ImageDataGenerator(val_file,
                                   dataroot=dataroot,
                                   mode='inference',
                                   batch_size=batch_size,
                                   num_classes=num_classes,
-                                  shuffle=False)
+                                  shuffle=False,
+                                  cache_dir=cache_dir)
 
     # create an reinitializable iterator given the dataset structure
     iterator = Iterator.from_structure(tr_data.data.output_types,
@@ -172,7 +178,7 @@ with tf.Session() as sess:
     writer.add_graph(sess.graph)
 
     # Load the pretrained weights into the non-trainable layer
-    model.load_initial_weights(sess)
+    model.load_initial_weights(sess, mmap=mmap_weights)
 
     print("{} Start training...".format(datetime.now()))
     print("{} Open Tensorboard at --logdir {}".format(datetime.now(),
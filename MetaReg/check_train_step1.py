@@ -0,0 +1,76 @@
+import argparse
+import numpy as np
+import tensorflow as tf
+from models import get_model
+from main import loss_fn_task, _train_step1
+
+# compares the losses of the original step 1 of metalearning (all task networks under
+# every tape) with _train_step1 (one forward and backward pass per task network)
+parser = argparse.ArgumentParser(description='MetaReg step 1 equivalence check')
+parser.add_argument('--batch_size', type=int, default=4)
+parser.add_argument('--num_classes_label', type=int, default=7)
+parser.add_argument('--steps', type=int, default=3)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--atol', type=float, default=1e-5)
+flags = parser.parse_args()
+
+config = argparse.Namespace(resnet_weights=None, num_classes_label=flags.num_classes_label)
+
+# the loss function step 1 used before, it runs all three task networks
+def loss_fn_regular(features1, features2, features3, model_task1, model_task2,
+                    model_task3, config, training):
+    model_task1_loss, accuracy1 = loss_fn_task(features1, model_task1, config, training)
+    model_task2_loss, accuracy2 = loss_fn_task(features2, model_task2, config, training)
+    model_task3_loss, accuracy3 = loss_fn_task(features3, model_task3, config, training)
+    label_loss = tf.reduce_mean([model_task1_loss, model_task2_loss, model_task3_loss])
+    accuracy = tf.reduce_mean([accuracy1, accuracy2, accuracy3])
+    return label_loss, model_task1_loss, model_task2_loss, model_task3_loss, accuracy
+
+# the original step 1, every tape computes the losses of all task networks
+def _train_step1_regular(model_task1, model_task2, model_task3, features1, features2, features3,
+                optimizer, global_step, config):
+    model_tasks = [model_task1, model_task2, model_task3]
+    for i, model_task in enumerate(model_tasks):
+        with tf.GradientTape() as tape_src:
+            losses = loss_fn_regular(features1, features2, features3,
+                            *model_tasks, config=config, training=True)
+        grads = tape_src.gradient(losses[i + 1], model_task.trainable_variables)
+        optimizer.apply_gradients(zip(grads, model_task.trainable_variables))
+
+# three task networks on one shared feature network, initialized from the seed
+def build_models():
+    tf.random.set_seed(flags.seed)
+    model_feature = get_model("feature_network", config)
+    return [get_model("classifier_task", config, model_feature=model_feature) for _ in range(3)]
+
+# batch statistics, the BatchNorm moving statistics are updated a different number of times
+def task_losses(model_tasks, features):
+    return [loss_fn_task(f, m, config, training=True)[0].numpy()
+                for m, f in zip(model_tasks, features)]
+
+rng = np.random.RandomState(flags.seed)
+features = [{"image": tf.constant(rng.rand(flags.batch_size, 227, 227, 3), dtype=tf.float32),
+             "label": tf.constant(rng.randint(flags.num_classes_label, size=[flags.batch_size, 1]))}
+            for _ in range(3)]
+
+models_regular = build_models()
+models_task = build_models()
+optimizer_regular = tf.keras.optimizers.SGD(learning_rate=0.001, momentum=0.9)
+optimizer_task = tf.keras.optimizers.SGD(learning_rate=0.001, momentum=0.9)
+global_step = tf.Variable(initial_value=0, trainable=False, dtype=tf.int64)
+
+max_diff = 0.
+print('{:>6} {:>36} {:>36}'.format('step', 'regular losses', 'per task losses'))
+for step in range(flags.steps):
+    _train_step1_regular(*models_regular, *features, optimizer_regular, global_step, config)
+    _train_step1(*models_task, *features, optimizer_task, global_step, config)
+    losses_regular = task_losses(models_regular, features)
+    losses_task = task_losses(models_task, features)
+    max_diff = max(max_diff, np.max(np.abs(np.subtract(losses_regular, losses_task))))
+    print('{:>6} {:>36} {:>36}'.format(step,
+        ' '.join('{:.6f}'.format(l) for l in losses_regular),
+        ' '.join('{:.6f}'.format(l) for l in losses_task)))
+
+print('max abs loss difference: {:.3e}'.format(max_diff))
+if max_diff > flags.atol:
+    raise SystemExit('step 1 losses differ by more than {}'.format(flags.atol))
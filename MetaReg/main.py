@@ -61,56 +61,57 @@ parser.add_argument('--dropout_rate', type=float, help='Dropout rate.')
 parser.add_argument('--use_dropout', type=int, help='Flag whether to use dropout.')
 parser.add_argument('--alpha', type=float, help='weighting factor of classification loss.')
 parser.add_argument('--lambda', type=float, help='weighting factor of generator.')
-
-# this is the loss function used in the paper without regularizer
-def loss_fn_regular(features1, features2, features3, model_task1, model_task2, 
-                    model_task3, config, training):
-    inputs1 = features1["image"]
-    label1 = tf.squeeze(features1["label"])
-    inputs2 = features2["image"]
-    label2 = tf.squeeze(features2["label"])
-    inputs3 = features3["image"]
-    label3 = tf.squeeze(features3["label"])
-
-    # predict the outputs of all task networks (one per domain)
-    model_task1_output = model_task1(inputs1, training=training)
-    model_task2_output = model_task2(inputs2, training=training)
-    model_task3_output = model_task3(inputs3, training=training)
-
-    # calculate the mean loss of all task networks (one per domain)
-    model_task1_loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels = tf.one_hot(label1, axis=-1, 
+parser.add_argument('--raw_shards', type=int, help='Flag whether to read the raw uint8 shards.')
+parser.add_argument('--parallel_pipeline', type=int, help='Flag whether to use parallel map and prefetch.')
+parser.add_argument('--deterministic_pipeline', type=int, help='Flag whether to keep the element order.')
+parser.add_argument('--cache_eval', type=int, help='Flag whether to cache the eval splits.')
+parser.add_argument('--compiled_steps', type=int, help='Flag whether to trace the train steps with tf.function.')
+parser.add_argument('--xla', type=int, help='Flag whether to compile the traced train steps with XLA.')
+parser.add_argument('--multi_head', type=int, help='Flag whether to share one feature network pass between the task networks.')
+parser.add_argument('--eval_batch_size', type=int, help='Batch size of the single pass eval over all splits (0 to keep the sharded eval).')
+
+# loss and accuracy of one task network on the batch of its own domain
+def loss_fn_task(features, model_task, config, training):
+    inputs = features["image"]
+    label = tf.squeeze(features["label"])
+
+    # predict the outputs of the task network
+    model_task_output = model_task(inputs, training=training)
+
+    # calculate the mean loss of the task network
+    model_task_loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels = tf.one_hot(label, axis=-1, 
                                 depth=config.num_classes_label), 
-                                logits = model_task1_output), name='Label_loss1')
-    model_task2_loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels = tf.one_hot(label2, axis=-1, 
+                                logits = model_task_output))
+
+    # calculate the accuracy of the task network
+    accuracy = tf.reduce_mean(
+        tf.where(tf.equal(label, tf.argmax(model_task_output, axis=-1)),
+                    tf.ones_like(label, dtype=tf.float32),
+                    tf.zeros_like(label, dtype=tf.float32)))
+
+    return model_task_loss, accuracy
+
+# loss of every task head on its own domain, the feature network runs once on all domains
+def loss_fn_multi_head(features1, features2, features3, model_multi_head, config, training):
+    features = [features1, features2, features3]
+    inputs = tf.concat([f["image"] for f in features], 0)
+    label = tf.concat([tf.reshape(f["label"], [-1]) for f in features], 0)
+    domain = tf.concat([tf.fill(tf.shape(tf.reshape(f["label"], [-1])), i) 
+                        for i, f in enumerate(features)], 0)
+
+    # predict the outputs of all task heads on all domains
+    model_multi_head_output = model_multi_head(inputs, training=training)
+
+    # mask the loss of every head to the examples of its own domain
+    model_task_losses = []
+    for i, model_task_output in enumerate(model_multi_head_output):
+        mask = tf.cast(tf.equal(domain, i), tf.float32)
+        loss = tf.nn.softmax_cross_entropy_with_logits(labels = tf.one_hot(label, axis=-1, 
                                 depth=config.num_classes_label), 
-                                logits = model_task2_output), name='Label_loss2')
-    model_task3_loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels = tf.one_hot(label3, axis=-1, 
-                                depth=config.num_classes_label), 
-                                logits = model_task3_output), name='Label_loss3')     
-
-    # total mean loss over all task networks (one per domain)
-    label_loss = tf.reduce_mean([model_task1_loss, model_task2_loss, model_task3_loss])
-
-    # calculate the accuracies of all task networks
-    accuracy1 = tf.reduce_mean(
-        tf.where(tf.equal(label1, tf.argmax(model_task1_output, axis=-1)),
-                    tf.ones_like(label1, dtype=tf.float32),
-                    tf.zeros_like(label1, dtype=tf.float32)))
-
-    accuracy2 = tf.reduce_mean(
-        tf.where(tf.equal(label2, tf.argmax(model_task2_output, axis=-1)),
-                    tf.ones_like(label2, dtype=tf.float32),
-                    tf.zeros_like(label2, dtype=tf.float32)))
-    
-    accuracy3 = tf.reduce_mean(
-        tf.where(tf.equal(label3, tf.argmax(model_task3_output, axis=-1)),
-                    tf.ones_like(label3, dtype=tf.float32),
-                    tf.zeros_like(label3, dtype=tf.float32)))
+                                logits = model_task_output)
+        model_task_losses.append(tf.reduce_sum(loss * mask) / tf.reduce_sum(mask))
 
-    # get the mean accurary over all task models
-    accuracy = tf.reduce_mean([accuracy1, accuracy2, accuracy3])
-
-    return label_loss, model_task1_loss, model_task2_loss, model_task3_loss, accuracy
+    return model_task_losses
 
 # this is the loss function used in the paper with regularizer, used for training after metalearning
 def loss_fn_full(features1, features2, features3, model_final, model_regularizer, config, training):
@@ -153,101 +154,92 @@ def loss_fn_full(features1, features2, features3, model_final, model_regularizer
 # first step of metalearning, regular backpropagation
 def _train_step1(model_task1, model_task2, model_task3, features1, features2, features3,
                 optimizer, global_step, config):
-    
-    with tf.GradientTape() as tape_src:
 
-        # get loss of all networks 
-        _, model_task1_loss, model_task2_loss, model_task3_loss, _ = loss_fn_regular(features1, 
-                                    features2, features3, model_task1, model_task2, model_task3, config=config, training=True)
+    # every task network only depends on its own domain, so each network gets
+    # one forward and one backward pass on its own batch
+    for model_task, features in zip([model_task1, model_task2, model_task3], 
+                                    [features1, features2, features3]):
+        with tf.GradientTape() as tape_src:
+            model_task_loss, _ = loss_fn_task(features, model_task, config=config, training=True)
 
         # calculate gradients and apply SGD updates
-        grads1 = tape_src.gradient(model_task1_loss, model_task1.trainable_variables)
-        optimizer.apply_gradients(zip(grads1, model_task1.trainable_variables))
+        grads = tape_src.gradient(model_task_loss, model_task.trainable_variables)
+        optimizer.apply_gradients(zip(grads, model_task.trainable_variables))
 
-    with tf.GradientTape() as tape_src:
-        
-        # get loss of all networks 
-        _, model_task1_loss, model_task2_loss, model_task3_loss, _ = loss_fn_regular(features1, 
-                                    features2, features3, model_task1, model_task2, model_task3, config=config, training=True)
-        # calculate gradients and apply SGD updates
-        grads2 = tape_src.gradient(model_task2_loss, model_task2.trainable_variables)
-        optimizer.apply_gradients(zip(grads2, model_task2.model.trainable_variables))
+# first step of metalearning with one shared feature network pass for all task networks
+def _train_step1_multi_head(model_multi_head, features1, features2, features3,
+                optimizer, global_step, config):
 
     with tf.GradientTape() as tape_src:
+        model_task_losses = loss_fn_multi_head(features1, features2, features3, 
+                                model_multi_head, config=config, training=True)
+        loss = tf.reduce_sum(model_task_losses)
 
-        # get loss of all networks 
-        _, model_task1_loss, model_task2_loss, model_task3_loss, _ = loss_fn_regular(features1, 
-                                    features2, features3, model_task1, model_task2, model_task3, config=config, training=True)
-        # calculate gradients and apply SGD updates
-        grads3 = tape_src.gradient(model_task3_loss, model_task3.trainable_variables)
-        optimizer.apply_gradients(zip(grads3, model_task3.model.trainable_variables))
+    # calculate gradients and apply SGD updates to the feature network and all heads
+    grads = tape_src.gradient(loss, model_multi_head.trainable_variables)
+    optimizer.apply_gradients(zip(grads, model_multi_head.trainable_variables))
 
-# Second step of metalearning, episodic training
+# Second step of metalearning, episodic training. Every update gets its own non persistent 
+# tape, so the recorded activations are released after each gradient
 def _train_step2(model1, model2, model3, model_regularizer, features1, features2, features3, 
                 optimizer, global_step, config, models, random_domains):
 
-    with tf.GradientTape(persistent=True) as tape_src:
-        _, model1_loss, model2_loss, model3_loss, _ = loss_fn_regular(features1, 
-                                    features2, features3, model1, model2, model3, config=config, training=True)
-        tape_src.watch(model_regularizer.trainable_variables)
-    
-        loss = [model1_loss, model2_loss, model3_loss]
+    features = [features1, features2, features3]
+    meta_train_model = models[random_domains[0]]
 
-        meta_train_loss = loss[random_domains[0]]
-        meta_train_model = models[random_domains[0]]
+    # only the loss of the meta train model on its own domain is used
+    with tf.GradientTape() as tape_src:
+        meta_train_loss, _ = loss_fn_task(features[random_domains[0]], meta_train_model, 
+                                    config=config, training=True)
 
-        # calculate gradients and apply SGD updates
-        grads = tape_src.gradient(meta_train_loss, meta_train_model.trainable_variables) 
-        optimizer.apply_gradients(zip(grads, meta_train_model.trainable_variables))
+    # calculate gradients and apply SGD updates
+    grads = tape_src.gradient(meta_train_loss, meta_train_model.trainable_variables) 
+    optimizer.apply_gradients(zip(grads, meta_train_model.trainable_variables))
 
-    # with tf.GradientTape() as tape_src:
+    with tf.GradientTape() as tape_src:
         output = model_regularizer(tf.expand_dims(tf.abs(tf.reshape(meta_train_model.trainable_variables[0], [-1])), 0))
-        # calculate gradients and apply SGD updates
-        grads = tape_src.gradient(output, model_regularizer.trainable_variables) 
-        grads = tf.reshape(grads, [2048,7])
-        optimizer.apply_gradients(zip([grads], [meta_train_model.trainable_variables[0]]))
-
-# # third step of metalearning, update regularizer NN
-# def _train_step3(model_regularizer, features1, features2, features3, 
-#                 optimizer, global_step, config, models ,random_domains):
-
-        # meta_test_model = models[random_domains[0]]
-
-        _, model1_loss, model2_loss, model3_loss, _ = loss_fn_regular(features1, features2, features3, 
-                                                            meta_train_model, meta_train_model, meta_train_model, 
-                                                            config=config, training=True)
-
-        loss = [model1_loss, model2_loss, model3_loss]
-        meta_test_loss = loss[random_domains[1]]
-
-    # with tf.GradientTape() as tape_src:
-        print(model_regularizer.trainable_variables)
-        meta_test_loss = tf.convert_to_tensor(meta_test_loss)
-        print(meta_test_loss)
-        print(tf.convert_to_tensor(model_regularizer.trainable_variables))
-        # loss = [model1_loss, model2_loss, model3_loss]
-        # meta_test_loss = loss[random_domains[1]]
-        # calculate gradients and apply SGD updates
-        grads1 = tape_src.gradient(meta_test_loss, model_regularizer.trainable_variables)
-        print(grads1) 
-        optimizer.apply_gradients(zip(grads1, model_regularizer.trainable_variables))
 
+    # calculate gradients and apply SGD updates
+    grads = tape_src.gradient(output, model_regularizer.trainable_variables) 
+    grads = tf.reshape(grads, [2048,7])
+    optimizer.apply_gradients(zip([grads], [meta_train_model.trainable_variables[0]]))
+
+    # third step of metalearning, update regularizer NN
+    # meta test loss of the meta train model on the meta test domain
+    with tf.GradientTape() as tape_src:
+        tape_src.watch(model_regularizer.trainable_variables)
+        meta_test_loss, _ = loss_fn_task(features[random_domains[1]], meta_train_model, 
+                                    config=config, training=True)
 
+    # calculate gradients and apply SGD updates
+    grads1 = tape_src.gradient(meta_test_loss, model_regularizer.trainable_variables)
+    optimizer.apply_gradients(zip(grads1, model_regularizer.trainable_variables))
 
 # train one epoch of the metalearning (not train the full model)
 def train_one_epoch(model_task1, model_task2, model_task3, model1, 
                     model2, model3, model_regularizer, train_input1, 
-                    train_input2, train_input3, optimizer, global_step, config):
+                    train_input2, train_input3, optimizer, global_step, config,
+                    model_multi_head=None):
 
     # randomly shuffle data before each epoch
     train_input1 = train_input1.shuffle(buffer_size=10000)
     train_input2 = train_input2.shuffle(buffer_size=10000)
     train_input3 = train_input3.shuffle(buffer_size=10000)
 
+    # measure how long the loop waits for the input pipeline
+    input_timer = util.InputTimer()
+
     # TRAIN_STEP1, regular training (first part of MetaReg algo)
-    for _input1, _input2, _input3 in zip(train_input1, train_input2, train_input3):
-        _train_step1(model_task1, model_task2, model_task3, _input1, _input2, _input3,
-                        optimizer, global_step, config)
+    if model_multi_head is not None:
+        train_step1 = util.get_train_step(_train_step1_multi_head, config)
+        for _input1, _input2, _input3 in input_timer(zip(train_input1, train_input2, train_input3)):
+            train_step1(model_multi_head, _input1, _input2, _input3,
+                            optimizer, global_step, config)
+    else:
+        train_step1 = util.get_train_step(_train_step1, config)
+        for _input1, _input2, _input3 in input_timer(zip(train_input1, train_input2, train_input3)):
+            train_step1(model_task1, model_task2, model_task3, _input1, _input2, _input3,
+                            optimizer, global_step, config)
     
     # sample two random domains
     random_domains = random.sample([0, 1, 2], 2)
@@ -275,9 +267,10 @@ def train_one_epoch(model_task1, model_task2, model_task3, model1,
     _train_input2 = train_input2.take(5)
     _train_input3 = train_input3.take(5)
 
-    # TRAIN_STEP2, meta learning of regularizer
-    for _input1, _input2, _input3 in zip(_train_input1, _train_input2, _train_input3):
-        _train_step2(model1, model2, model3, model_regularizer, _input1, _input2, _input3, optimizer, 
+    # TRAIN_STEP2, meta learning of regularizer, traced once per pair of random domains
+    train_step2 = util.get_train_step(_train_step2, config, key=tuple(random_domains))
+    for _input1, _input2, _input3 in input_timer(zip(_train_input1, _train_input2, _train_input3)):
+        train_step2(model1, model2, model3, model_regularizer, _input1, _input2, _input3, optimizer, 
         global_step, config, models=models, random_domains=random_domains)
     
     # all layers trainable again (unset meta learning)
@@ -288,6 +281,8 @@ def train_one_epoch(model_task1, model_task2, model_task3, model1,
     for layer in model3.model.layers[:-1]:
         layer.trainable = True
 
+    return input_timer
+
     # # TRAIN_STEP3, meta update for regularizer
     # for _input1, _input2, _input3 in zip(train_input1, train_input2, train_input3):
     #     _train_step3(model_regularizer, _input1, _input2, _input3, optimizer, global_step, config, 
@@ -319,10 +314,16 @@ def train_one_epoch_full(train_input1, train_input2, train_input3, model_final,
     for layer in model_regularizer.model.layers[:]:
         layer.trainable = False 
 
+    # measure how long the loop waits for the input pipeline
+    input_timer = util.InputTimer()
+
     # train one batch on final model
-    for _input1, _input2, _input3 in zip(train_input1, train_input2, train_input3):
-        _train_step_full(_input1, _input2, _input3, model_final,
+    train_step_full = util.get_train_step(_train_step_full, config)
+    for _input1, _input2, _input3 in input_timer(zip(train_input1, train_input2, train_input3)):
+        train_step_full(_input1, _input2, _input3, model_final,
                             model_regularizer, optimizer, global_step, config)
+
+    return input_timer
     
 
 # compute the mean of all examples for a specific set (eval, validation, out-of-distribution, etc)
@@ -344,7 +345,7 @@ def eval_one_epoch(model_final, model_regularizer, dataset, summary_directory, g
         classification_loss(_classification_loss)
         accuracy(_accuracy)
 
-    writer = tf.summary.create_file_writer(summary_directory)
+    writer = _get_writer(summary_directory)
     with writer.as_default(), tf.summary.record_if(True):
         tf.summary.scalar("classification_loss", classification_loss.result(), 
             step=global_step)
@@ -356,9 +357,69 @@ def eval_one_epoch(model_final, model_regularizer, dataset, summary_directory, g
     return results_dict
 
 
+# one summary writer per eval split, created on first use
+_WRITERS = {}
+def _get_writer(summary_directory):
+    if summary_directory not in _WRITERS:
+        _WRITERS[summary_directory] = tf.summary.create_file_writer(summary_directory)
+    return _WRITERS[summary_directory]
+
+
+def loss_fn_eval(features, model_final, config, training):
+    inputs = features["image"]
+    label = tf.reshape(features["label"], [-1])
+
+    # predict the labels  
+    model_final_output = model_final(inputs, training=training)
+
+    # per example loss and correct predictions, averaged by the streaming metrics
+    cross_entropy = tf.nn.softmax_cross_entropy_with_logits(labels = tf.one_hot(label, axis=-1, 
+                                depth=config.num_classes_label), 
+                                logits = model_final_output)
+    correct = tf.cast(tf.equal(label, tf.argmax(model_final_output, axis=-1)), tf.float64)
+
+    return cross_entropy, correct
+
+
+def eval_splits(model_final, model_regularizer, datasets, summary_directory, global_step, config, training):
+    """
+    Evaluates all splits, every dataset is read once in its own (large) batches. 
+    datasets maps the split name to its dataset, the summaries of a split are 
+    written to summary_directory/<split name>. Returns the results dict per split.
+    """
+    eval_step = util.get_train_step(loss_fn_eval, config)
+
+    # the regularizer loss only depends on the weights, compute it once for all splits
+    last_layer = tf.expand_dims(tf.abs(tf.reshape(model_final.model.layers[-1].trainable_variables[0], [-1])), 0)
+    regularizer_loss = tf.reduce_sum(model_regularizer(last_layer))
+
+    results = {}
+    for name, dataset in datasets.items():
+        classification_loss = tf.metrics.Mean("binary_crossentropy")
+        accuracy = tf.metrics.Mean("accuracy")
+        for features in dataset:
+            cross_entropy, correct = eval_step(features, model_final, config, training)
+            classification_loss(cross_entropy)
+            accuracy(correct)
+        loss = classification_loss.result() + tf.cast(regularizer_loss, classification_loss.result().dtype)
+
+        writer = _get_writer(os.path.join(summary_directory, name))
+        with writer.as_default(), tf.summary.record_if(True):
+            tf.summary.scalar("classification_loss", loss, step=global_step)
+            tf.summary.scalar("accuracy", accuracy.result(), step=global_step)
+
+        results[name] = {"accuracy": accuracy.result(), "loss": loss}
+
+    return results
+
+
 def _preprocess_exampe(model_task1, example, dataset_name, config):
     example["image"] = tf.cast(example["image"], dtype=tf.float64)/255.
-    example["image"] = tf.image.resize(example["image"], size=(model_task1.input_shape[0], model_task1.input_shape[1]))
+    if example["image"].shape[:2].as_list() != list(model_task1.input_shape):
+        example["image"] = tf.image.resize(example["image"], size=(model_task1.input_shape[0], model_task1.input_shape[1]))
+    else:
+        # raw shards are already stored at the model resolution
+        example["image"] = tf.cast(example["image"], dtype=tf.float32)
     example["label"] = example["attributes"]["label"]
     example["domain"] = example["attributes"]["domain"]
     domain = example["domain"]
@@ -372,22 +433,48 @@ def _preprocess_exampe(model_task1, example, dataset_name, config):
     return example
 
 
+_BUILDERS = {}
+
+def _get_builder(dataset_name, validation_split):
+    # prepare the tfds builder once and read all splits from it
+    key = (dataset_name, tuple(validation_split))
+    if key not in _BUILDERS:
+        builder = tfds.builder(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
+            validation_split=validation_split)
+        builder.download_and_prepare()
+        _BUILDERS[key] = builder
+    return _BUILDERS[key]
+
+
 def _get_dataset(dataset_name, model_label, validation_split, split, batch_size, config, 
-    num_batches=None):
+    num_batches=None, cache=False):
 
-    builder_kwargs = {
-        "validation_split": validation_split,
-    }
+    if config.raw_shards:
+        dataset = pacs.load_raw_split(split, model_label.input_shape, local_settings.TF_DATASET_PATH)
+    else:
+        dataset = _get_builder(dataset_name, validation_split).as_dataset(split=split)
 
-    dataset, info = tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
-        split=split, builder_kwargs=builder_kwargs, with_info=True)
-    dataset = dataset.map(lambda x: _preprocess_exampe(model_label, x, dataset_name, config))
+    if config.parallel_pipeline:
+        num_parallel_calls = tf.data.experimental.AUTOTUNE
+    else:
+        num_parallel_calls = None
+    options = tf.data.Options()
+    options.experimental_deterministic = bool(config.deterministic_pipeline)
+    dataset = dataset.with_options(options)
+
+    dataset = dataset.map(lambda x: _preprocess_exampe(model_label, x, dataset_name, config), 
+        num_parallel_calls=num_parallel_calls)
+    # keep the preprocessed examples in memory, only used for the eval splits. take()
+    # stops the first pass early and an unfinished cache is never written
+    if cache and num_batches is None:
+        dataset = dataset.cache()
     dataset = dataset.shuffle(512)
     dataset = dataset.batch(batch_size)
     if num_batches is not None:
         dataset = dataset.take(num_batches)
 
-    # dataset = dataset.prefetch(2)
+    if config.parallel_pipeline:
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
     return dataset
 
@@ -497,6 +584,11 @@ def main():
 
     model_final = get_model(config.name_classifier_task, config, model_feature = model_feature)
 
+    # all task networks share model_feature, run it once for the three domains
+    if config.multi_head:
+        model_multi_head = MetaReg.model_multi_head(model_feature, [model_task1, model_task2, model_task3])
+    else:
+        model_multi_head = None
 
     # Get datasets
     if DEBUG:
@@ -504,9 +596,15 @@ def main():
     else:
         num_batches = None
 
+    # the single pass eval reads the eval splits in large batches
+    if config.eval_batch_size:
+        eval_batch_size = tf.cast(config.eval_batch_size, tf.int64)
+    else:
+        eval_batch_size = tf.cast(config.batch_size/3, tf.int64)
+
     ds_train_complete = _get_dataset(config.dataset, model_task1, config.test_domain,
-        split=tfds.Split.TRAIN, batch_size=tf.cast(config.batch_size/3, tf.int64), config = config,
-        num_batches=num_batches)
+        split=tfds.Split.TRAIN, batch_size=eval_batch_size, config = config,
+        num_batches=num_batches, cache=config.cache_eval)
 
     ds_train1 = _get_dataset(config.dataset, model_task1, config.test_domain,
         split="train1", batch_size=tf.cast(config.batch_size/3, tf.int64), config = config,
@@ -521,20 +619,20 @@ def main():
         num_batches=num_batches)
 
     ds_val_in = _get_dataset(config.dataset, model_task1, config.test_domain, config = config,
-        split="val_in", batch_size=tf.cast(config.batch_size/3, tf.int64),
-        num_batches=num_batches)
+        split="val_in", batch_size=eval_batch_size,
+        num_batches=num_batches, cache=config.cache_eval)
 
     ds_val_out = _get_dataset(config.dataset, model_task1, config.test_domain, config = config,
-        split="val_out", batch_size=tf.cast(config.batch_size/3, tf.int64),
-        num_batches=num_batches)
+        split="val_out", batch_size=eval_batch_size,
+        num_batches=num_batches, cache=config.cache_eval)
 
     ds_test_in = _get_dataset(config.dataset, model_task1, config.test_domain, config = config,
-        split="test_in", batch_size=tf.cast(config.batch_size/3, tf.int64), 
-        num_batches=num_batches)
+        split="test_in", batch_size=eval_batch_size, 
+        num_batches=num_batches, cache=config.cache_eval)
 
     ds_test_out = _get_dataset(config.dataset, model_task1, config.test_domain, config = config, 
-        split="test_out", batch_size=tf.cast(config.batch_size/3, tf.int64),
-        num_batches=num_batches)
+        split="test_out", batch_size=eval_batch_size,
+        num_batches=num_batches, cache=config.cache_eval)
 
 
     # Set up checkpointing
@@ -548,52 +646,73 @@ def main():
         manager = tf.train.CheckpointManager(ckpt, model_dir, max_to_keep=3) 
 
     writer = tf.summary.create_file_writer(manager._directory)
-    with writer.as_default(), tf.summary.record_if(lambda: int(global_step.numpy()) % 100 == 0):
+    with writer.as_default(), tf.summary.record_if(lambda: tf.equal(global_step % 100, 0)):
         for epoch in range(epoch_start, config.num_epochs):
         
             start_time = time.time()
+            util.reset_peak_memory()
 
             # Metalearning of the regularizer
             if epoch < (config.num_epochs/2):
-                train_one_epoch(model_task1 = model_task1, model_task2=model_task2, model_task3=model_task3, 
+                input_timer = train_one_epoch(model_task1 = model_task1, model_task2=model_task2, model_task3=model_task3, 
                     model1 = model1, model2 = model2, model3 = model3,
                     model_regularizer=model_regularizer, train_input1=ds_train1, 
                     train_input2=ds_train2, train_input3=ds_train3 ,optimizer=optimizer,
-                    global_step=global_step, config=config)
+                    global_step=global_step, config=config, model_multi_head=model_multi_head)
+
+                train_time = time.time() - start_time
+                logging.info("meta epoch: %d, time: %0.2f, step_time: %0.4f, input_wait_time: %0.2f" % 
+                    (epoch, train_time, train_time/max(input_timer.num_steps, 1), input_timer.wait_time))
+                peak_memory = util.get_peak_memory()
+                if peak_memory is not None:
+                    logging.info("peak_memory_per_step: {:1f} MB".format(peak_memory))
 
             if epoch >= (config.num_epochs/2):
                 
                 # After Metalearning, train the full model
-                train_one_epoch_full(train_input1=ds_train1, train_input2=ds_train2, 
+                input_timer = train_one_epoch_full(train_input1=ds_train1, train_input2=ds_train2, 
                                     train_input3=ds_train3, model_final=model_final, 
                                     model_regularizer=model_regularizer, optimizer=optimizer,
                                     global_step=global_step, config=config)
+                train_time = time.time() - start_time
+                peak_memory = util.get_peak_memory()
                     
-                train_metr = eval_one_epoch(model_final=model_final, 
-                    model_regularizer=model_regularizer, dataset=ds_train_complete,
-                    summary_directory=os.path.join(manager._directory, "train"), 
-                    global_step=global_step, config=config, training=False)
+                if config.eval_batch_size:
+                    # one pass over every split instead of three sharded reads
+                    eval_metr = eval_splits(model_final=model_final, 
+                        model_regularizer=model_regularizer, 
+                        datasets={"train": ds_train_complete, "val_out": ds_val_out, 
+                            "val_in": ds_val_in, "test_in": ds_test_in, "test_out": ds_test_out},
+                        summary_directory=manager._directory, 
+                        global_step=global_step, config=config, training=False)
+                    train_metr, val_out_metr, val_in_metr, test_in_metr, test_out_metr = [eval_metr[name] 
+                        for name in ["train", "val_out", "val_in", "test_in", "test_out"]]
+                else:
+                    train_metr = eval_one_epoch(model_final=model_final, 
+                        model_regularizer=model_regularizer, dataset=ds_train_complete,
+                        summary_directory=os.path.join(manager._directory, "train"), 
+                        global_step=global_step, config=config, training=False)
                 
-                val_out_metr = eval_one_epoch(model_final=model_final, 
-                    model_regularizer=model_regularizer, dataset=ds_val_out,
-                    summary_directory=os.path.join(manager._directory, "val_out"), 
-                    global_step=global_step, config=config, training=False)
+                    val_out_metr = eval_one_epoch(model_final=model_final, 
+                        model_regularizer=model_regularizer, dataset=ds_val_out,
+                        summary_directory=os.path.join(manager._directory, "val_out"), 
+                        global_step=global_step, config=config, training=False)
+
+                    val_in_metr = eval_one_epoch(model_final=model_final, 
+                        model_regularizer=model_regularizer, dataset=ds_val_in,
+                        summary_directory=os.path.join(manager._directory, "val_in"),
+                        global_step=global_step, config=config, training=False)
 
-                val_in_metr = eval_one_epoch(model_final=model_final, 
-                    model_regularizer=model_regularizer, dataset=ds_val_in,
-                    summary_directory=os.path.join(manager._directory, "val_in"),
-                    global_step=global_step, config=config, training=False)
+                    test_in_metr = eval_one_epoch(model_final=model_final, 
+                        model_regularizer=model_regularizer, dataset=ds_test_in,
+                        summary_directory=os.path.join(manager._directory, "test_in"), 
+                        global_step=global_step, config=config, training=False)
 
-                test_in_metr = eval_one_epoch(model_final=model_final, 
-                    model_regularizer=model_regularizer, dataset=ds_test_in,
-                    summary_directory=os.path.join(manager._directory, "test_in"), 
-                    global_step=global_step, config=config, training=False)
+                    test_out_metr = eval_one_epoch(model_final=model_final, 
+                        model_regularizer=model_regularizer, dataset=ds_test_out,
+                        summary_directory=os.path.join(manager._directory, "test_out"),
+                        global_step=global_step, config=config, training=False)
 
-                test_out_metr = eval_one_epoch(model_final=model_final, 
-                    model_regularizer=model_regularizer, dataset=ds_test_out,
-                    summary_directory=os.path.join(manager._directory, "test_out"),
-                    global_step=global_step, config=config, training=False)
-            
 
 
                 manager.save()
@@ -601,6 +720,10 @@ def main():
                 logging.info("\n #### \n epoch: %d, time: %0.2f" % 
                     (epoch-config.num_epochs/2, time.time() - start_time))
                 logging.info("Global step: {}".format(global_step.numpy()))
+                logging.info("step_time: {:4f}, input_wait_time: {:2f}".format(
+                    train_time/max(input_timer.num_steps, 1), input_timer.wait_time))
+                if peak_memory is not None:
+                    logging.info("peak_memory_per_step: {:1f} MB".format(peak_memory))
                 logging.info("train_accuracy: {:2f}, train_loss: {:4f}".format(
                     train_metr['accuracy'], train_metr['loss']))
                 logging.info("val_out_accuracy: {:2f}, val_out_loss: {:4f}".format(
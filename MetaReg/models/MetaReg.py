@@ -42,6 +42,19 @@ class model_task(tf.keras.Model):
     def input_shape(self):
         return model_task.INPUT_SHAPE
 
+# shares one feature network between the task networks, the feature network runs
+# once on the concatenated domain batches and every task head gets all features
+class model_multi_head(tf.keras.Model):
+
+    def __init__(self, model_feature, model_tasks, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.model_feature = model_feature
+        self.heads = [model_task.model.layers[-1] for model_task in model_tasks]
+
+    def call(self, inputs, training=None, mask=None):
+        features = self.model_feature(inputs, training=training)
+        return [head(features) for head in self.heads]
+
 class model_regularizer(tf.keras.Model):
 
     def __init__(self, config, *args, **kwargs):
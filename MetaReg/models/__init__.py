@@ -1,6 +1,7 @@
 from models.MetaReg import model_feature
 from models.MetaReg import model_task
 from models.MetaReg import model_regularizer
+from models.MetaReg import model_multi_head
 
 def get_model(name, config, model_feature=model_feature):
     if name == "feature_network":
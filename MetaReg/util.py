@@ -4,6 +4,7 @@ from collections import namedtuple
 from shutil import make_archive
 from datetime import datetime
 import os
+import time
 import tensorflow as tf
 import numpy as np
 
@@ -40,4 +41,66 @@ def update_config(config, args):
     return config
 
 def g_sgd(gradients, state, learning_rate=0.1):
-    return -learning_rate*gradients, state
\ No newline at end of file
+    return -learning_rate*gradients, state
+
+
+_COMPILED_STEPS = {}
+
+def get_train_step(step_fn, config, key=None):
+    """
+    Returns the train step traced into a graph with tf.function if compiled_steps 
+    is set in the config, otherwise the eager step_fn. Every key gets its own 
+    traced function, so optimizer slots of new variables are created on its first call.
+    """
+    if not config.compiled_steps:
+        return step_fn
+    if config.xla:
+        # auto-clustering compiles the XLA compatible ops, summary ops stay outside
+        tf.config.optimizer.set_jit(True)
+    if (step_fn, key) not in _COMPILED_STEPS:
+        _COMPILED_STEPS[(step_fn, key)] = tf.function(step_fn, experimental_relax_shapes=True)
+    return _COMPILED_STEPS[(step_fn, key)]
+
+
+def reset_peak_memory(device="GPU:0"):
+    """
+    Resets the peak memory statistic of the device, no-op if tensorflow 
+    can not report memory statistics for it.
+    """
+    try:
+        tf.config.experimental.reset_memory_stats(device)
+    except (AttributeError, ValueError):
+        pass
+
+
+def get_peak_memory(device="GPU:0"):
+    """
+    Returns the peak memory in MB allocated on the device since the last 
+    reset, None if tensorflow can not report memory statistics for it.
+    """
+    try:
+        return tf.config.experimental.get_memory_info(device)["peak"] / 2.**20
+    except (AttributeError, ValueError):
+        return None
+
+
+class InputTimer(object):
+    """
+    Wraps the input iterators of a training loop and accumulates the time 
+    spent waiting for the next batch.
+    """
+    def __init__(self):
+        self.wait_time = 0.
+        self.num_steps = 0
+
+    def __call__(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            start_time = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.wait_time += time.time() - start_time
+            self.num_steps += 1
+            yield item
@@ -59,6 +59,7 @@ parser.add_argument('--overwrite_configs', type=int,
 parser.add_argument('--dropout_rate', type=float, help='Dropout rate.')
 parser.add_argument('--use_dropout', type=int, help='Flag whether to use dropout.')
 parser.add_argument('--alpha', type=float, help='weighting factor of classification loss.')
+parser.add_argument('--env_cache', type=int, help='Flag whether to load the colored environments from the on-disk cache.')
 parser.add_argument('--lambda', type=float, help='weighting factor of generator.')
 
 # this is the loss function used in the paper without regularizer
@@ -348,12 +349,28 @@ def _preprocess_exampe(model_label, example, dataset_name, domain, e):
     return example  
 
 
-def _get_dataset(dataset_name, model_label, split, batch_size, e, domain,
-    num_batches=None):
+def _load_raw(dataset_name, split):
+    data = tfds.as_numpy(tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
+        split=split, batch_size=-1))
+    return data["image"], data["label"]
+
 
-    dataset, info = tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
-        split=split, with_info=True)
-    dataset = dataset.map(lambda x: _preprocess_exampe(model_label, x, dataset_name, domain, e))
+def _get_dataset(dataset_name, model_label, split, batch_size, e, domain,
+    num_batches=None, env_cache=False, seed=0):
+
+    if env_cache:
+        # load the colored environment from the on-disk cache instead of preprocessing per example
+        images, labels, _ = util.load_colored_mnist("{}_domain{}".format(dataset_name, 
+            int(domain)), e, seed, lambda: _load_raw(dataset_name, split), 
+            os.path.join(local_settings.RAW_DATA_PATH, "colored_mnist"))
+        images = np.transpose(images, (0, 2, 3, 1)).astype(np.float64)/255.
+        labels = labels.astype(np.int64)[:, None, None]
+        dataset = tf.data.Dataset.from_tensor_slices({"image": images, "label": labels})
+        dataset = dataset.map(lambda x: dict(x, domain=domain))
+    else:
+        dataset, info = tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
+            split=split, with_info=True)
+        dataset = dataset.map(lambda x: _preprocess_exampe(model_label, x, dataset_name, domain, e))
     dataset = dataset.shuffle(512)
     dataset = dataset.batch(batch_size)
     dataset = dataset.take(tf.cast(20, tf.int64))
@@ -478,16 +495,19 @@ def main():
     ds_train1 = _get_dataset(config.dataset, model_task1, 
         split=tfds.Split.TRAIN.subsplit(tfds.percent[:50]), 
         batch_size=tf.cast(config.batch_size/2, tf.int64), 
-        num_batches=num_batches, domain = tf.constant(0), e = 0.2)
+        num_batches=num_batches, domain = tf.constant(0), e = 0.2,
+        env_cache=config.env_cache, seed=config.seed)
 
     ds_train2 = _get_dataset(config.dataset, model_task1, 
         split=tfds.Split.TRAIN.subsplit(tfds.percent[-50:]), 
         batch_size=tf.cast(config.batch_size/2, tf.int64),
-        num_batches=num_batches, domain = tf.constant(1), e = 0.1)
+        num_batches=num_batches, domain = tf.constant(1), e = 0.1,
+        env_cache=config.env_cache, seed=config.seed)
     
     ds_val = _get_dataset(config.dataset, model_task1, 
         split=tfds.Split.TEST, batch_size=config.batch_size, 
-        num_batches=num_batches, domain = tf.constant(2), e = 0.9)
+        num_batches=num_batches, domain = tf.constant(2), e = 0.9,
+        env_cache=config.env_cache, seed=config.seed)
 
 
 
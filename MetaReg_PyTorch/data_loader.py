@@ -2,16 +2,91 @@ import torch.utils.data as data
 import numpy as np
 import torch
 import h5py
+import os
+import bisect
 
 class HDF5Dataset(data.Dataset):
-    def __init__(self, file_path):
+    def __init__(self, file_path, lazy=False):
         super(HDF5Dataset, self).__init__()
-        with h5py.File(file_path) as hf:
-            self.data = np.asarray(hf['images'])
+        self.file_path = file_path
+        self.lazy = lazy
+        with h5py.File(file_path, 'r') as hf:
             self.target = (np.expand_dims(np.asarray(hf['labels']), -1)-1)
+            if lazy:
+                # only keep the labels in memory, images are read on demand
+                self.data = None
+                self.file = None
+                self.pid = None
+            else:
+                self.data = np.asarray(hf['images'])
+
+    def _open(self):
+        # open the file once per process, each DataLoader worker gets its own handle
+        hf = h5py.File(self.file_path, 'r')
+        images = hf['images']
+        offset = images.id.get_offset()
+        if images.chunks is None and images.compression is None and offset is not None:
+            # contiguous dataset, map it directly so all workers share the page cache
+            self.data = np.memmap(self.file_path, mode='r', dtype=images.dtype,
+                                  shape=images.shape, offset=offset)
+            hf.close()
+            self.file = None
+        else:
+            # chunked or compressed dataset, read slices through h5py
+            self.data = images
+            self.file = hf
+        self.pid = os.getpid()
 
     def __getitem__(self, index):
+        if self.lazy and self.pid != os.getpid():
+            self._open()
+        if isinstance(index, (list, tuple, np.ndarray)):
+            return self.get_batch(index)
         return torch.from_numpy(np.asarray(self.data[index,:,:,:]/255., dtype=np.float16)).float(), torch.from_numpy(np.asarray(self.target[index], dtype=np.int16)).float()
-        
+
+    def get_batch(self, indices):
+        # read a whole batch at once and keep it as uint8, normalization happens on the device
+        if self.lazy and self.pid != os.getpid():
+            self._open()
+        # h5py needs increasing indices, sorting also makes the reads sequential
+        indices = sorted(indices)
+        images = np.asarray(self.data[indices])
+        labels = np.asarray(self.target[indices], dtype=np.float32)
+        return torch.from_numpy(images), torch.from_numpy(labels)
+
+    def __getstate__(self):
+        # file handles can not be pickled, workers reopen the file on first access
+        state = self.__dict__.copy()
+        if self.lazy:
+            state['data'] = None
+            state['file'] = None
+            state['pid'] = None
+        return state
+
     def __len__(self):
-        return list(self.data.shape)[0]
\ No newline at end of file
+        return list(self.target.shape)[0]
+
+class HDF5ConcatDataset(data.ConcatDataset):
+    # ConcatDataset which also accepts a list of indices and forwards them per dataset
+    def __getitem__(self, index):
+        if not isinstance(index, (list, tuple, np.ndarray)):
+            return super(HDF5ConcatDataset, self).__getitem__(index)
+        indices_per_dataset = [[] for _ in self.datasets]
+        for idx in index:
+            dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+            offset = 0 if dataset_idx == 0 else self.cumulative_sizes[dataset_idx - 1]
+            indices_per_dataset[dataset_idx].append(idx - offset)
+        batches = [dataset.get_batch(indices) for dataset, indices in 
+                   zip(self.datasets, indices_per_dataset) if len(indices) > 0]
+        images = torch.cat([images for images, _ in batches], 0)
+        labels = torch.cat([labels for _, labels in batches], 0)
+        return images, labels
+
+def get_loader(dataset, batch_size, num_workers=1, batched=False, pin_memory=False):
+    if batched:
+        # the sampler yields whole batches of indices, the dataset returns collated uint8 batches
+        sampler = data.BatchSampler(data.RandomSampler(dataset), batch_size, drop_last=True)
+        return data.DataLoader(dataset, sampler=sampler, batch_size=None, 
+                               num_workers=num_workers, pin_memory=pin_memory)
+    return data.DataLoader(dataset, num_workers=num_workers, batch_size=batch_size, 
+                           shuffle=True, drop_last=True, pin_memory=pin_memory)
@@ -3,9 +3,9 @@ import random
 from torch import nn, optim
 import argparse
 import numpy as np
-from models import model_feature, model_task, model_regularizer
+from models import model_feature, model_task, model_regularizer, model_multi_head
 from torch.utils import data
-from data_loader import HDF5Dataset
+from data_loader import HDF5Dataset, HDF5ConcatDataset, get_loader
 from train import validate_epoch, train_one_epoch_metatrain, train_one_epoch_full
 
 parser = argparse.ArgumentParser(description='PACS')
@@ -17,6 +17,11 @@ parser.add_argument('--epochs_full', type=int, default=15)
 parser.add_argument('--num_classes', type=int, default=7)
 parser.add_argument('--meta_train_steps', type=int, default=20)
 parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--num_workers', type=int, default=1)
+parser.add_argument('--lazy_loading', type=int, default=0)
+parser.add_argument('--batched_loading', type=int, default=0)
+parser.add_argument('--pin_memory', type=int, default=0)
+parser.add_argument('--multi_head', type=int, default=0)
 flags = parser.parse_args()
 
 #print setup
@@ -28,21 +33,21 @@ for k,v in sorted(vars(flags).items()):
 random.seed(flags.seed)
 
 # load data
-dataset1 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/art_painting_train.hdf5')
-train_data1 = data.DataLoader(dataset1, num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)
-dataset2 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/sketch_train.hdf5')
-train_data2 = data.DataLoader(dataset2, num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)
-dataset3 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/photo_train.hdf5')
-train_data3 = data.DataLoader(dataset3, num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)
-train_data_full = data.DataLoader(data.ConcatDataset([dataset1, dataset2, dataset3]), 
-                                                    num_workers=1, batch_size=flags.batch_size, 
-                                                    shuffle=True, drop_last=True)
-dataset = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/cartoon_test.hdf5')
-test_data = data.DataLoader(dataset, num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)
+dataset1 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/art_painting_train.hdf5', lazy=flags.lazy_loading)
+train_data1 = get_loader(dataset1, flags.batch_size, num_workers=flags.num_workers, 
+                         batched=flags.batched_loading, pin_memory=flags.pin_memory)
+dataset2 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/sketch_train.hdf5', lazy=flags.lazy_loading)
+train_data2 = get_loader(dataset2, flags.batch_size, num_workers=flags.num_workers, 
+                         batched=flags.batched_loading, pin_memory=flags.pin_memory)
+dataset3 = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/photo_train.hdf5', lazy=flags.lazy_loading)
+train_data3 = get_loader(dataset3, flags.batch_size, num_workers=flags.num_workers, 
+                         batched=flags.batched_loading, pin_memory=flags.pin_memory)
+train_data_full = get_loader(HDF5ConcatDataset([dataset1, dataset2, dataset3]), flags.batch_size, 
+                             num_workers=flags.num_workers, batched=flags.batched_loading, 
+                             pin_memory=flags.pin_memory)
+dataset = HDF5Dataset('/cluster/work/math/ebeck/data/pacs/cartoon_test.hdf5', lazy=flags.lazy_loading)
+test_data = get_loader(dataset, flags.batch_size, num_workers=flags.num_workers, 
+                       batched=flags.batched_loading, pin_memory=flags.pin_memory)
 
 # load models
 model_feature_final = model_feature(flags.hidden_dim).cuda()
@@ -52,6 +57,11 @@ model_task2 = model_task(model_feature, flags.hidden_dim, flags.num_classes).cud
 model_task3 = model_task(model_feature, flags.hidden_dim, flags.num_classes).cuda()
 model_regularizer = model_regularizer(flags.hidden_dim, flags.num_classes).cuda()
 model_final = model_task(model_feature_final, flags.hidden_dim, flags.num_classes).cuda()
+# all task networks share model_feature, run it once for the three domains
+if flags.multi_head:
+    model_multi_head = model_multi_head(model_feature, [model_task1, model_task2, model_task3]).cuda()
+else:
+    model_multi_head = None
 
 # set train function 
 def trainer(model_task1, model_task2, model_task3, model_regularizer, model_final, train_data_full,
@@ -64,13 +74,18 @@ def trainer(model_task1, model_task2, model_task3, model_regularizer, model_fina
     optimizer_task2 = optim.SGD(model_task2.parameters(), lr=learning_rate, momentum=0.9)
     optimizer_task3 = optim.SGD(model_task3.parameters(), lr=learning_rate, momentum=0.9)
     optimizer_reg = optim.SGD(model_regularizer.parameters(), lr=learning_rate, momentum=0.9)
+    if model_multi_head is not None:
+        optimizer_multi_head = optim.SGD(model_multi_head.parameters(), lr=learning_rate, momentum=0.9)
+    else:
+        optimizer_multi_head = None
     
     # metatraining
     for epoch in range(epochs_metatrain):  
 
         train_one_epoch_metatrain(model_task1, model_task2, model_task3, model_regularizer, train_data1, 
                         train_data2, train_data3, optimizer_task1, optimizer_task2, optimizer_task3, 
-                        optimizer_reg, loss_function, learning_rate, flags.meta_train_steps)
+                        optimizer_reg, loss_function, learning_rate, flags.meta_train_steps,
+                        model_multi_head=model_multi_head, optimizer_multi_head=optimizer_multi_head)
         #print status         
         template = 'Step {} of {} of Meta Learning completed'
         print(template.format(epoch+1, epochs_metatrain)) 
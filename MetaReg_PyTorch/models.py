@@ -1,3 +1,4 @@
+import torch
 import torchvision.models as models
 from torch import nn
 # ResNet50 as feature network
@@ -14,7 +15,11 @@ class model_feature(nn.Module):
       return x
 
    def forward(self, input):
-      input = input.permute(0,3,1,2).cuda()
+      if input.dtype == torch.uint8:
+         # raw batches from the batched loader, normalize once on the device
+         input = input.cuda(non_blocking=True).permute(0,3,1,2).float().div_(255.)
+      else:
+         input = input.permute(0,3,1,2).cuda()
       x = self.logits(input)
       return x
 
@@ -39,6 +44,24 @@ class model_task(nn.Module):
       x = self.logits(input)
       return x
 
+# shares one feature network between the task networks, the feature network runs
+# once on the concatenated domain batches and every task head gets all features
+class model_multi_head(nn.Module):
+   def __init__(self, model_feature, model_tasks):
+      super(model_multi_head, self).__init__()
+      self.model_feature = model_feature
+      self.model_tasks = nn.ModuleList(model_tasks)
+      self.relu = nn.ReLU()
+
+   def logits(self, input):
+      x = self.model_feature(input)
+      x = self.relu(x)
+      return [model_task.linear1(x) for model_task in self.model_tasks]
+
+   def forward(self, input):
+      x = self.logits(input)
+      return x
+
 # regularizer network takes hidden_dims*num_classes as input 
 class model_regularizer(nn.Module):
    def __init__(self, hidden_dim, num_classes):
@@ -2,7 +2,6 @@ import torch
 import numpy as np
 import random
 from torch import nn, optim
-import copy
 import itertools
 import util
 
@@ -89,29 +88,35 @@ def train_step1(model_task1, model_task2, model_task3, input1, input2, input3, o
     model_task3_loss.backward()
     optimizer_task3.step()
 
+def train_step1_multi_head(model_multi_head, input1, input2, input3, optimizer_multi_head, 
+                           loss_function):
+    inputs = torch.cat([input1[0], input2[0], input3[0]], 0)
+    labels = torch.tensor(torch.squeeze(torch.cat([input1[1], input2[1], input3[1]], 0)), 
+                                    dtype=torch.long).cuda()
+    domains = torch.cat([torch.full((input[0].size(0),), i, dtype=torch.long) 
+                         for i, input in enumerate([input1, input2, input3])], 0).cuda()
+    # one feature network pass for all three domains
+    outputs = model_multi_head(inputs)
+    # mask the loss of every head to the examples of its own domain
+    loss = 0
+    for i, output in enumerate(outputs):
+        mask = domains == i
+        loss = loss + loss_function(output[mask], labels[mask])
+    # zero the parameter gradients
+    optimizer_multi_head.zero_grad()
+    # perform gradient descent
+    loss.backward()
+    optimizer_multi_head.step()
+
 def train_step2(model_regularizer, input1, input2, input3, loss_function, 
                 optimizer1, optimizer2, optimizer3,
                 learning_rate, models, random_domains):
-    inputs1, labels1 = input1
-    inputs2, labels2 = input2
-    inputs3, labels3 = input3
-
-    # get loss for model_task1 
-    model1_loss = loss_function(models[0](inputs1), torch.tensor(torch.squeeze(labels1), 
-                                    dtype=torch.long).cuda()) 
-    # get loss for model_task2
-    model2_loss = loss_function(models[1](inputs2), torch.tensor(torch.squeeze(labels2), 
-                                    dtype=torch.long).cuda()) 
-    # get loss for model_task3
-    model3_loss = loss_function(models[2](inputs3), torch.tensor(torch.squeeze(labels3), 
-                                    dtype=torch.long).cuda()) 
-                                    
-    # save losses in list                                
-    loss = [model1_loss, model2_loss, model3_loss]
-    # random meta train loss
-    meta_train_loss = loss[random_domains[0]]
     # random meta train model
     meta_train_model = models[random_domains[0]]
+    # only the loss of the meta train model is used, skip the other two forward passes
+    inputs, labels = [input1, input2, input3][random_domains[0]]
+    meta_train_loss = loss_function(meta_train_model(inputs), torch.tensor(torch.squeeze(labels), 
+                                    dtype=torch.long).cuda()) 
     # get loss of regularizer 
     loss_regularizer = model_regularizer(torch.abs(torch.flatten(meta_train_model.linear1.weight)))
     # add the losses
@@ -139,26 +144,50 @@ def train_step3(model_regularizer, input1, input2, input3, optimizer_reg,
   
 
 
+# snapshot the parts of the task models the meta learning step changes: the linear1 heads
+# and the buffers (batchnorm statistics) of the shared feature network
+def snapshot_heads(models, model_feature):
+    heads = [{name: value.detach().clone() for name, value in model.linear1.state_dict().items()} 
+             for model in models]
+    buffers = {name: value.detach().clone() for name, value in model_feature.named_buffers()}
+    return heads, buffers
+
+def restore_heads(models, model_feature, snapshot):
+    heads, buffers = snapshot
+    for model, head in zip(models, heads):
+        model.linear1.load_state_dict(head)
+    with torch.no_grad():
+        for name, value in model_feature.named_buffers():
+            value.copy_(buffers[name])
+
 # train one epoch of the metalearning step (not train the full model)
 def train_one_epoch_metatrain(model_task1, model_task2, model_task3, model_regularizer ,train_input1, 
                     train_input2, train_input3, optimizer_task1, optimizer_task2, optimizer_task3, 
-                    optimizer_reg, loss_function, learning_rate, meta_train_steps):
+                    optimizer_reg, loss_function, learning_rate, meta_train_steps, 
+                    model_multi_head=None, optimizer_multi_head=None):
 
     # TRAIN STEP 1, regular training (line 2-7 in MetaReg algo)
     for i, (input1, input2 ,input3) in enumerate(zip(train_input1, train_input2, train_input3)):
-        train_step1(model_task1, model_task2, model_task3, input1, input2, input3, optimizer_task1, 
-                    optimizer_task2, optimizer_task3, loss_function)
+        if model_multi_head is not None:
+            train_step1_multi_head(model_multi_head, input1, input2, input3, optimizer_multi_head, 
+                                   loss_function)
+        else:
+            train_step1(model_task1, model_task2, model_task3, input1, input2, input3, optimizer_task1, 
+                        optimizer_task2, optimizer_task3, loss_function)
                     
     # sample two random domains
     random_domains = random.sample([0, 1, 2], 2)
-    # create deepcopies of models for meta learning
-    model1 = copy.deepcopy(model_task1)
-    model2 = copy.deepcopy(model_task2)
-    model3 = copy.deepcopy(model_task3)
     # make list with models
-    models = [model1, model2, model3]
+    models = [model_task1, model_task2, model_task3]
+    # only the heads are meta learned, snapshot them instead of deepcopying the full models
+    # and freeze the shared feature network so no gradients are kept for it
+    model_feature = model_task1.model_feature
+    snapshot = snapshot_heads(models, model_feature)
+    requires_grad = [param.requires_grad for param in model_feature.parameters()]
+    for param in model_feature.parameters():
+        param.requires_grad_(False)
     # choose randomly n metatrain steps
-    meta_train_sample = util.sample(zip(train_input1, train_input2, train_input3), meta_train_steps)
+    meta_train_sample = util.sample_batches([train_input1, train_input2, train_input3], meta_train_steps)
     # set optimizers 
     optimizer1 = optim.SGD(models[0].linear1.parameters(), lr=learning_rate, momentum=0.9)
     optimizer2 = optim.SGD(models[1].linear1.parameters(), lr=learning_rate, momentum=0.9)
@@ -176,6 +205,11 @@ def train_one_epoch_metatrain(model_task1, model_task2, model_task3, model_regul
                 optimizer_reg, loss_function, models=models, 
                 random_domains=random_domains)
 
+    # the meta learned heads are discarded, restore the task models
+    restore_heads(models, model_feature, snapshot)
+    for param, grad in zip(model_feature.parameters(), requires_grad):
+        param.requires_grad_(grad)
+
 def train_step_full(input, model_final, model_regularizer, loss_function ,optimizer_final):
     inputs, labels = input
     model_final = model_final.train()
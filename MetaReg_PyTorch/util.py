@@ -1,21 +1,30 @@
 import random 
 
-def sample(iterator, k):
+def sample_batches(loaders, k):
     """
-    Samples k elements from an iterable object.
+    Samples k batches from every DataLoader without iterating the loaders. 
+    The batch indices are drawn up front and only the chosen batches are loaded.
 
-    :param iterator: an object that is iterable
-    :param k: the number of items to sample
+    :param loaders: list of DataLoaders (one per domain)
+    :param k: the number of batches to sample
     """
-    # fill the reservoir to start
-    result = [next(iterator) for _ in range(k)]
-
-    n = k - 1
-    for item in iterator:
-        n += 1
-        s = random.randint(0, n)
-        if s < k:
-            result[s] = item
-
-    return result
-
+    batches = []
+    for loader in loaders:
+        dataset = loader.dataset
+        # batched loaders yield whole batches from a BatchSampler
+        if loader.batch_size is None:
+            batch_size = loader.sampler.batch_size
+        else:
+            batch_size = loader.batch_size
+        num_batches = min(k, len(dataset) // batch_size)
+        indices = random.sample(range(len(dataset)), num_batches * batch_size)
+        domain_batches = []
+        for i in range(num_batches):
+            batch_indices = indices[i*batch_size:(i+1)*batch_size]
+            if loader.batch_size is None:
+                # the dataset reads the whole batch at once
+                domain_batches.append(dataset[batch_indices])
+            else:
+                domain_batches.append(loader.collate_fn([dataset[index] for index in batch_indices]))
+        batches.append(domain_batches)
+    return list(zip(*batches))
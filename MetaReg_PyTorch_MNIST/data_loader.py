@@ -3,16 +3,64 @@ import util
 import numpy as np
 import torch
 import h5py
+import bisect
 
 class mnist(data.Dataset):
-    def __init__(self, data, e):
+    def __init__(self, data, e, seed=None, stream=0):
         super(mnist, self).__init__()
         self.data = data[0]
         self.target = data[1]
         self.e = e
+        self.seed = seed
+        self.stream = stream
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        # draw the label and color flips of all samples for this epoch at once,
+        # with a seed the stream of an epoch does not depend on batch order or workers
+        if self.seed is None:
+            rng = np.random
+        else:
+            rng = np.random.RandomState([self.seed, self.stream, epoch])
+        n = self.data.shape[0]
+        self.label_noise = torch.from_numpy((rng.uniform(size=n) < 0.25).astype(np.float32))
+        self.color_noise = torch.from_numpy((rng.uniform(size=n) < self.e).astype(np.float32))
 
     def __getitem__(self, index):
+        if isinstance(index, (list, tuple, np.ndarray)):
+            return self.get_batch(index)
         return util.preprocess(self.data[index,:,:], self.target[index], self.e)
+
+    def get_batch(self, indices):
+        # transform a whole batch of indices at once
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        return util.preprocess_batch(self.data[indices], self.target[indices], 
+                                     self.label_noise[indices], self.color_noise[indices])
         
     def __len__(self):
-        return self.data.shape[0]
\ No newline at end of file
+        return self.data.shape[0]
+
+class mnist_concat(data.ConcatDataset):
+    # ConcatDataset which also accepts a list of indices and forwards them per dataset
+    def __getitem__(self, index):
+        if not isinstance(index, (list, tuple, np.ndarray)):
+            return super(mnist_concat, self).__getitem__(index)
+        indices_per_dataset = [[] for _ in self.datasets]
+        for idx in index:
+            dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+            offset = 0 if dataset_idx == 0 else self.cumulative_sizes[dataset_idx - 1]
+            indices_per_dataset[dataset_idx].append(idx - offset)
+        batches = [dataset.get_batch(indices) for dataset, indices in 
+                   zip(self.datasets, indices_per_dataset) if len(indices) > 0]
+        images = torch.cat([images for images, _ in batches], 0)
+        labels = torch.cat([labels for _, labels in batches], 0)
+        return images, labels
+
+def get_loader(dataset, batch_size, num_workers=1, batched=False):
+    if batched:
+        # the sampler yields whole batches of indices, the dataset transforms them at once
+        sampler = data.BatchSampler(data.RandomSampler(dataset), batch_size, drop_last=True)
+        return data.DataLoader(dataset, sampler=sampler, batch_size=None, 
+                               num_workers=num_workers)
+    return data.DataLoader(dataset, num_workers=num_workers, batch_size=batch_size, 
+                           shuffle=True, drop_last=True)
@@ -7,7 +7,7 @@ import argparse
 import numpy as np
 from models import model_feature, model_task, model_regularizer
 from torch.utils import data
-from data_loader import mnist
+from data_loader import mnist, mnist_concat, get_loader
 from train import validate_epoch, train_one_epoch_metatrain, train_one_epoch_full
 
 parser = argparse.ArgumentParser(description='PACS')
@@ -19,6 +19,7 @@ parser.add_argument('--epochs_full', type=int, default=15)
 parser.add_argument('--num_classes', type=int, default=1)
 parser.add_argument('--meta_train_steps', type=int, default=20)
 parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--batched_transform', type=int, default=0)
 flags = parser.parse_args()
 
 #print setup
@@ -39,17 +40,21 @@ mnist_test = datasets.MNIST(root='./data', train=False, download=True, transform
 test_data = (mnist_test.test_data, mnist_test.test_labels)
 
 # put data in dataloader
-train_data1 = mnist(train_data1, 0.2)
-train_data2 = mnist(train_data2, 0.1)
-test_data = mnist(test_data, 0.9)
-train_data_full = data.DataLoader(data.ConcatDataset([train_data1, train_data2]), num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)
-train_data1 = data.DataLoader(train_data1, num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)
-train_data2 = data.DataLoader(train_data2, num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)                                
-test_data = data.DataLoader(test_data, num_workers=1, batch_size=flags.batch_size, 
-                              shuffle=True, drop_last=True)            
+if flags.batched_transform:
+    # whole index batches are transformed at once with seeded per-epoch flips
+    train_data1 = mnist(train_data1, 0.2, seed=flags.seed, stream=0)
+    train_data2 = mnist(train_data2, 0.1, seed=flags.seed, stream=1)
+    test_data = mnist(test_data, 0.9, seed=flags.seed, stream=2)
+else:
+    train_data1 = mnist(train_data1, 0.2)
+    train_data2 = mnist(train_data2, 0.1)
+    test_data = mnist(test_data, 0.9)
+datasets_mnist = [train_data1, train_data2, test_data]
+train_data_full = get_loader(mnist_concat([train_data1, train_data2]), flags.batch_size, 
+                             batched=flags.batched_transform)
+train_data1 = get_loader(train_data1, flags.batch_size, batched=flags.batched_transform)
+train_data2 = get_loader(train_data2, flags.batch_size, batched=flags.batched_transform)
+test_data = get_loader(test_data, flags.batch_size, batched=flags.batched_transform)
 
 # load models
 model_feature_final = model_feature(flags.hidden_dim).cuda()
@@ -71,6 +76,9 @@ def trainer(model_task1, model_task2, model_regularizer, model_final, train_data
     
     # metatraining
     for epoch in range(epochs_metatrain):  
+        if flags.batched_transform:
+            for dataset in datasets_mnist:
+                dataset.set_epoch(epoch)
 
         train_one_epoch_metatrain(model_task1, model_task2, model_regularizer, train_data1, 
                         train_data2,  optimizer_task1, optimizer_task2,  
@@ -85,6 +93,9 @@ def trainer(model_task1, model_task2, model_regularizer, model_final, train_data
     # full training 
     print('Start Training of Full Model')
     for epoch in range(epochs_full):
+        if flags.batched_transform:
+            for dataset in datasets_mnist:
+                dataset.set_epoch(epochs_metatrain + epoch)
         train_one_epoch_full(train_data_full, model_final, model_regularizer, loss_function, optimizer_final)
         # validate epoch on validation set
         loss_train, accuracy_train, loss_test, accuracy_test = validate_epoch(train_data_full, test_data, model_final, loss_function)
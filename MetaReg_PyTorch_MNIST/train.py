@@ -138,7 +138,7 @@ def train_one_epoch_metatrain(model_task1, model_task2, model_regularizer ,train
     # make list with models
     models = [model1, model2]
     # choose randomly n metatrain steps
-    meta_train_sample = util.sample(zip(train_input1, train_input2), meta_train_steps)
+    meta_train_sample = util.sample_batches([train_input1, train_input2], meta_train_steps)
     # TRAIN STEP 2, meta learning of regularizer (line 10-13 in MetaReg algo)
     for input1, input2 in meta_train_sample:
         train_step2(model_regularizer, input1, input2, loss_function, 
@@ -20,21 +20,45 @@ def preprocess(images, labels, e):
     labels = torch.squeeze(labels)
     return images.float(), labels
 
-def sample(iterator, k):
-    """
-    Samples k elements from an iterable object.
+def preprocess_batch(images, labels, label_noise, color_noise):
+    # same transform as preprocess for a whole batch, the Bernoulli draws are passed in
+    # 2x subsample for computational convenience
+    images = images.reshape((-1, 28, 28))[:, ::2, ::2]
+    # Assign a binary label based on the digit; flip label with probability 0.25
+    labels = (labels < 5).float()
+    labels = (labels - label_noise).abs()
+    # Assign a color based on the label; flip the color with probability e
+    colors = (labels - color_noise).abs()
+    # Apply the color to the image by zeroing out the other color channel
+    images = torch.stack([images, images], dim=1)
+    images[torch.arange(len(images)), (1-colors).long(), :, :] *= 0
+    return images.float() / 255., labels
 
-    :param iterator: an object that is iterable
-    :param k: the number of items to sample
+def sample_batches(loaders, k):
     """
-    # fill the reservoir to start
-    result = [next(iterator) for _ in range(k)]
+    Samples k batches from every DataLoader without iterating the loaders. 
+    The batch indices are drawn up front and only the chosen batches are loaded.
 
-    n = k - 1
-    for item in iterator:
-        n += 1
-        s = random.randint(0, n)
-        if s < k:
-            result[s] = item
-
-    return result
\ No newline at end of file
+    :param loaders: list of DataLoaders (one per domain)
+    :param k: the number of batches to sample
+    """
+    batches = []
+    for loader in loaders:
+        dataset = loader.dataset
+        # batched loaders yield whole batches from a BatchSampler
+        if loader.batch_size is None:
+            batch_size = loader.sampler.batch_size
+        else:
+            batch_size = loader.batch_size
+        num_batches = min(k, len(dataset) // batch_size)
+        indices = random.sample(range(len(dataset)), num_batches * batch_size)
+        domain_batches = []
+        for i in range(num_batches):
+            batch_indices = indices[i*batch_size:(i+1)*batch_size]
+            if loader.batch_size is None:
+                # the dataset reads the whole batch at once
+                domain_batches.append(dataset[batch_indices])
+            else:
+                domain_batches.append(loader.collate_fn([dataset[index] for index in batch_indices]))
+        batches.append(domain_batches)
+    return list(zip(*batches))
@@ -8,6 +8,7 @@ from PIL import Image
 
 import local_settings
 import os
+import shutil
 import numpy as np
 from absl import flags, app
 
@@ -23,6 +24,7 @@ PCAS
 
 flags.DEFINE_list(name="validation_split", default=["photo"], help="")
 flags.DEFINE_string(name="tfds_path", default=None, help="")
+flags.DEFINE_boolean(name="write_raw_shards", default=False, help="")
 
 flags = flags.FLAGS
 
@@ -47,6 +49,59 @@ else:
 
 
 
+def _split_files():
+    # TODO: remove split defined in validation_split and create separate test set for it
+    # TODO: download remaining datasets and fix the filename vars below - done
+
+    # filter hold out domain out from training data
+    filenames_train = ['pacs/art_painting_train.hdf5', 'pacs/sketch_train.hdf5',
+                 'pacs/cartoon_train.hdf5', 'pacs/photo_train.hdf5']
+    train_list = sorted(set(filenames_train) - set(holdout_domain_path))
+
+    filenames = [train_list[0]]
+    train_files1 = [os.path.join(local_settings.RAW_DATA_PATH, f) 
+        for f in filenames]
+    
+    filenames = [train_list[1]]
+    train_files2 = [os.path.join(local_settings.RAW_DATA_PATH, f) 
+        for f in filenames]
+
+    filenames = [train_list[2]]
+    train_files3 = [os.path.join(local_settings.RAW_DATA_PATH, f) 
+        for f in filenames]
+
+    filenames = train_list
+    train_files_complete = [os.path.join(local_settings.RAW_DATA_PATH, f) 
+        for f in filenames]
+
+    # filter hold out domain out from validation data
+    filenames_val = ['pacs/art_painting_val.hdf5', 'pacs/sketch_val.hdf5',
+                 'pacs/cartoon_val.hdf5', 'pacs/photo_val.hdf5']
+    val_list = sorted(set(filenames_val) - set(holdout_domain_path))
+
+    filenames = val_list
+    validation_files_in = [os.path.join(local_settings.RAW_DATA_PATH, f) 
+        for f in filenames]
+
+    filenames = [holdout_domain_path[1]]
+    validation_files_out = [os.path.join(local_settings.RAW_DATA_PATH, f)
+        for f in filenames]
+
+    # filenames = ['pacs/art_painting_test.hdf5', 'pacs/sketch_test.hdf5',
+    #              'pacs/cartoon_test.hdf5']
+    # test_files = [os.path.join(local_settings.RAW_DATA_PATH, f)
+    #               for f in filenames]
+
+    return {
+        "train1": train_files1,
+        "train2": train_files2,
+        "train3": train_files3,
+        "train": train_files_complete,
+        "val_in": validation_files_in,
+        "val_out": validation_files_out
+    }
+
+
 class PACSConfig(tfds.core.BuilderConfig):
     def __init__(self, validation_split=None, **kwargs):
         self.validation_split = VALIDATION_SPLIT
@@ -85,90 +140,49 @@ class PACS(tfds.core.GeneratorBasedBuilder):
 
 
     def _split_generators(self, dl_manager):
-        
-        # TODO: remove split defined in validation_split and create separate test set for it
-        # TODO: download remaining datasets and fix the filename vars below - done
-
-        # filter hold out domain out from training data
-        filenames_train = ['pacs/art_painting_train.hdf5', 'pacs/sketch_train.hdf5',
-                     'pacs/cartoon_train.hdf5', 'pacs/photo_train.hdf5']
-        train_list = list(set(filenames_train) - set(holdout_domain_path))
-
-        filenames = [train_list[0]]
-        train_files1 = [os.path.join(local_settings.RAW_DATA_PATH, f) 
-            for f in filenames]
-        
-        filenames = [train_list[1]]
-        train_files2 = [os.path.join(local_settings.RAW_DATA_PATH, f) 
-            for f in filenames]
-
-        filenames = [train_list[2]]
-        train_files3 = [os.path.join(local_settings.RAW_DATA_PATH, f) 
-            for f in filenames]
-
-        filenames = train_list
-        train_files_complete = [os.path.join(local_settings.RAW_DATA_PATH, f) 
-            for f in filenames]
-
-        # filter hold out domain out from validation data
-        filenames_val = ['pacs/art_painting_val.hdf5', 'pacs/sketch_val.hdf5',
-                     'pacs/cartoon_val.hdf5', 'pacs/photo_val.hdf5']
-        val_list = list(set(filenames_val) - set(holdout_domain_path))
-
-        filenames = val_list
-        validation_files_in = [os.path.join(local_settings.RAW_DATA_PATH, f) 
-            for f in filenames]
-
-        filenames = [holdout_domain_path[1]]
-        validation_files_out = [os.path.join(local_settings.RAW_DATA_PATH, f)
-            for f in filenames]
-
-        # filenames = ['pacs/art_painting_test.hdf5', 'pacs/sketch_test.hdf5',
-        #              'pacs/cartoon_test.hdf5']
-        # test_files = [os.path.join(local_settings.RAW_DATA_PATH, f)
-        #               for f in filenames]
+        split_files = _split_files()
 
         return [tfds.core.SplitGenerator(
                     name="train1",
                     num_shards=30,
                     gen_kwargs=dict(
                         split="train1",
-                        files=train_files1
+                        files=split_files["train1"]
                 )),
                 tfds.core.SplitGenerator(
                     name="train2",
                     num_shards=30,
                     gen_kwargs=dict(
                         split="train2",
-                        files=train_files2
+                        files=split_files["train2"]
                 )),
                 tfds.core.SplitGenerator(
                     name="train3",
                     num_shards=30,
                     gen_kwargs=dict(
                         split="train3",
-                        files=train_files3
+                        files=split_files["train3"]
                 )),                   
                 tfds.core.SplitGenerator(
                     name=tfds.Split.TRAIN,
                     num_shards=1,
                     gen_kwargs=dict(
                         split="train",
-                        files=train_files_complete
+                        files=split_files["train"]
                 )),
                 tfds.core.SplitGenerator(
                     name="val_in",
                     num_shards=30,
                     gen_kwargs=dict(
                         split="val_in",
-                        files=validation_files_in
+                        files=split_files["val_in"]
                 )),
                 tfds.core.SplitGenerator(
                     name="val_out",
                     num_shards=1,
                     gen_kwargs=dict(
                         split="val_out",
-                        files=validation_files_out))
+                        files=split_files["val_out"]))
                 # tfds.core.SplitGenerator(
                 #     name=tfds.Split.VALIDATION,
                 #     num_shards=10,
@@ -208,6 +222,99 @@ class PACS(tfds.core.GeneratorBasedBuilder):
 
 
 
+# raw uint8 shards at the model resolution, an alternative to the png encoded tfds records
+RAW_SHARD_SIZE = 1000
+# the split definitions differ between the projects, each one gets its own raw cache
+RAW_CACHE_NAME = "resnet50_0.1.11"
+
+
+def _raw_dir(data_dir, image_size):
+    return os.path.join(data_dir, "pacs_raw", RAW_CACHE_NAME, "_".join(VALIDATION_SPLIT), 
+        "{}x{}".format(image_size[0], image_size[1]))
+
+
+def _write_raw_split(files, image_size, split_dir, shard_size):
+    os.makedirs(split_dir)
+
+    shards = []
+    for f in files:
+        file_ = h5py.File(f, 'r')
+        images = file_['images']
+        labels = np.reshape(np.asarray(file_['labels']), [-1]).astype(np.int64)
+        domain = f.split("_")[0].split("/")[-1]
+
+        for start in range(0, images.shape[0], shard_size):
+            end = min(start + shard_size, images.shape[0])
+            name = "shard-{:05d}".format(len(shards))
+
+            # write the images into a .npy file, it can be memory-mapped with numpy as well
+            shard_images = np.lib.format.open_memmap(os.path.join(split_dir, name + ".images.npy"), 
+                mode='w+', dtype=np.uint8, shape=(end - start, image_size[0], image_size[1], 3))
+            for i, img in enumerate(images[start:end]):
+                img = np.uint8(img)
+                if list(img.shape[:2]) != list(image_size):
+                    img = np.asarray(Image.fromarray(img).resize((image_size[1], image_size[0]), 
+                        Image.BILINEAR))
+                shard_images[i] = img
+            shard_images.flush()
+            del shard_images
+
+            np.save(os.path.join(split_dir, name + ".labels.npy"), labels[start:end])
+            shards.append({"name": name, "num_examples": end - start, "domain": domain})
+
+        file_.close()
+
+    with open(os.path.join(split_dir, "shards.json"), 'w') as f:
+        json.dump({"image_size": list(image_size), "shards": shards}, f, indent=2)
+
+
+def write_raw_shards(image_size, data_dir, shard_size=RAW_SHARD_SIZE):
+    # all splits are written in one pass from a single split definition
+    raw_dir = _raw_dir(data_dir, image_size)
+    tmp_dir = "{}.{}.tmp".format(raw_dir, os.getpid())
+    for split, files in _split_files().items():
+        _write_raw_split(files, image_size, os.path.join(tmp_dir, split), shard_size)
+
+    # renamed into place at the end, a partially written cache is never read
+    try:
+        os.rename(tmp_dir, raw_dir)
+    except OSError:
+        # another process finished the cache first
+        shutil.rmtree(tmp_dir)
+
+
+def load_raw_split(split, image_size, data_dir):
+    split = str(split)
+    raw_dir = _raw_dir(data_dir, image_size)
+    if not os.path.exists(raw_dir):
+        write_raw_shards(image_size, data_dir)
+    split_dir = os.path.join(raw_dir, split)
+    with open(os.path.join(split_dir, "shards.json"), 'r') as f:
+        index = json.load(f)
+
+    image_shape = list(image_size) + [3]
+    record_bytes = int(np.prod(image_shape))
+
+    def _decode(image, label, domain):
+        # no png decode and no resize, the record is the image
+        image = tf.reshape(tf.io.decode_raw(image, tf.uint8), image_shape)
+        return {"image": image, "attributes": {"label": label, "domain": domain}}
+
+    dataset = None
+    for shard in index["shards"]:
+        images_path = os.path.join(split_dir, shard["name"] + ".images.npy")
+        labels = np.load(os.path.join(split_dir, shard["name"] + ".labels.npy"))
+        # skip the .npy header, the rest of the file are fixed size records
+        header_bytes = os.path.getsize(images_path) - shard["num_examples"] * record_bytes
+        shard_dataset = tf.data.Dataset.zip((
+            tf.data.FixedLengthRecordDataset(images_path, record_bytes, header_bytes=header_bytes),
+            tf.data.Dataset.from_tensor_slices(labels),
+            tf.data.Dataset.from_tensors(shard["domain"]).repeat(shard["num_examples"])))
+        dataset = shard_dataset if dataset is None else dataset.concatenate(shard_dataset)
+
+    return dataset.map(_decode)
+
+
 def main(_):
     builder_kwargs = {
         "validation_split": flags.validation_split
@@ -217,6 +324,10 @@ def main(_):
     if flags.tfds_path is not None:
         tfdataset_path = flags.tfds_path
 
+    if flags.write_raw_shards:
+        write_raw_shards([227, 227], tfdataset_path)
+        return
+
     train, dsinfo = tfds.load("pacs", 
         data_dir=tfdataset_path, split=tfds.Split.VALIDATION,
         builder_kwargs=builder_kwargs, with_info=True)
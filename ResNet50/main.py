@@ -55,6 +55,10 @@ parser.add_argument('--overwrite_configs', type=int,
     help='Flag whether to overwrite configs.')
 parser.add_argument('--dropout_rate', type=float, help='Dropout rate.')
 parser.add_argument('--use_dropout', type=int, help='Flag whether to use dropout.')
+parser.add_argument('--raw_shards', type=int, help='Flag whether to read the raw uint8 shards.')
+parser.add_argument('--parallel_pipeline', type=int, help='Flag whether to use parallel map and prefetch.')
+parser.add_argument('--deterministic_pipeline', type=int, help='Flag whether to keep the element order.')
+parser.add_argument('--cache_eval', type=int, help='Flag whether to cache the eval splits.')
 
 
 
@@ -107,8 +111,11 @@ def _train_step(model, features1, features2, optimizer, global_step, config):
 
 def train_one_epoch(model, train_input1, train_input2, optimizer, global_step, config):
 
-    for _input1, _input2 in zip(train_input1, train_input2):
+    # measure how long the loop waits for the input pipeline
+    input_timer = util.InputTimer()
+    for _input1, _input2 in input_timer(zip(train_input1, train_input2)):
         _train_step(model, _input1, _input2, optimizer, global_step, config)
+    return input_timer
 
 
 # compute the mean of all examples for a specific set (eval, validation, out-of-distribution, etc)
@@ -143,30 +150,57 @@ def eval_one_epoch(model, dataset, summary_directory, global_step, config, train
 
 def _preprocess_exampe(model, example, dataset_name):
     example["image"] = tf.cast(example["image"], dtype=tf.float32)/255.
-    example["image"] = tf.image.resize(example["image"], 
-        size=(model.input_shape[0], model.input_shape[1]))
+    if example["image"].shape[:2].as_list() != list(model.input_shape):
+        example["image"] = tf.image.resize(example["image"], 
+            size=(model.input_shape[0], model.input_shape[1]))
     example["label"] = example["attributes"]["label"]
     example["domain"] = example["attributes"]["domain"]
     example["label"] = tf.subtract(example["label"],1)
     return example
 
 
-def _get_dataset(dataset_name, model, validation_split, split, batch_size, 
-    num_batches=None):
+_BUILDERS = {}
 
-    builder_kwargs = {
-        "validation_split": validation_split,
-    }
+def _get_builder(dataset_name, validation_split):
+    # prepare the tfds builder once and read all splits from it
+    key = (dataset_name, tuple(validation_split))
+    if key not in _BUILDERS:
+        builder = tfds.builder(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
+            validation_split=validation_split)
+        builder.download_and_prepare()
+        _BUILDERS[key] = builder
+    return _BUILDERS[key]
 
-    dataset, info = tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
-        split=split, builder_kwargs=builder_kwargs, with_info=True)
-    dataset = dataset.map(lambda x: _preprocess_exampe(model, x, dataset_name))
+
+def _get_dataset(dataset_name, model, validation_split, split, batch_size, config, 
+    num_batches=None, cache=False):
+
+    if config.raw_shards:
+        dataset = pacs.load_raw_split(split, model.input_shape, local_settings.TF_DATASET_PATH)
+    else:
+        dataset = _get_builder(dataset_name, validation_split).as_dataset(split=split)
+
+    if config.parallel_pipeline:
+        num_parallel_calls = tf.data.experimental.AUTOTUNE
+    else:
+        num_parallel_calls = None
+    options = tf.data.Options()
+    options.experimental_deterministic = bool(config.deterministic_pipeline)
+    dataset = dataset.with_options(options)
+
+    dataset = dataset.map(lambda x: _preprocess_exampe(model, x, dataset_name), 
+        num_parallel_calls=num_parallel_calls)
+    # keep the preprocessed examples in memory, only used for the eval splits. take()
+    # stops the first pass early and an unfinished cache is never written
+    if cache and num_batches is None:
+        dataset = dataset.cache()
     dataset = dataset.shuffle(512)
     dataset = dataset.batch(batch_size)
     if num_batches is not None:
         dataset = dataset.take(num_batches)
 
-    # dataset = dataset.prefetch(2)
+    if config.parallel_pipeline:
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
     return dataset
 
@@ -271,19 +305,19 @@ def main():
 
     ds_train_complete = _get_dataset(config.dataset, model, config.test_domain,
         split=tfds.Split.TRAIN, batch_size=tf.cast(config.batch_size/2, tf.int64), 
-        num_batches=num_batches)
+        config=config, num_batches=num_batches, cache=config.cache_eval)
 
     ds_train1 = _get_dataset(config.dataset, model, config.test_domain,
         split="train1", batch_size=tf.cast(config.batch_size/2, tf.int64), 
-        num_batches=num_batches)
+        config=config, num_batches=num_batches)
 
     ds_train2 = _get_dataset(config.dataset, model, config.test_domain,
         split="train2", batch_size=tf.cast(config.batch_size/2, tf.int64), 
-        num_batches=num_batches)
+        config=config, num_batches=num_batches)
 
     ds_train3 = _get_dataset(config.dataset, model, config.test_domain,
         split="train3", batch_size=tf.cast(config.batch_size/2, tf.int64), 
-        num_batches=num_batches)
+        config=config, num_batches=num_batches)
     
     # ds_val = _get_dataset(config.dataset, model, config.test_domain,
     #     split=tfds.Split.VALIDATION, batch_size=config.batch_size, 
@@ -295,11 +329,11 @@ def main():
 
     ds_val_in = _get_dataset(config.dataset, model, config.test_domain,
         split="val_in", batch_size=tf.cast(config.batch_size/2, tf.int64),
-        num_batches=num_batches)
+        config=config, num_batches=num_batches, cache=config.cache_eval)
 
     ds_val_out = _get_dataset(config.dataset, model, config.test_domain,
         split="val_out", batch_size=tf.cast(config.batch_size/2, tf.int64),
-        num_batches=num_batches)
+        config=config, num_batches=num_batches, cache=config.cache_eval)
 
     # TODO: add test set - done
     
@@ -329,8 +363,9 @@ def main():
             
             # ds_train = poss_inputs[random[0]].concatenate(poss_inputs[random[1]])
 
-            train_one_epoch(model=model, train_input1=rand_inputs[random[0]], 
+            input_timer = train_one_epoch(model=model, train_input1=rand_inputs[random[0]], 
                 train_input2=rand_inputs[random[1]],optimizer=optimizer, global_step=global_step, config=config)
+            train_time = time.time() - start_time
 
             train_metr = eval_one_epoch(model=model, dataset=ds_train_complete,
                 summary_directory=os.path.join(manager._directory, "train"), 
@@ -364,6 +399,8 @@ def main():
             logging.info("\n #### \n epoch: %d, time: %0.2f" % 
                 (epoch, time.time() - start_time))
             logging.info("Global step: {}".format(global_step.numpy()))
+            logging.info("step_time: {:4f}, input_wait_time: {:2f}".format(
+                train_time/max(input_timer.num_steps, 1), input_timer.wait_time))
             logging.info("train_accuracy: {:2f}, train_loss: {:4f}".format(
                 train_metr['accuracy'], train_metr['loss']))
             logging.info("val_out_accuracy: {:2f}, val_out_loss: {:4f}".format(
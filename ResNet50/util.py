@@ -4,6 +4,7 @@ from collections import namedtuple
 from shutil import make_archive
 from datetime import datetime
 import os
+import time
 import tensorflow as tf
 
 import local_settings
@@ -39,3 +40,24 @@ def update_config(config, args):
                 config[entry] = eval("args.{}".format(entry))
     return config
 
+
+class InputTimer(object):
+    """
+    Wraps the input iterators of a training loop and accumulates the time 
+    spent waiting for the next batch.
+    """
+    def __init__(self):
+        self.wait_time = 0.
+        self.num_steps = 0
+
+    def __call__(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            start_time = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.wait_time += time.time() - start_time
+            self.num_steps += 1
+            yield item
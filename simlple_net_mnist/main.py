@@ -18,6 +18,7 @@ parser.add_argument('--batch_size', type=int, default=20000)
 parser.add_argument('--shuffle_buffer_size', type=int, default=20000)
 parser.add_argument('--grayscale_model', action='store_true')
 parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--env_cache', action='store_true')
 flags = parser.parse_args()
 random.seed(flags.seed)
 
@@ -88,11 +89,26 @@ def _preprocess_exampe(model, example, dataset_name, e):
     return example
 
 
-def _get_dataset(dataset_name, model, split, batch_size, e):
+def _load_raw(dataset_name, split):
+    data = tfds.as_numpy(tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
+        split=split, batch_size=-1))
+    return data["image"], data["label"]
 
-    dataset, _ = tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
-        split=split, with_info=True)
-    dataset = dataset.map(lambda x: _preprocess_exampe(model, x, dataset_name, e))
+
+def _get_dataset(dataset_name, model, split, batch_size, e, env_name=None):
+
+    if flags.env_cache:
+        # load the colored environment from the on-disk cache instead of preprocessing per example
+        images, labels, _ = util.load_colored_mnist("{}_{}".format(dataset_name, env_name), 
+            e, flags.seed, lambda: _load_raw(dataset_name, split), 
+            os.path.join(local_settings.RAW_DATA_PATH, "colored_mnist"))
+        images = np.transpose(images, (0, 2, 3, 1)).astype(np.float64)/255.
+        dataset = tf.data.Dataset.from_tensor_slices({"image": images, 
+            "label": labels[:, None, None]})
+    else:
+        dataset, _ = tfds.load(dataset_name, data_dir=local_settings.TF_DATASET_PATH, 
+            split=split, with_info=True)
+        dataset = dataset.map(lambda x: _preprocess_exampe(model, x, dataset_name, e))
     dataset = dataset.shuffle(flags.shuffle_buffer_size)
     dataset = dataset.batch(batch_size)
 
@@ -103,15 +119,15 @@ def _get_dataset(dataset_name, model, split, batch_size, e):
 
 train_ds1 = _get_dataset('mnist', model,
         split=tfds.Split.TRAIN.subsplit(tfds.percent[:50]), 
-        batch_size=flags.batch_size, e = 0.2)
+        batch_size=flags.batch_size, e = 0.2, env_name="train1")
 
 train_ds2 = _get_dataset('mnist', model, 
         split=tfds.Split.TRAIN.subsplit(tfds.percent[-50:]), 
-        batch_size=flags.batch_size,e = 0.1)
+        batch_size=flags.batch_size,e = 0.1, env_name="train2")
     
 test_ds = _get_dataset('mnist', model, 
         split=tfds.Split.TEST, batch_size=flags.batch_size, 
-        e = 0.9)
+        e = 0.9, env_name="test")
 
 
 # Build environments